@@ -0,0 +1,295 @@
+import sys, os
+import numpy as np
+import matplotlib.pyplot as plt
+import ti3d_eigen
+import mnk12
+
+usage = """Usage: python dos.py [options] calcType kpointsFileName outDir
+Writes the density of states of the model calcType (4band, 8band or mnk12)
+to outDir as .npy files: energies.npy, dos.npy and, for slabs, layers.npy
+(density of states projected on each layer, shape (numE, numLayers)).
+kpointsFileName is normally a uniform grid (see README.md); with
+--method gaussian a band path is also accepted, giving each k-point the
+same weight.
+Options:
+    --emin E     lowest energy (required)
+    --emax E     highest energy (required)
+    --ne N       number of energies (default 501)
+    --method M   gaussian (default) or tetra (linear tetrahedron method)
+    --sigma S    width of the Gaussian broadening (default 0.01)
+    --layers N   mnk12 only: slab with N layers, giving the layer-resolved
+                 density of states
+    --jobs N     diagonalize in N worker processes (gaussian only)"""
+
+knownOptions = ["emin", "emax", "ne", "method", "sigma", "layers", "jobs"]
+
+# Parse command-line arguments calcType, kpointsFileName, outDir and the
+# options given in usage.
+def parseArgs():
+    positional, options = ti3d_eigen.splitOptions(sys.argv[1:], knownOptions)
+    if (options is None or len(positional) != 3
+            or "emin" not in options or "emax" not in options
+            or options.get("method", "gaussian") not in ["gaussian", "tetra"]):
+        print(usage)
+        sys.exit(2)
+    return positional[0], positional[1], positional[2], options
+
+# Accumulates the density of states with Gaussian broadening from
+# eigenvalues given a chunk of k-points at a time. Each eigenvalue is
+# shared linearly between the two nearest points of a fine energy grid and
+# the resulting histogram is convolved with the Gaussian at the end, so
+# the memory used does not depend on the number of k-points and each chunk
+# costs O(number of eigenvalues). If numChannels > 0, the density of states
+# projected on each of numChannels channels (e.g. layers) is accumulated
+# as well.
+class GaussianDOS(object):
+    # Number of widths sigma beyond which the Gaussian is cut off.
+    CUTOFF = 6.0
+
+    def __init__(self, energies, sigma, numChannels=0):
+        self.energies = np.asarray(energies, dtype=np.float64)
+        self.sigma = sigma
+        self.step = sigma / 10.0
+        if len(self.energies) > 1:
+            self.step = min(self.step, self.energies[1] - self.energies[0])
+        # fine grid, extended so that eigenvalues just outside the energy
+        # range contribute their tails
+        self.start = self.energies[0] - self.CUTOFF*sigma
+        stop = self.energies[-1] + self.CUTOFF*sigma
+        numFine = int(np.ceil((stop - self.start) / self.step)) + 2
+        self.hist = np.zeros(numFine)
+        self.channelHist = np.zeros([numFine, numChannels])
+
+    # Add the eigenvalues eigenvals (shape (n, nb); NaN values are skipped)
+    # of n k-points with weights (shape (n,)). projections (shape
+    # (n, nb, numChannels)) gives the weight of each eigenstate on each
+    # channel.
+    def add(self, eigenvals, weights, projections=None):
+        eigenvals = np.asarray(eigenvals, dtype=np.float64)
+        w = np.broadcast_to(np.asarray(weights)[:, np.newaxis], eigenvals.shape)
+        x = (eigenvals - self.start) / self.step
+        valid = np.isfinite(x) & (x >= 0.0) & (x < len(self.hist) - 1)
+        x, w = x[valid], w[valid]
+        i = np.floor(x).astype(int)
+        upper = x - i
+        n = len(self.hist)
+        self.hist += (np.bincount(i, w*(1.0 - upper), n)
+                      + np.bincount(i + 1, w*upper, n))
+        if projections is not None:
+            p = projections[valid]
+            for c in range(self.channelHist.shape[1]):
+                self.channelHist[:, c] += (np.bincount(i, w*(1.0 - upper)*p[:, c], n)
+                                           + np.bincount(i + 1, w*upper*p[:, c], n))
+
+    # Return (dos, pdos) at the energies: dos has shape (nE,) and pdos has
+    # shape (nE, numChannels).
+    def result(self):
+        half = int(np.ceil(self.CUTOFF*self.sigma / self.step))
+        x = self.step * np.arange(-half, half + 1)
+        kernel = np.exp(-0.5*(x/self.sigma)**2) / (self.sigma*np.sqrt(2.0*np.pi))
+        fine = self.start + self.step*np.arange(len(self.hist))
+        dos = np.interp(self.energies, fine,
+                        np.convolve(self.hist, kernel, mode="same"))
+        pdos = np.zeros([len(self.energies), self.channelHist.shape[1]])
+        for c in range(pdos.shape[1]):
+            pdos[:, c] = np.interp(self.energies, fine,
+                                   np.convolve(self.channelHist[:, c], kernel, mode="same"))
+        return dos, pdos
+
+# Simplices dividing each cell of a uniform grid, as lists of cell corners
+# c = 4*i + 2*j + l for the corner at offset (i, j, l). Six tetrahedra
+# around the main diagonal divide a 3D cell; two triangles (l = 0) divide a
+# cell of a 2D grid (one point along the third reciprocal lattice vector).
+CELL_TETRAHEDRA = [[0, 1, 3, 7], [0, 1, 5, 7], [0, 2, 3, 7],
+                   [0, 2, 6, 7], [0, 4, 5, 7], [0, 4, 6, 7]]
+CELL_TRIANGLES = [[0, 2, 6], [0, 4, 6]]
+
+# Number of simplices passed to simplexDOS at once.
+SIMPLEX_BLOCK = 2**16
+
+# Return the density of states at energies (shape (nE,)) of linearly
+# interpolated bands on n simplices, summed over the simplices. e has shape
+# (n, d+1) and holds the band energies at the corners of triangles (d = 2)
+# or tetrahedra (d = 3); each simplex contributes a total weight of 1.
+# If projections (shape (n, numChannels)) is given, also return the sum
+# weighted by the projections of each simplex, shape (nE, numChannels).
+# Only the energies between the lowest and highest corner energy of each
+# simplex are evaluated. The tetrahedron formulas are those of Bloechl,
+# Jepsen and Andersen, PRB 49, 16223 (1994), without the curvature
+# correction.
+def simplexDOS(e, energies, projections=None):
+    e = np.sort(e, axis=1)
+    # pairs (simplex rows[i], energy cols[i]) with e_1 < E < e_(d+1)
+    lo = np.searchsorted(energies, e[:, 0], side="right")
+    hi = np.searchsorted(energies, e[:, -1], side="left")
+    counts = np.maximum(hi - lo, 0)
+    rows = np.repeat(np.arange(len(e)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cols = lo[rows] + offsets
+    E = energies[cols]
+    # corner energies and differences e_ij = e_i - e_j, kept away from 0:
+    # the intervals they bound are then empty, so they do not contribute
+    c = [e[rows, i] for i in range(e.shape[1])]
+    tiny = 1e-12
+    diff = lambda i, j: np.maximum(c[i] - c[j], tiny)
+    if e.shape[1] == 3:
+        g = np.where(E <= c[1],
+                     2.0*(E - c[0]) / (diff(1, 0)*diff(2, 0)),
+                     2.0*(c[2] - E) / (diff(2, 0)*diff(2, 1)))
+    else:
+        lower = 3.0*(E - c[0])**2 / (diff(1, 0)*diff(2, 0)*diff(3, 0))
+        middle = ((3.0*diff(1, 0) + 6.0*(E - c[1])
+                   - 3.0*(diff(2, 0) + diff(3, 1))*(E - c[1])**2 / (diff(2, 1)*diff(3, 1)))
+                  / (diff(2, 0)*diff(3, 0)))
+        upper = 3.0*(c[3] - E)**2 / (diff(3, 0)*diff(3, 1)*diff(3, 2))
+        g = np.where(E <= c[1], lower, np.where(E <= c[2], middle, upper))
+    dos = np.bincount(cols, g, len(energies))
+    if projections is None:
+        return dos, None
+    pdos = np.zeros([len(energies), projections.shape[1]])
+    for channel in range(projections.shape[1]):
+        pdos[:, channel] = np.bincount(cols, g*projections[rows, channel], len(energies))
+    return dos, pdos
+
+# Return (dos, pdos) at energies by the linear tetrahedron method (linear
+# triangles for 2D grids) over the full uniform grid of the KGrid grid.
+# solve(ks) returns (eigenvals, projections) for an array of k-points:
+# eigenvals has shape (n, nb) with the bands in ascending order and
+# projections has shape (n, nb, numChannels) or is None. The grid is
+# diagonalized one plane (fixed first grid index) at a time, and only two
+# planes are kept, so the memory used is that of two planes of results.
+# Cells wrap around the edges of the grid; this is exact for models
+# periodic in k (mnk12) but only approximate on the zone boundary for the
+# continuum models. The projected density of states uses the average of
+# the projections at the corners of each simplex.
+def tetrahedronDOS(solve, grid, energies):
+    energies = np.asarray(energies, dtype=np.float64)
+    N1, N2, N3 = grid.sizes
+    simplices = CELL_TETRAHEDRA
+    if N3 == 1:
+        simplices = CELL_TRIANGLES
+    planeSize = N2*N3
+    plane = lambda m1: solve(grid.fullKpoints[m1*planeSize:(m1+1)*planeSize])
+    # weight of each simplex
+    weight = 1.0 / (N1*N2*N3*len(simplices))
+    dos, pdos = np.zeros(len(energies)), None
+
+    first = plane(0)
+    current = first
+    for m1 in range(N1):
+        following = first
+        if m1 + 1 < N1:
+            following = plane(m1 + 1)
+        # values at the corners c = 4*i + 2*j + l of each cell, each with
+        # shape (N2, N3, nb, ...)
+        corners = []
+        for i, (vals, proj) in enumerate([current, following]):
+            for j in range(2):
+                for l in range(2):
+                    shape = (N2, N3) + vals.shape[1:]
+                    v = np.roll(np.roll(vals.reshape(shape), -j, axis=0), -l, axis=1)
+                    p = None
+                    if proj is not None:
+                        shape = (N2, N3) + proj.shape[1:]
+                        p = np.roll(np.roll(proj.reshape(shape), -j, axis=0), -l, axis=1)
+                    corners.append((v, p))
+        for simplex in simplices:
+            e = np.stack([corners[c][0] for c in simplex], axis=-1)
+            e = e.reshape(-1, len(simplex))
+            p = None
+            if corners[0][1] is not None:
+                p = np.mean([corners[c][1] for c in simplex], axis=0)
+                p = p.reshape(-1, p.shape[-1])
+                if pdos is None:
+                    pdos = np.zeros([len(energies), p.shape[-1]])
+            for start in range(0, len(e), SIMPLEX_BLOCK):
+                stop = start + SIMPLEX_BLOCK
+                g, gp = simplexDOS(e[start:stop], energies,
+                                   None if p is None else p[start:stop])
+                dos += weight * g
+                if gp is not None:
+                    pdos += weight * gp
+        current = following
+    if pdos is None:
+        pdos = np.zeros([len(energies), 0])
+    return dos, pdos
+
+# Return a function solving for (eigenvals, projections) at an array of
+# k-points with the Hamiltonian H, a chunk at a time. If project is not
+# None, the eigenkets are computed and project(eigenkets) gives the
+# projections; otherwise only eigenvalues are computed.
+def solver(H, project=None):
+    mode = {"eigvalsOnly": project is None}
+    def solve(ks):
+        vals, proj = [], []
+        for chunk, eigenvals, eigenkets in ti3d_eigen.diagonalizeChunks(H, ks, mode=mode):
+            vals.append(eigenvals)
+            if project is not None:
+                proj.append(project(eigenkets))
+        if project is None:
+            return np.concatenate(vals), None
+        return np.concatenate(vals), np.concatenate(proj)
+    return solve
+
+# Plot the density of states dos and the projected densities of states
+# pdos at the energies.
+def plotDOS(energies, dos, pdos):
+    plt.plot(energies, dos, "k")
+    for c in range(pdos.shape[1]):
+        plt.plot(energies, pdos[:, c])
+    plt.show()
+
+def main():
+    calcType, kpointsFileName, outDir, options = parseArgs()
+    energies = np.linspace(float(options["emin"]), float(options["emax"]),
+                           int(options.get("ne", 501)))
+    method = options.get("method", "gaussian")
+    jobs = int(options.get("jobs", 1))
+    # get appropriate Hamiltonian; slabs are projected on the layers
+    project, numChannels = None, 0
+    if "layers" in options:
+        numChannels = int(options["layers"])
+        fn, args = mnk12.HamiltonianSpec(calcType, numChannels)
+        project = mnk12.layerWeights
+    else:
+        fn, args = ti3d_eigen.HamiltonianSpec(calcType)
+    H = fn(*args)
+    grid = ti3d_eigen.getKpointGrid(kpointsFileName, calcType)
+
+    if method == "tetra":
+        if grid is None:
+            print("error: the tetrahedron method needs a uniform k-point grid")
+            sys.exit(2)
+        dos, pdos = tetrahedronDOS(solver(H, project), grid, energies)
+    else:
+        if grid is not None:
+            kpoints, weights = grid.kpoints, grid.weights
+        else:
+            kpoints = np.array(ti3d_eigen.getKpoints(kpointsFileName))
+            weights = np.full(len(kpoints), 1.0/len(kpoints))
+        mode = {"eigvalsOnly": project is None}
+        if jobs > 1:
+            chunks = ti3d_eigen.diagonalizeParallel(fn, args, kpoints, jobs, mode=mode)
+        else:
+            chunks = ti3d_eigen.diagonalizeChunks(H, kpoints, mode=mode)
+        accumulator = GaussianDOS(energies, float(options.get("sigma", 0.01)),
+                                  numChannels)
+        start = 0
+        for ks, eigenvals, eigenkets in chunks:
+            projections = None
+            if project is not None:
+                projections = project(eigenkets)
+            accumulator.add(eigenvals, weights[start:start+len(ks)], projections)
+            start += len(ks)
+        dos, pdos = accumulator.result()
+
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    np.save(os.path.join(outDir, "energies.npy"), energies)
+    np.save(os.path.join(outDir, "dos.npy"), dos)
+    if project is not None:
+        np.save(os.path.join(outDir, "layers.npy"), pdos)
+    plotDOS(energies, dos, pdos)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import sys, os
+import numpy as np
+import matplotlib.pyplot as plt
+import ti3d_eigen
+import mnk12
+
+usage = """Usage: python greens.py [options] kpointsFileName outDir
+Writes the spectral functions of the top and bottom surfaces and of the bulk
+of a semi-infinite mnk12 slab to outDir as .npy files (shape (numK, numE)).
+Options:
+    --emin E    lowest energy (default E_F - 0.5)
+    --emax E    highest energy (default E_F + 0.5)
+    --ne N      number of energies (default 201)
+    --eta E     broadening (imaginary part of the energy, default 0.005)"""
+
+# Maximum number of decimation steps. Each step doubles the number of
+# layers accounted for, so this is far more than enough unless eta is 0.
+MAX_DECIMATIONS = 60
+
+# Parse command-line arguments kpointsFileName, outDir and the options given
+# in usage.
+def parseArgs():
+    positional, options = ti3d_eigen.splitOptions(sys.argv[1:],
+                                                  ["emin", "emax", "ne", "eta"])
+    if options is None or len(positional) != 2:
+        print(usage)
+        sys.exit(2)
+    return positional[0], positional[1], options
+
+# Return the surface and bulk Green's functions of a semi-infinite stack
+# of identical layers with on-site block h0 and coupling h01 from each
+# layer to the next one (H[i, i+1] = h01), using the decimation method of
+# Lopez Sancho, Lopez Sancho and Rubio, J. Phys. F 15, 851 (1985). Each
+# iteration doubles the number of layers accounted for, so the result
+# converges in O(log N) block operations, N ~ 1/eta.
+#
+# h0 has shape (..., d, d), for instance one block for each k-point, and h01
+# has shape (d, d) or the same shape as h0. energies has shape (nE,) and eta
+# is the broadening. Return (G_top, G_bottom, G_bulk) with shape
+# (nE, ..., d, d): G_top is the Green's function of the surface layer with
+# the rest of the stack below it (coupled through h01), G_bottom that of the
+# surface layer with the rest of the stack above it (coupled through h01^H),
+# and G_bulk that of a layer deep inside an infinite stack.
+def decimate(h0, h01, energies, eta, tol=1e-12):
+    h0 = np.asarray(h0, dtype=np.complex128)
+    d = h0.shape[-1]
+    energies = np.asarray(energies, dtype=np.float64)
+    z = (energies + 1j*eta).reshape((-1,) + (1,)*h0.ndim) * np.eye(d)
+    shape = z.shape[:1] + h0.shape
+    eps_top = np.broadcast_to(h0, shape).copy()
+    eps_bottom = eps_top.copy()
+    eps = eps_top.copy()
+    alpha = np.broadcast_to(h01, shape).astype(np.complex128)
+    beta = np.swapaxes(alpha, -1, -2).conj()
+    for step in range(MAX_DECIMATIONS):
+        g = np.linalg.inv(z - eps)
+        ag, bg = np.matmul(alpha, g), np.matmul(beta, g)
+        agb, bga = np.matmul(ag, beta), np.matmul(bg, alpha)
+        eps_top += agb
+        eps_bottom += bga
+        eps += agb + bga
+        alpha, beta = np.matmul(ag, alpha), np.matmul(bg, beta)
+        if max(abs(alpha).max(), abs(beta).max()) < tol:
+            break
+    return (np.linalg.inv(z - eps_top), np.linalg.inv(z - eps_bottom),
+            np.linalg.inv(z - eps))
+
+# Return the spectral function A = -Im Tr G / pi for the stack of Green's
+# functions G (shape (..., d, d)).
+def spectralFunction(G):
+    return -np.trace(G, axis1=-2, axis2=-1).imag / np.pi
+
+# Return the spectral functions (A_top, A_bottom, A_bulk), each with shape
+# (numK, nE), of the semi-infinite mnk12 slab with properties p at the
+# k-points kpoints (shape (numK, 3); k_z is ignored) and the given energies.
+def surfaceSpectral_mnk12(p, kpoints, energies, eta):
+    diagonal, cross, single = mnk12.Blocks_mnk12(p)(kpoints)
+    G_top, G_bottom, G_bulk = decimate(diagonal, cross, energies, eta)
+    return tuple(spectralFunction(G).T for G in [G_top, G_bottom, G_bulk])
+
+# Plot the spectral function A (shape (numK, nE)) along the k-path.
+def plotSpectral(A, energies):
+    plt.imshow(np.log10(A.T + 1e-6), origin="lower", aspect="auto",
+               extent=[0, len(A) - 1, energies[0], energies[-1]])
+    plt.colorbar()
+    plt.show()
+
+def main():
+    kpointsFileName, outDir, options = parseArgs()
+    kpoints = np.array(ti3d_eigen.getKpoints(kpointsFileName))
+    props = ti3d_eigen.loadParams("mnk12")
+    energies = np.linspace(float(options.get("emin", props["E_F"] - 0.5)),
+                           float(options.get("emax", props["E_F"] + 0.5)),
+                           int(options.get("ne", 201)))
+    eta = float(options.get("eta", 0.005))
+
+    store = {}
+    for name in ["top", "bottom", "bulk"]:
+        store[name] = []
+    # a chunk of k-points at a time to bound the memory used by the
+    # (nE, numK, 4, 4) blocks
+    chunkSize = max(1, ti3d_eigen.CHUNK_BYTES // (16 * 16 * 8 * len(energies)))
+    for start in range(0, len(kpoints), chunkSize):
+        ks = kpoints[start:start+chunkSize]
+        A_top, A_bottom, A_bulk = surfaceSpectral_mnk12(props, ks, energies, eta)
+        store["top"].append(A_top)
+        store["bottom"].append(A_bottom)
+        store["bulk"].append(A_bulk)
+
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    np.save(outDir + "/k.npy", kpoints)
+    np.save(outDir + "/energies.npy", energies)
+    for name in ["top", "bottom", "bulk"]:
+        store[name] = np.concatenate(store[name])
+        np.save(outDir + "/A_" + name + ".npy", store[name])
+    plotSpectral(store["top"], energies)
+
+if __name__ == "__main__":
+    main()
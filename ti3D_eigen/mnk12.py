@@ -1,60 +1,246 @@
-import sys, json, math
+import sys, math
 import numpy as np
-from scipy import linalg
+from scipy import linalg, sparse
+from scipy.sparse import linalg as sparse_linalg
 import matplotlib.pyplot as plt
 import ti3d_eigen
-from ti3d_eigen import Gamma1, Gamma2, Gamma3, Gamma4, Gamma5
+from ti3d_eigen import Gamma1, Gamma2, Gamma3, Gamma4, Gamma5, scaleMatrix
 
-# Parse command-line arguments numLayers, kpointsFileName, outFileName
+usage = """Usage: python mnk12.py [options] numLayers kpointsFileName outFileName
+Options:
+    --jobs N        diagonalize k-points in N worker processes (default 1)
+    --format F      output format: text (default) or npy; for npy,
+                    outFileName is a directory of .npy files
+    --kets LO:HI    with --format npy, store only the eigenkets of bands
+                    LO to HI-1 (LO:LO stores none; default all); counted
+                    from 0 like --bands and within its range
+    --eigen E       full (default): eigenvalues and eigenkets;
+                    vals: eigenvalues only
+    --bands LO:HI   only find bands LO to HI-1 (counting from 0); the bands
+                    next to the Dirac point are 2N-4:2N+4
+    --window A:B    only find eigenvalues with A < E <= B
+    --solver S      dense (default) or banded: build H in banded storage and
+                    use the LAPACK banded Hermitian solver (O(N) memory);
+                    or sparse: find the --nev eigenvalues closest to --sigma
+                    with shift-invert Lanczos (no --jobs, --bands, --window)
+    --sigma E       target energy for --solver sparse (default E_F)
+    --nev K         number of eigenpairs for --solver sparse (default 8;
+                    at most 4N-2 for N layers)
+    --connect C     sorted (default) or overlap: connect bands in the plot by
+                    the overlap of the eigenkets (see ti3d_eigen.py)
+    --dirac TOL     instead of diagonalizing along the path, find the minima
+                    of the gap between bands 2N-1 and 2N (the Dirac point
+                    of the surface states) along it to within TOL (in 2pi/a
+                    units), and write their k, gap and Fermi velocity
+    --maxgap G      with --dirac, leave out minima with a gap above G
+                    (default: report all of them)"""
+
+# Parse command-line arguments numLayers, kpointsFileName, outFileName and
+# the options given in usage.
 def parseArgs():
-    if len(sys.argv) != 4:
-        print("Usage: python mnk12.py numLayers kpointsFileName outFileName")
+    positional, options = ti3d_eigen.splitOptions(sys.argv[1:],
+                                                  ti3d_eigen.knownOptions
+                                                  + ["solver", "sigma", "nev", "dirac",
+                                                     "maxgap"])
+    if (options is None or len(positional) != 3
+            or options.get("format", "text") not in ["text", "npy"]
+            or options.get("solver", "dense") not in ["dense", "banded", "sparse"]
+            or not ti3d_eigen.validEigenOptions(options)
+            or ("maxgap" in options and "dirac" not in options)
+            or (options.get("solver") == "sparse"
+                and ("jobs" in options or "bands" in options
+                     or "window" in options or "dirac" in options))):
+        print(usage)
         sys.exit(2)
-    numLayers = int(sys.argv[1])
+    numLayers = int(positional[0])
     if numLayers <= 0:
-        print("Usage: python mnk12.py numLayers kpointsFileName outFileName")
+        print(usage)
         print("numLayers must be at least 1")
         sys.exit(2)
+    # ARPACK finds fewer eigenpairs than one less than the matrix size
+    nev = int(options.get("nev", 8))
+    if options.get("solver") == "sparse" and not 0 < nev < 4*numLayers - 1:
+        print(usage)
+        print("--nev must be between 1 and 4*numLayers - 2")
+        sys.exit(2)
 
-    return numLayers, sys.argv[2], sys.argv[3]
+    return numLayers, positional[1], positional[2], options
 
-# Return a Hamiltonian function (k -> H_k) of the type specified
-def HamiltonianFn(calcType, numLayers):
-    fns = {"mnk12": Hamiltonian_mnk12}
+# Return (fn, args) such that fn(*args) is the Hamiltonian function
+# (k -> H_k) of the type specified. fn and args can be passed to worker
+# processes. If solver is "banded", the Hamiltonian is given in banded
+# storage (see HamiltonianBanded_mnk12); if solver is "sparse", it is a
+# scipy.sparse matrix (see HamiltonianSparse_mnk12).
+def HamiltonianSpec(calcType, numLayers, solver="dense"):
+    fns = {"mnk12": {"dense": Hamiltonian_mnk12, "banded": HamiltonianBanded_mnk12,
+                     "sparse": HamiltonianSparse_mnk12}}
     if calcType not in fns:
         print("error: calcType should be mnk12")
         sys.exit(2)
-    with open(calcType + ".json", 'r') as propsFile:
-        props = json.load(propsFile)
-        return fns[calcType](props, numLayers)
+    return fns[calcType][solver], (ti3d_eigen.loadParams(calcType), numLayers)
 
-# Generate mnk12 Hamiltonian function with properties given by p and the
-# given number of layers.
-def Hamiltonian_mnk12(p, numLayers):
-    d = lambda k: p["M"] - 2.0*p["B"] + 2.0*p["B"] * (math.cos(k[0])
-            + math.cos(k[1]) - 2.0)
-    def H(k):
+# Return a Hamiltonian function (k -> H_k) of the type specified
+def HamiltonianFn(calcType, numLayers):
+    fn, args = HamiltonianSpec(calcType, numLayers)
+    return ti3d_eigen.cachedModel(fn, *args)
+
+# Generate a function giving the 4x4 blocks of the mnk12 Hamiltonian with
+# properties given by p. The function accepts a single k-point or an (n, 3)
+# array of k-points and returns (diagonal, cross): diagonal has shape
+# (n, 4, 4) and is the block on the diagonal of the 4Nx4N Hamiltonian;
+# cross has shape (4, 4) and is the block to the right of the diagonal
+# block (coupling each layer to the next). single is True if a single
+# k-point was given.
+def Blocks_mnk12(p):
+    d = lambda k: p["M"] - 2.0*p["B"] + 2.0*p["B"] * (np.cos(k[0])
+            + np.cos(k[1]) - 2.0)
+    # 4x4 block appearing to the right of diagonal part (cross term)
+    cross = p["B"]*Gamma5 - (1j*p["A"]/2.0)*Gamma4
+    C_Ident = p["C"]*ti3d_eigen.Ident
+    A_Gamma1, A_Gamma2 = p["A"]*Gamma1, p["A"]*Gamma2
+    def blocks(in_k):
+        k, single = ti3d_eigen.kColumns(in_k)
         # Convert k from 2pi/(lattice vector) units to 1/(lattice vector).
         # Lattice vector factor eliminated in sin(kx * a), etc.
         k = 2.0 * math.pi * k
 
         # 4x4 block along diagonal of 4Nx4N Hamiltonian (N=numer of layers)
-        diagonal = np.diag([p["C"]]*4) + d(k)*Gamma5 + p["A"]*(Gamma2*math.sin(k[0]) + Gamma1*math.sin(k[1]))
-        # 4x4 block appearing to the right of diagonal part (cross term)
-        cross = p["B"]*Gamma5 - (1j*p["A"]/2.0)*Gamma4
+        diagonal = (C_Ident + scaleMatrix(d(k), Gamma5)
+                    + scaleMatrix(np.sin(k[0]), A_Gamma2)
+                    + scaleMatrix(np.sin(k[1]), A_Gamma1))
+        return diagonal, cross, single
+
+    return blocks
+
+# Generate mnk12 Hamiltonian function with properties given by p and the
+# given number of layers. The returned function accepts either a single
+# k-point, giving a 4Nx4N matrix, or an (n, 3) array of k-points, giving an
+# (n, 4N, 4N) stack.
+def Hamiltonian_mnk12(p, numLayers):
+    blocks = Blocks_mnk12(p)
+    def H(in_k):
+        diagonal, cross, single = blocks(in_k)
         cross_conj = cross.T.conj()
         # 4Nx4N Hamiltonian
-        Hk = np.zeros([4*numLayers, 4*numLayers], dtype=np.complex128)
+        Hk = np.zeros([len(diagonal), 4*numLayers, 4*numLayers], dtype=np.complex128)
         for i in range(0, 4*numLayers, 4): # i = 0, 4, 8, ..., 4*numLayers - 4
-            Hk[i:i+4, i:i+4] = diagonal
+            Hk[:, i:i+4, i:i+4] = diagonal
             if i < 4*numLayers - 4: # exclude bottom-left cross
-                Hk[i:i+4, i+4:i+8] = cross
+                Hk[:, i:i+4, i+4:i+8] = cross
             if i > 0:   # exclude top-right cross-conj
-                Hk[i:i+4, i-4:i] = cross_conj
+                Hk[:, i:i+4, i-4:i] = cross_conj
+        if single:
+            return Hk[0]
         return Hk
 
     return H
 
+# Number of superdiagonals of the mnk12 slab Hamiltonian: the cross block
+# reaches 7 places to the right of the diagonal.
+BANDWIDTH_mnk12 = 7
+
+# Generate the mnk12 slab Hamiltonian in LAPACK upper banded storage, as
+# used by scipy.linalg.eig_banded: element H[i, j] (i <= j) of the 4Nx4N
+# Hamiltonian is stored at Hb[u + i - j, j] with u = BANDWIDTH_mnk12. The
+# dense matrix is never built, so each k-point takes O(N) memory.
+# The returned function accepts either a single k-point, giving an
+# (u+1, 4N) array, or an (n, 3) array of k-points, giving (n, u+1, 4N).
+def HamiltonianBanded_mnk12(p, numLayers):
+    blocks = Blocks_mnk12(p)
+    u = BANDWIDTH_mnk12
+    def H(in_k):
+        diagonal, cross, single = blocks(in_k)
+        Hb = np.zeros([len(diagonal), u+1, 4*numLayers], dtype=np.complex128)
+        for r in range(4):
+            for s in range(r, 4):
+                # diagonal blocks: H[4L+r, 4L+s]
+                Hb[:, u+r-s, s::4] = diagonal[:, r, s][:, np.newaxis]
+        for r in range(4):
+            for s in range(4):
+                # cross blocks: H[4L+r, 4L+4+s], for L = 0, ..., N-2
+                Hb[:, u+r-s-4, 4+s::4] = cross[r, s]
+        if single:
+            return Hb[0]
+        return Hb
+
+    return H
+
+# Generate the mnk12 slab Hamiltonian as a scipy.sparse matrix (CSC
+# format). The returned function accepts a single k-point.
+def HamiltonianSparse_mnk12(p, numLayers):
+    blocks = Blocks_mnk12(p)
+    def H(k):
+        diagonal, cross, single = blocks(k)
+        Hk = (sparse.kron(sparse.eye(numLayers), diagonal[0])
+              + sparse.kron(sparse.eye(numLayers, k=1), cross)
+              + sparse.kron(sparse.eye(numLayers, k=-1), cross.T.conj()))
+        return sparse.csc_matrix(Hk, dtype=np.complex128)
+
+    return H
+
+# Finds the nev eigenpairs of the sparse mnk12 slab Hamiltonian with
+# eigenvalues closest to the energy sigma, using shift-invert Lanczos
+# (ARPACK through eigsh). Only O(N) memory is used, so very thick slabs can
+# be treated as long as only the states near sigma (e.g. the surface states
+# near E_F) are needed.
+#
+# Shift-invert needs solutions of (H(k) - sigma) x = b, which come from a
+# sparse LU factorization. The sparsity pattern does not depend on k and
+# the natural (layer) ordering is already fill-free for the block
+# tridiagonal H, so no fill-reducing ordering is computed at any k. The
+# factorization is reused as long as k does not change (line-mode KPOINTS
+# repeat the endpoints of each segment), and the eigenkets from the
+# previous k-point are used to start the Lanczos iteration at the next one.
+class ShiftInvertSolver(object):
+    def __init__(self, p, numLayers, sigma, nev):
+        self.H = HamiltonianSparse_mnk12(p, numLayers)
+        self.dim = 4*numLayers
+        self.sigma = sigma
+        self.nev = nev
+        # more Lanczos vectors than the ARPACK default: the Kramers pairs
+        # and the closely spaced slab states otherwise need many restarts
+        self.ncv = min(self.dim, max(4*nev, 20))
+        self.lu, self.luK = None, None
+        self.v0 = None
+        self.numFactorizations = 0
+
+    # Return the shift-invert operator (H(k) - sigma)^(-1), given
+    # Hk = H(k).
+    def inverse(self, Hk, k):
+        if self.lu is None or not np.array_equal(k, self.luK):
+            A = sparse.csc_matrix(Hk - self.sigma*sparse.eye(self.dim))
+            self.lu = sparse_linalg.splu(A, permc_spec="NATURAL")
+            self.luK = np.array(k, dtype=np.float64)
+            self.numFactorizations += 1
+        return sparse_linalg.LinearOperator(Hk.shape, matvec=self.lu.solve,
+                                            dtype=np.complex128)
+
+    # Return (eigenvals, eigenkets) for the nev eigenvalues closest to
+    # sigma at the k-point k, sorted by energy. eigenkets (the columns of
+    # a (4N, nev) array) is None if eigvalsOnly is True.
+    def solve(self, k, eigvalsOnly=False):
+        Hk = self.H(k)
+        vals, kets = sparse_linalg.eigsh(Hk, k=self.nev, sigma=self.sigma,
+                                         OPinv=self.inverse(Hk, k),
+                                         ncv=self.ncv, v0=self.v0)
+        order = np.argsort(vals)
+        vals, kets = vals[order], kets[:, order]
+        self.v0 = kets.sum(axis=1)
+        if eigvalsOnly:
+            return vals, None
+        return vals, kets
+
+# Diagonalize over kpoints with the ShiftInvertSolver solver, one k-point
+# at a time. Yields chunks in the same format as
+# ti3d_eigen.diagonalizeChunks.
+def diagonalizeSparse(solver, kpoints, eigvalsOnly=False):
+    kpoints = np.asarray(kpoints, dtype=np.float64)
+    for i in range(len(kpoints)):
+        eigenvals, eigenkets = solver.solve(kpoints[i], eigvalsOnly)
+        if eigenkets is not None:
+            eigenkets = eigenkets[np.newaxis]
+        yield kpoints[i:i+1], eigenvals[np.newaxis], eigenkets
+
 # Write the per-layer contribution of the given eigenket
 def layerContribution(ket):
     layers = []
@@ -66,81 +252,264 @@ def layerContribution(ket):
         layers.append(mag)
     return layers
 
-# Write the output for one kpoint
+# Return the per-layer contributions of all the eigenkets in eigenkets,
+# which has shape (..., 4N, numKets) with the eigenkets in its columns.
+# The result has shape (..., numKets, N).
+def layerWeights(eigenkets):
+    mag = abs(eigenkets)**2
+    shape = mag.shape[:-2] + (mag.shape[-2] // 4, 4, mag.shape[-1])
+    return np.swapaxes(mag.reshape(shape).sum(axis=-2), -1, -2)
+
+# Write the output for one kpoint. eigenkets may be None if only the
+# eigenvalues were computed. NaN padding added by solveStack is dropped.
 def writeOutput(k, eigenvals, eigenkets, outFile):
     #TODO - is there a better format?
+    eigenvals = eigenvals[~np.isnan(eigenvals)]
     outFile.write("k:\n" + str(k) + "\n")
     outFile.write("eigenvals:\n" + str(eigenvals) + "\n")
+    if eigenkets is None:
+        return
+    eigenkets = eigenkets[:, :len(eigenvals)]
     outFile.write("eigenkets:\n" + str(eigenkets) + "\n")
     outFile.write("layer contributions:\n")
-    for ket in eigenkets:
+    # eigenkets are the columns of eigenkets
+    for ket in eigenkets.T:
         layers = layerContribution(ket)
         outFile.write(str(layers) + "\n")
 
+# Ratio of the golden section.
+GOLDEN = (math.sqrt(5.0) - 1.0) / 2.0
+
+# Return a function giving, for an (n, 3) array of k-points, the energies of
+# bands lower and lower+1 of the Hamiltonian H as an array with shape (n, 2).
+# H is in banded storage if banded is True.
+def bandPair(H, lower, banded=False):
+    mode = {"eigvalsOnly": True, "bands": (lower, lower + 2), "banded": banded}
+    return lambda ks: ti3d_eigen.solveStack(H(ks), **mode)[0]
+
+# Minimize the function f of one variable on [a, b] by golden-section
+# search, until the minimum is bracketed to within tol. f is assumed to
+# have a single minimum in [a, b]. Return (t, f(t)) for the best point found.
+def goldenSection(f, a, b, tol):
+    c, d = b - GOLDEN*(b - a), a + GOLDEN*(b - a)
+    fc, fd = f(c), f(d)
+    while b - a > tol:
+        if fc < fd:
+            b, d, fd = d, c, fc
+            c = b - GOLDEN*(b - a)
+            fc = f(c)
+        else:
+            a, c, fc = c, d, fd
+            d = a + GOLDEN*(b - a)
+            fd = f(d)
+    if fc < fd:
+        return c, fc
+    return d, fd
+
+# Return the mean slope |dE/dk| of the bands given by energies (see bandPair)
+# on either side of k along the unit vector u, in units of energy x lattice
+# constant (hbar = 1). The slope is taken between distances dk and 2dk from
+# k, with dk doubled from dk0 until two successive slopes agree to within
+# the relative tolerance rtol, so that it is measured beyond the curvature
+# a small gap gives the bands at k; if they still don't agree at maxDk, the
+# last slope is returned.
+def fermiVelocity(energies, k, u, dk0, rtol=0.01, maxDk=0.05):
+    dk = dk0
+    E = energies(k + np.array([dk, -dk])[:, np.newaxis]*u)
+    slope = None
+    while True:
+        outer = energies(k + np.array([2.0*dk, -2.0*dk])[:, np.newaxis]*u)
+        slopes = np.abs(outer - E) / dk
+        last, slope = slope, np.mean(slopes) / (2.0 * math.pi)
+        if last is not None and abs(slope - last) <= rtol*slope:
+            return slope
+        if 2.0*dk > maxDk:
+            return slope
+        dk, E = 2.0*dk, outer
+
+# Find the minima of the gap between the two bands given by pair (see
+# bandPair) along the k-path segments kBounds ([start, stop] pairs, in
+# 2pi/a units). Each segment is sampled at numSamples points, and each
+# strict local minimum of the sampled gap (lower than both neighbouring
+# samples, or than its one neighbour at the end of a segment; or two equal
+# samples lower than theirs, with the refined gap below both) is refined by
+# golden-section search to within tol (in 2pi/a units); only near the
+# minima is the path sampled finely. A refined point is kept only if its
+# gap is below those of the neighbouring samples (and, if maxGap is given,
+# at most maxGap), so flat stretches of the gap (e.g. along k_z, which the
+# slab ignores) give no minima. For each minimum, return (k, gap,
+# velocity): velocity is the Fermi velocity along the in-plane direction of
+# the path (see fermiVelocity), starting from a step of 10 tol, well beyond
+# the uncertainty in k. Also return the number of k-points diagonalized.
+def findDiracPoints(pair, kBounds, tol, numSamples=16, maxGap=None):
+    numEvals = [0]
+    def energies(ks):
+        numEvals[0] += len(ks)
+        return pair(ks)
+
+    minima = []
+    for start, stop in kBounds:
+        start, stop = np.array(start, dtype=np.float64), np.array(stop, dtype=np.float64)
+        length = np.linalg.norm(stop - start)
+        # the slab Hamiltonian does not depend on k_z
+        inPlane = np.array([stop[0] - start[0], stop[1] - start[1], 0.0])
+        inPlaneLength = np.linalg.norm(inPlane)
+        if inPlaneLength == 0.0:
+            continue
+        kAt = lambda t: start + t*(stop - start)
+        gapAt = lambda t: np.diff(energies(kAt(t)[np.newaxis, :])[0])[0]
+        ts = np.linspace(0.0, 1.0, numSamples)
+        gaps = np.diff(energies(kAt(ts[:, np.newaxis])), axis=1)[:, 0]
+        i = 0
+        while i < numSamples:
+            # samples first to last have the same gap
+            first = last = i
+            while last + 1 < numSamples and gaps[last + 1] == gaps[first]:
+                last += 1
+            i = last + 1
+            # two equal samples may straddle a minimum (e.g. half-way along
+            # a symmetric segment); more than two are a flat stretch
+            outer = [gaps[n] for n in [first - 1, last + 1] if 0 <= n < numSamples]
+            if last - first > 1 or not outer or not gaps[first] < min(outer):
+                continue
+            a, b = ts[max(first - 1, 0)], ts[min(last + 1, numSamples - 1)]
+            t, gap = goldenSection(gapAt, a, b, tol / length)
+            if not gap < min(outer):
+                continue
+            if maxGap is not None and gap > maxGap:
+                continue
+            if last > first and not gap < gaps[first]:
+                continue
+            k = kAt(t)
+            velocity = fermiVelocity(energies, k, inPlane / inPlaneLength, 10.0*tol)
+            minima.append((k, gap, velocity))
+    return minima, numEvals[0]
+
 # Decompose eigenvalList (with format [[k, eigenvals]]) into bands and make
 # band plot.
 def plotEigenvals(eigenvalList):
     if len(eigenvalList) == 0 or len(eigenvalList[0]) != 2:
         print("error: invalid input to plotEigenvals")
         return
-    DiracCheckLinear = False # set to True to output slope near Dirac point
-    DiracAtZero = []
     kpoints = []
     bands = []
-    for i in range(len(eigenvalList[0][1])):
+    # with an energy window the number of eigenvalues varies with k: pad
+    # the missing ones with NaN, which are left out of the plot
+    numBands = max(len(eigenvals) for k, eigenvals in eigenvalList)
+    for i in range(numBands):
         bands.append([])
     for k, eigenvals in eigenvalList:
         kpoints.append(k)
+        for i in range(numBands, len(eigenvals), -1):
+            bands[i-1].append(float("nan"))
         for i in range(len(eigenvals)):
             bands[i].append(eigenvals[i])
-            if DiracCheckLinear:
-                doDiracCheckLinear(i, k, eigenvals, DiracAtZero)
     for i in range(len(bands)):
         plt.plot(kpoints, bands[i])
     plt.show()
 
-# Print diagnostic info about linearity around Dirac point.
-# TODO - Dirac point may not be at k = 0 - need to find it.
-def doDiracCheckLinear(i, k, eigenvals, DiracAtZero):
-    numLayers = len(eigenvals) / 4.0
-    if i == 2.0*numLayers - 1:
-        if k == 0.0:
-            DiracAtZero.append(eigenvals[i])
-        else:
-            print("k: " + str(k))
-            print(str((eigenvals[i] - DiracAtZero[0]) / k))
-    elif i == 2.0*numLayers + 1:
-        if k == 0.0:
-            DiracAtZero.append(eigenvals[i])
-        else:
-            print("k: " + str(k))
-            print(str((eigenvals[i] - DiracAtZero[1]) / k))
+# Find the Dirac points (minima of the gap between bands 2N-1 and 2N) of the
+# slab Hamiltonian H with numLayers layers along the path in the kpoints
+# file to within tol, and write k, gap and Fermi velocity of each to
+# outFileName. Minima with a gap above maxGap (if given) are left out.
+def writeDiracPoints(H, numLayers, banded, kpointsFileName, tol, outFileName,
+                     maxGap=None):
+    if ti3d_eigen.getKpointGrid(kpointsFileName, "mnk12") is not None:
+        print("error: --dirac needs a k-point path, not a grid")
+        sys.exit(2)
+    kNum, kBounds = ti3d_eigen.getKpointRanges(kpointsFileName)
+    pair = bandPair(H, 2*numLayers - 1, banded)
+    minima, numEvals = findDiracPoints(pair, kBounds, tol, maxGap=maxGap)
+    with open(outFileName, 'w') as outFile:
+        for k, gap, velocity in minima:
+            line = "k: " + str(k) + " gap: " + str(gap) + " v_F: " + str(velocity)
+            outFile.write(line + "\n")
+            print(line)
+    print("k-points diagonalized: " + str(numEvals))
 
 def main():
     # get command line arguments
-    numLayers, kpointsFileName, outFileName = parseArgs()
-    # read input file
-    kpoints = ti3d_eigen.getKpoints(kpointsFileName)
+    numLayers, kpointsFileName, outFileName, options = parseArgs()
+    jobs = int(options.get("jobs", 1))
+    mode = ti3d_eigen.eigenMode(options)
+    solver = options.get("solver", "dense")
+    mode["banded"] = (solver == "banded")
+    # read input file: a uniform grid is reduced by the model's symmetry
+    grid = ti3d_eigen.getKpointGrid(kpointsFileName, "mnk12")
+    if grid is not None:
+        kpoints = grid.kpoints
+    else:
+        kpoints = ti3d_eigen.getKpoints(kpointsFileName)
     # get appropriate Hamiltonian
-    H = HamiltonianFn("mnk12", numLayers)
+    fn, args = HamiltonianSpec("mnk12", numLayers, solver)
+    if "dirac" in options:
+        maxGap = None
+        if "maxgap" in options:
+            maxGap = float(options["maxgap"])
+        writeDiracPoints(fn(*args), numLayers, mode["banded"], kpointsFileName,
+                         float(options["dirac"]), outFileName, maxGap)
+        return
+    if solver == "sparse":
+        props = args[0]
+        sigma = float(options.get("sigma", props["E_F"]))
+        nev = int(options.get("nev", 8))
+        chunks = diagonalizeSparse(ShiftInvertSolver(props, numLayers, sigma, nev),
+                                   kpoints, mode["eigvalsOnly"])
+    elif jobs > 1:
+        chunks = ti3d_eigen.diagonalizeParallel(fn, args, kpoints, jobs, mode=mode)
+    else:
+        chunks = ti3d_eigen.diagonalizeChunks(fn(*args), kpoints, mode=mode)
+
+    store, outFile = None, None
+    if options.get("format", "text") == "npy":
+        # an energy window may hold any number of bands, up to all of them
+        numBands = None
+        if "window" in mode:
+            numBands = 4*numLayers
+        store = ti3d_eigen.ResultStore(outFileName, len(kpoints),
+                                       ti3d_eigen.ketRange(options),
+                                       numBands)
+        if grid is not None:
+            store.writeGrid(grid)
+    else:
+        outFile = open(outFileName, 'w')
+
+    tracker, bandOrder = None, []
+    if options.get("connect", "sorted") == "overlap":
+        tracker = ti3d_eigen.BandTracker()
 
     seenZero = False # TODO - fix this hack - keeping only k_x for plot
     eigenvalList = []
-    with open(outFileName, 'w') as outFile:
-        # iterate over kpoints (parallelize later if necessary)
-        for k in kpoints:
-            # get Hamiltonian for this k-point
-            Hk = H(k)
-            # diagonalize Hamiltonian
-            eigenvals, eigenkets = linalg.eigh(Hk)
-            # handle output
-            writeOutput(k, eigenvals, eigenkets, outFile)
+    # build and diagonalize the Hamiltonians a chunk of kpoints at a time
+    for ks, eigenvalsChunk, eigenketsChunk in chunks:
+        # handle output
+        if store is not None:
+            layers = None
+            if eigenketsChunk is not None:
+                layers = layerWeights(eigenketsChunk)
+            store.write(ks, eigenvalsChunk, eigenketsChunk, layers)
+        if eigenketsChunk is None:
+            eigenketsChunk = [None]*len(ks)
+        for k, eigenvals, eigenkets in zip(ks, eigenvalsChunk, eigenketsChunk):
+            if outFile is not None:
+                writeOutput(k, eigenvals, eigenkets, outFile)
+            if tracker is not None:
+                order = tracker.step(eigenvals, eigenkets)
+                bandOrder.append(order)
+                eigenvals = eigenvals[order]
             if k[1] == 0.0 and (k[0] != 0.0 or not seenZero): # TODO - fix this hack - keeping only k_x for plot
                 if k[0] == 0.0:
                     seenZero = True
                 eigenvalList.append([k[0], eigenvals])
+    if store is not None:
+        if tracker is not None:
+            store.writeBandOrder(bandOrder)
+        store.close()
+    else:
+        outFile.close()
     # plotting
-    plotEigenvals(eigenvalList)
+    if grid is None:
+        plotEigenvals(eigenvalList)
 
 if __name__ == "__main__":
     main()
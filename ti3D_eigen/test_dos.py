@@ -0,0 +1,56 @@
+import unittest
+import numpy as np
+import ti3d_eigen
+import mnk12
+import dos
+
+class TestGaussianDOS(unittest.TestCase):
+    # A single eigenvalue should give the Gaussian itself, however the
+    # eigenvalues are split into chunks.
+    def test_single_level(self):
+        energies = np.linspace(-1.0, 1.0, 401)
+        sigma = 0.05
+        accumulator = dos.GaussianDOS(energies, sigma)
+        accumulator.add(np.array([[0.123, np.nan]]), np.array([0.5]))
+        accumulator.add(np.array([[0.123]]), np.array([0.5]))
+        result, pdos = accumulator.result()
+        expected = (np.exp(-0.5*((energies - 0.123)/sigma)**2)
+                    / (sigma*np.sqrt(2.0*np.pi)))
+        self.assertTrue(np.allclose(result, expected, atol=1e-2*expected.max()))
+        self.assertEqual(pdos.shape, (401, 0))
+
+class TestTetrahedronDOS(unittest.TestCase):
+    # Over the whole band range the density of states should integrate to
+    # the number of bands and agree with the Gaussian method once both are
+    # broadened.
+    def test_mnk12_bulk(self):
+        energies = np.linspace(-2.0, 8.0, 1001)
+        step = energies[1] - energies[0]
+        lattice, group, periodic = ti3d_eigen.modelSymmetry["mnk12"]
+        grid = ti3d_eigen.KGrid(lattice, (12, 12, 12), ops=ti3d_eigen.pointGroup(group),
+                                periodic=periodic)
+        H = ti3d_eigen.HamiltonianFn("mnk12")
+        tetra, pdos = dos.tetrahedronDOS(dos.solver(H), grid, energies)
+        self.assertAlmostEqual(tetra.sum()*step, 4.0, places=3)
+        accumulator = dos.GaussianDOS(energies, 0.2)
+        accumulator.add(H.eigenvalues(grid.kpoints), grid.weights)
+        gaussian, pdos = accumulator.result()
+        x = step*np.arange(-120, 121)
+        kernel = np.exp(-0.5*(x/0.2)**2)
+        smoothed = np.convolve(tetra, kernel / kernel.sum(), mode="same")
+        self.assertTrue(np.allclose(smoothed[200:800], gaussian[200:800],
+                                    atol=0.03*gaussian.max()))
+
+    # The layer-resolved density of states of a slab should add up to the
+    # total.
+    def test_slab_layers(self):
+        energies = np.linspace(-2.0, 8.0, 401)
+        grid = ti3d_eigen.KGrid("cubic", (8, 8, 1))
+        H = mnk12.HamiltonianFn("mnk12", 3)
+        total, layers = dos.tetrahedronDOS(dos.solver(H, mnk12.layerWeights),
+                                           grid, energies)
+        self.assertEqual(layers.shape, (401, 3))
+        self.assertTrue(np.allclose(layers.sum(axis=1), total))
+
+if __name__ == "__main__":
+    unittest.main()
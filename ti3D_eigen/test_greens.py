@@ -0,0 +1,28 @@
+import unittest
+import json
+import numpy as np
+import greens
+import mnk12
+
+class TestDecimation(unittest.TestCase):
+    # With broadening eta, a slab much thicker than 1/eta layers should have
+    # the same Green's functions at its surfaces and in its middle as the
+    # semi-infinite stack.
+    def test_matches_thick_slab(self):
+        with open("mnk12.json", 'r') as propsFile:
+            p = json.load(propsFile)
+        k = np.array([0.02, 0.01, 0.0])
+        energies = np.array([2.9, 3.05, 3.3])
+        eta, numLayers = 0.05, 400
+        diagonal, cross, single = mnk12.Blocks_mnk12(p)(k)
+        G_top, G_bottom, G_bulk = greens.decimate(diagonal, cross, energies, eta)
+        H = mnk12.Hamiltonian_mnk12(p, numLayers)(k)
+        mid = 4*(numLayers // 2)
+        for i, E in enumerate(energies):
+            G = np.linalg.inv((E + 1j*eta)*np.eye(4*numLayers) - H)
+            self.assertTrue(np.allclose(G[:4, :4], G_top[i]))
+            self.assertTrue(np.allclose(G[-4:, -4:], G_bottom[i]))
+            self.assertTrue(np.allclose(G[mid:mid+4, mid:mid+4], G_bulk[i]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,7 @@
 import unittest
 import numpy as np
 import mnk12
+import ti3d_eigen
 
 class TestBlockTridiagonal(unittest.TestCase):
     # H(k) may include top-left and bottom-right 4x4 blocks if periodic but
@@ -31,5 +32,121 @@ class TestBlockTridiagonal(unittest.TestCase):
             for s in range(4):
                 self.assertEqual(H[i+r, j+s], 0)
 
+class TestBanded(unittest.TestCase):
+    # The banded storage should hold the upper band of the dense H(k), and
+    # the banded solver should give the same eigenvalues as the dense one.
+    def test_banded_matches_dense(self):
+        k = np.array([0.05, 0.1, 0.03])
+        u = mnk12.BANDWIDTH_mnk12
+        for numLayers in range(1, 5):
+            H = mnk12.HamiltonianFn("mnk12", numLayers)(k)
+            fn, args = mnk12.HamiltonianSpec("mnk12", numLayers, "banded")
+            Hb = fn(*args)(k)
+            for j in range(len(H)):
+                for i in range(max(0, j-u), j+1):
+                    self.assertEqual(Hb[u+i-j, j], H[i, j])
+            dense, kets = ti3d_eigen.solveStack(np.array([H]), eigvalsOnly=True)
+            banded, kets = ti3d_eigen.solveStack(np.array([Hb]), eigvalsOnly=True,
+                                                 banded=True)
+            self.assertTrue(np.allclose(dense, banded))
+
+class TestShiftInvert(unittest.TestCase):
+    # The sparse shift-invert solver should find the eigenvalues closest to
+    # sigma, in increasing order.
+    def test_closest_eigenvalues(self):
+        numLayers, sigma, nev = 20, 3.1, 6
+        fn, args = mnk12.HamiltonianSpec("mnk12", numLayers)
+        solver = mnk12.ShiftInvertSolver(args[0], numLayers, sigma, nev)
+        for k in [np.array([0.0, 0.0, 0.0]), np.array([0.05, 0.1, 0.0])]:
+            vals, kets = solver.solve(k)
+            allVals = np.linalg.eigvalsh(fn(*args)(k))
+            closest = allVals[np.argsort(abs(allVals - sigma))[:nev]]
+            self.assertTrue(np.allclose(vals, np.sort(closest)))
+            self.assertEqual(kets.shape, (4*numLayers, nev))
+
+class TestLayerWeights(unittest.TestCase):
+    # layerWeights should agree with layerContribution applied to each
+    # eigenket (column) and each eigenket should have total weight 1.
+    def test_layer_weights(self):
+        k = np.array([0.05, 0.1, 0.03])
+        H = mnk12.HamiltonianFn("mnk12", 4)(k)
+        eigenvals, eigenkets = np.linalg.eigh(H)
+        weights = mnk12.layerWeights(eigenkets)
+        self.assertEqual(weights.shape, (16, 4))
+        for n in range(16):
+            expected = mnk12.layerContribution(eigenkets[:, n])
+            self.assertTrue(np.allclose(weights[n], expected))
+        self.assertTrue(np.allclose(weights.sum(axis=-1), 1.0))
+
+class TestDiracPoints(unittest.TestCase):
+    # The surface Dirac point of a thick slab is at Gamma, with a vanishing
+    # gap and a Fermi velocity close to A; it should be found in the middle
+    # of a path as well as at its end, with few diagonalizations.
+    def test_dirac_at_gamma(self):
+        numLayers = 20
+        H = mnk12.HamiltonianFn("mnk12", numLayers)
+        pair = mnk12.bandPair(H, 2*numLayers - 1)
+        kBounds = [[[0.0, 0.0, 0.0], [0.2, 0.0, 0.0]],
+                   [[-0.15, 0.0, 0.0], [0.25, 0.0, 0.0]]]
+        minima, numEvals = mnk12.findDiracPoints(pair, kBounds, 1e-6)
+        self.assertEqual(len(minima), 2)
+        for k, gap, velocity in minima:
+            self.assertTrue(np.linalg.norm(k) < 1e-6)
+            self.assertTrue(gap < 1e-4)
+            self.assertAlmostEqual(velocity, 0.5, places=1)
+        self.assertTrue(numEvals < 100)
+
+    # A stretch of constant gap is not a minimum: neither a segment along
+    # k_z (which the slab ignores) nor a flat stretch in the plane, however
+    # it compares with its surroundings.
+    def test_constant_gap(self):
+        numLayers = 20
+        pair = mnk12.bandPair(mnk12.HamiltonianFn("mnk12", numLayers),
+                              2*numLayers - 1)
+        minima, numEvals = mnk12.findDiracPoints(
+            pair, [[[0.5, 0.5, 0.5], [0.5, 0.5, 0.0]]], 1e-6)
+        self.assertEqual(minima, [])
+        # gap 3 on kx < 0.5, rising to a minimum 0.01 at kx = 0.8
+        def plateau(ks):
+            gap = np.where(ks[:, 0] < 0.5, 3.0, 0.01 + 10.0*(ks[:, 0] - 0.8)**2)
+            return np.stack([-gap/2, gap/2], axis=-1)
+        minima, numEvals = mnk12.findDiracPoints(
+            plateau, [[[0.0, 0.0, 0.0], [1.0, 0.0, 0.0]]], 1e-6)
+        self.assertEqual(len(minima), 1)
+        self.assertAlmostEqual(minima[0][0][0], 0.8, places=5)
+        self.assertAlmostEqual(minima[0][1], 0.01, places=8)
+
+    # The Fermi velocity is the in-plane slope, even on a path that also
+    # moves along k_z.
+    def test_velocity_in_plane(self):
+        numLayers = 20
+        pair = mnk12.bandPair(mnk12.HamiltonianFn("mnk12", numLayers),
+                              2*numLayers - 1)
+        minima, numEvals = mnk12.findDiracPoints(
+            pair, [[[-0.1, 0.0, -0.3], [0.1, 0.0, 0.3]]], 1e-6)
+        self.assertEqual(len(minima), 1)
+        k, gap, velocity = minima[0]
+        self.assertTrue(np.linalg.norm(k[:2]) < 1e-6)
+        self.assertAlmostEqual(velocity, 0.5, places=1)
+
+    # The minimum of a thin slab's large hybridization gap is reported
+    # unless maxGap asks for smaller gaps only, and its Fermi velocity
+    # hardly depends on tol.
+    def test_thin_slab(self):
+        numLayers = 2
+        pair = mnk12.bandPair(mnk12.HamiltonianFn("mnk12", numLayers),
+                              2*numLayers - 1)
+        kBounds = [[[-0.1, 0.0, 0.0], [0.2, 0.0, 0.0]]]
+        velocities = []
+        for tol in [1e-6, 1e-4]:
+            minima, numEvals = mnk12.findDiracPoints(pair, kBounds, tol)
+            self.assertEqual(len(minima), 1)
+            k, gap, velocity = minima[0]
+            self.assertAlmostEqual(gap, 0.1403, places=4)
+            velocities.append(velocity)
+        self.assertAlmostEqual(velocities[0], velocities[1], places=1)
+        minima, numEvals = mnk12.findDiracPoints(pair, kBounds, 1e-6, maxGap=0.1)
+        self.assertEqual(minima, [])
+
 if __name__ == "__main__":
     unittest.main()
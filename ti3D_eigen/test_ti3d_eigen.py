@@ -0,0 +1,175 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import ti3d_eigen
+
+class TestBatchedHamiltonian(unittest.TestCase):
+    # H applied to an (N, 3) array of k-points should give the same
+    # matrices as applying H to each k-point separately.
+    def test_batch_matches_single(self):
+        ks = np.array([[0.0, 0.0, 0.0], [0.05, 0.1, 0.03],
+                       [-0.2, 0.07, 0.11], [0.3, -0.25, -0.05]])
+        for calcType in ["8band", "4band", "mnk12"]:
+            H = ti3d_eigen.HamiltonianFn(calcType)
+            H_batch = H(ks)
+            self.assertEqual(H_batch.shape[0], len(ks))
+            for i in range(len(ks)):
+                H_single = H(ks[i])
+                self.assertEqual(H_single.shape, H_batch.shape[1:])
+                self.assertTrue(np.allclose(H_single, H_batch[i]))
+                self.assertTrue(np.allclose(H_single, H_single.T.conj()))
+
+class TestModelCache(unittest.TestCase):
+    # Equal parameter sets should share one Hamiltonian function, and
+    # different ones should not.
+    def test_cached_by_params(self):
+        p = ti3d_eigen.loadParams("4band")
+        H = ti3d_eigen.cachedModel(ti3d_eigen.Hamiltonian_4band, p)
+        self.assertIs(ti3d_eigen.cachedModel(ti3d_eigen.Hamiltonian_4band, dict(p)), H)
+        self.assertIs(ti3d_eigen.HamiltonianFn("4band"), H)
+        p["M0"] += 0.1
+        H_other = ti3d_eigen.cachedModel(ti3d_eigen.Hamiltonian_4band, p)
+        self.assertIsNot(H_other, H)
+        k = [0.01, 0.02, 0.0]
+        self.assertFalse(np.allclose(H(k), H_other(k)))
+
+class TestSolveStack(unittest.TestCase):
+    # The band and energy window subsets should pick out the same
+    # eigenvalues as a full diagonalization, with the subset keywords of
+    # newer scipy and with the fallback for older scipy (where this scipy
+    # still accepts the eigvals keyword the fallback uses).
+    def test_subsets(self):
+        subsets = ti3d_eigen.EIGH_SUBSETS
+        modes = set([subsets])
+        try:
+            ti3d_eigen.linalg.eigh(np.eye(1), eigvals=(0, 0))
+            modes.add(False)
+        except TypeError:
+            pass
+        try:
+            for ti3d_eigen.EIGH_SUBSETS in sorted(modes):
+                self.checkSubsets()
+        finally:
+            ti3d_eigen.EIGH_SUBSETS = subsets
+
+    def checkSubsets(self):
+        ks = np.linspace([0.0, 0.0, 0.0], [0.2, 0.1, 0.05], 5)
+        Hs = ti3d_eigen.HamiltonianFn("mnk12")(ks)
+        full, fullKets = ti3d_eigen.solveStack(Hs.copy())
+        vals, kets = ti3d_eigen.solveStack(Hs.copy(), eigvalsOnly=True)
+        self.assertIsNone(kets)
+        self.assertTrue(np.allclose(vals, full))
+        vals, kets = ti3d_eigen.solveStack(Hs.copy(), bands=(1, 3))
+        self.assertTrue(np.allclose(vals, full[:, 1:3]))
+        self.assertEqual(kets.shape, (5, 4, 2))
+        window = (full[2, 1] - 1e-6, full[2, 3] + 1e-6)
+        vals, kets = ti3d_eigen.solveStack(Hs.copy(), window=window)
+        counts = []
+        for i in range(len(ks)):
+            inWindow = full[i][(full[i] > window[0]) & (full[i] <= window[1])]
+            found = vals[i][~np.isnan(vals[i])]
+            self.assertTrue(np.allclose(found, inWindow))
+            # eigenkets past the eigenvalues found are NaN, not zero
+            counts.append(len(found))
+            self.assertFalse(np.isnan(kets[i][:, :len(found)]).any())
+            self.assertTrue(np.isnan(kets[i][:, len(found):]).all())
+        self.assertTrue(min(counts) < max(counts))
+        vals, kets = ti3d_eigen.solveStack(Hs.copy(), eigvalsOnly=True,
+                                           window=window)
+        self.assertIsNone(kets)
+        self.assertEqual(list((~np.isnan(vals)).sum(axis=1)), counts)
+
+class TestGammaModel(unittest.TestCase):
+    # The closed-form eigenvalues should agree with diagonalizing H(k),
+    # including when selected through diagonalizeChunks.
+    def test_closed_form_eigenvalues(self):
+        ks = np.linspace([-0.2, 0.1, -0.05], [0.3, -0.15, 0.1], 11)
+        for calcType in ["4band", "mnk12"]:
+            H = ti3d_eigen.HamiltonianFn(calcType)
+            full = np.linalg.eigvalsh(H(ks))
+            self.assertTrue(np.allclose(H.eigenvalues(ks), full))
+            self.assertTrue(np.allclose(H.eigenvalues(ks[3]), full[3]))
+            mode = {"eigvalsOnly": True, "bands": (1, 3)}
+            chunks = list(ti3d_eigen.diagonalizeChunks(H, ks, 4, mode))
+            self.assertIsNone(chunks[0][2])
+            self.assertTrue(np.allclose(np.concatenate([c[1] for c in chunks]),
+                                        full[:, 1:3]))
+
+class TestKGrid(unittest.TestCase):
+    # Eigenvalues computed on the irreducible points and unfolded should
+    # equal those computed on the full grid, for both lattices.
+    def test_unfold_matches_full_grid(self):
+        for calcType, sizes in [("4band", (12, 12, 3)), ("mnk12", (8, 8, 8))]:
+            lattice, group, periodic = ti3d_eigen.modelSymmetry[calcType]
+            grid = ti3d_eigen.KGrid(lattice, sizes, ops=ti3d_eigen.pointGroup(group),
+                                    periodic=periodic)
+            self.assertTrue(len(grid.kpoints) < len(grid.fullKpoints) // 5)
+            self.assertAlmostEqual(grid.weights.sum(), 1.0)
+            H = ti3d_eigen.HamiltonianFn(calcType)
+            full = H.eigenvalues(grid.fullKpoints)
+            self.assertTrue(np.allclose(grid.unfold(H.eigenvalues(grid.kpoints)), full))
+
+class TestBandTracker(unittest.TestCase):
+    # With fixed eigenkets and eigenvalues linear in t, the bands are
+    # straight lines which cross at t = 0; the tracker should follow the
+    # lines through the crossings, including for degenerate bands.
+    def test_crossing_lines(self):
+        rng = np.random.RandomState(0)
+        U = np.linalg.qr(rng.randn(4, 4) + 1j*rng.randn(4, 4))[0]
+        ts = np.linspace(-1.0, 1.0, 41)
+        for lines in [lambda t: [t, -t, 0.5 + 0.3*t, 2.0],
+                      lambda t: [t, t, -t, -t]]:
+            tracker = ti3d_eigen.BandTracker()
+            start = np.argsort(lines(ts[0]))
+            for t in ts:
+                eigenvals, eigenkets = np.linalg.eigh(np.dot(U*lines(t), U.conj().T))
+                order = tracker.step(eigenvals, eigenkets)
+                self.assertTrue(np.allclose(eigenvals[order], np.array(lines(t))[start]))
+
+class TestParallelDiagonalize(unittest.TestCase):
+    # Diagonalizing in worker processes should give the same eigenvalues,
+    # in the same k order, as diagonalizing serially.
+    def test_parallel_matches_serial(self):
+        ks = np.linspace([0.0, 0.0, 0.0], [0.5, 0.25, 0.1], 37)
+        fn, args = ti3d_eigen.HamiltonianSpec("4band")
+        serial = list(ti3d_eigen.diagonalizeChunks(fn(*args), ks))
+        parallel = list(ti3d_eigen.diagonalizeParallel(fn, args, ks, 2))
+        self.assertTrue(np.allclose(np.concatenate([c[0] for c in parallel]), ks))
+        self.assertTrue(np.allclose(np.concatenate([c[1] for c in serial]),
+                                    np.concatenate([c[1] for c in parallel])))
+
+class TestResultStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # Chunks from an energy window may hold fewer states than the lower
+    # bound of the eigenkets to store; those eigenkets are NaN.
+    def test_window_fewer_states_than_kets(self):
+        store = ti3d_eigen.ResultStore(self.dir, 3, ketBands=(2, 4), numBands=4)
+        kets = np.arange(3*4*4, dtype=np.complex128).reshape(3, 4, 4)
+        store.write(np.zeros((1, 3)), np.zeros((1, 1)), kets[:1, :, :1])
+        store.write(np.zeros((1, 3)), np.zeros((1, 3)), kets[1:2, :, :3])
+        store.write(np.zeros((1, 3)), np.zeros((1, 4)), kets[2:])
+        store.close()
+        stored = np.load(os.path.join(self.dir, "eigenkets.npy"))
+        self.assertTrue(np.isnan(stored[0]).all())
+        self.assertTrue(np.array_equal(stored[1, :, 0], kets[1, :, 2]))
+        self.assertTrue(np.isnan(stored[1, :, 1]).all())
+        self.assertTrue(np.array_equal(stored[2], kets[2, :, 2:]))
+
+    # --kets counts bands like --bands and must lie within its range.
+    def test_kets_within_bands(self):
+        options = {"bands": "18:22", "kets": "19:21"}
+        self.assertTrue(ti3d_eigen.validEigenOptions(options))
+        self.assertEqual(ti3d_eigen.ketRange(options), (1, 3))
+        self.assertFalse(ti3d_eigen.validEigenOptions({"bands": "18:22",
+                                                       "kets": "2:6"}))
+        self.assertEqual(ti3d_eigen.ketRange({"kets": "2:6"}), (2, 6))
+
+if __name__ == "__main__":
+    unittest.main()
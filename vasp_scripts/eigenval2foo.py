@@ -21,6 +21,7 @@ import os
 import sys
 import math
 import string
+import numpy
 import symbolGreekGnuplot
 
 # ====================================================================== #
@@ -65,68 +66,101 @@ def status(str):
 #   7       22.4112
 #   8       22.4112
  
+# With cache = True, the parsed arrays of an EIGENVAL file are cached in
+# path + CACHE_SUFFIX and reused as long as the size and modification time
+# of the file are unchanged.
+CACHE_SUFFIX = '.cache.npz'
+
 class EIGENVAL:
-    def __init__(self, path = None):
+    def __init__(self, path = None, cache = False):
+        if cache:
+            self.load_cached(path)
+        else:
+            self.load_from_path(path)
+        self.set_lists()
+
+    # Load the arrays from the cache of path, parsing the file (and writing
+    # the cache) if there is no up-to-date cache.
+    def load_cached(self, path):
+        cache_path = path + CACHE_SUFFIX
+        info = os.stat(path)
+        stamp = [float(info.st_size), info.st_mtime]
+        try:
+            cached = numpy.load(cache_path)
+            try:
+                if cached['stamp'].tolist() == stamp:
+                    self.kArray = cached['kArray']
+                    self.weightArray = cached['weightArray']
+                    self.points = cached['points']
+                    self.symIndices = cached['symIndices'].tolist()
+                    return
+            finally:
+                cached.close()
+        except (IOError, OSError, KeyError, ValueError):
+            pass
         self.load_from_path(path)
-
+        try:
+            numpy.savez(cache_path, stamp=numpy.array(stamp),
+                        kArray=self.kArray, weightArray=self.weightArray,
+                        points=self.points,
+                        symIndices=numpy.array(self.symIndices, dtype=int))
+        except (IOError, OSError):
+            status("warning: couldn't write EIGENVAL cache %s\n" % cache_path)
+
+    # Parse the EIGENVAL file at path into kArray, weightArray, points and
+    # symIndices.
     def load_from_path(self, path):
-        lines = open(path).readlines()
+        text = open(path).read()
+        # 6 header lines, then the k-records: the data starts at the blank
+        # line opening the first record
+        header = text.split('\n', 6)
+        body = header.pop()
 
-        hdr1 = lines[0].split()
+        hdr1 = header[0].split()
         # Is this a 1 or 2 spin file?
         num_spins = int(hdr1[3])
-        (junk, num_k, num_bands) = map(int, lines[5].split())
-
-        def listoflists(n):
-            return map(lambda x: [], range(n))
-
-        if num_spins == 2:
-            self.points = \
-                [listoflists(num_bands),
-                 listoflists(num_bands)]
-        else:
-            self.points = [listoflists(num_bands)]
-
-        self.kpoints = []
-        self.weights = []
-        self.symIndices = [0]
-        self.minEnergy = 1e9
-        self.maxEnergy = -1e9
-        k_record_size = 2 + num_bands
-
-        count = 0       # number of k-points recorded
-        lastK = None    # last k-point seen
-        for k in range(num_k):
-            # k-record structure:
-            # 1 blank line.
-            # 1 k-point line.
-            # num_bands band lines.
-            o = 6 + k * k_record_size # o = line number for start of current k-record
-
-            aStr = lines[o + 1].split() # o+1 --> k-point line (skip blank line)
-            a = map(float, aStr)
-
-            thisK = map(float, tuple(aStr[:3]))
-            # if a k-point repeats, it is a symmetry point: don't record it,
-            # but do mark the location of it
-            if lastK is not None and vec_len(vec_sub(thisK, lastK)) < 1e-9:
-                self.symIndices.append(count-1)
-            else:
-                self.kpoints.append(map(float, tuple(a[:3])))
-                self.weights.append(a[3])
-                count += 1
-                for b in range(num_bands):
-                    p = map(float, lines[o + 2 + b].split()[1:])
-
-                    for s in range(num_spins):
-                        if p[s] > self.maxEnergy:
-                            self.maxEnergy = p[s]
-                        if p[s] < self.minEnergy:
-                            self.minEnergy = p[s]
-                        self.points[s][b].append(p[s])
-            lastK = thisK
-        if count != 0:
-            self.symIndices.append(count-1)
+        (junk, num_k, num_bands) = map(int, header[5].split())
+
+        # k-record structure:
+        # 1 blank line.
+        # 1 k-point line: kx ky kz weight.
+        # num_bands band lines: index, one energy per spin and, in newer
+        # VASP versions, occupations, so take the width from the first one.
+        band_width = len(body.split('\n', 3)[2].split())
+        record_size = 4 + num_bands * band_width
+        values = numpy.fromstring(body, dtype=numpy.float64, sep=' ')
+        if len(values) != num_k * record_size:
+            print 'Error, "%s" is truncated or malformed.' % path
+            sys.exit(2)
+        records = values.reshape(num_k, record_size)
+
+        k = records[:, :3]
+        # if a k-point repeats, it is a symmetry point: don't record it,
+        # but do mark the location of it
+        repeats = numpy.zeros(num_k, dtype=bool)
+        if num_k > 1:
+            repeats[1:] = numpy.sqrt(((k[1:] - k[:-1])**2).sum(axis=1)) < 1e-9
+        keep = ~repeats
+        count = numpy.cumsum(keep)  # k-points recorded up to each record
+        self.symIndices = [0] + (count[repeats] - 1).tolist()
+        if count[-1] != 0:
+            self.symIndices.append(int(count[-1]) - 1)
+
+        # (num_k, 3) k-points and (num_k,) weights, repeats dropped
+        if repeats.any():
+            records = records[keep]
+        self.kArray = records[:, :3]
+        self.weightArray = records[:, 3]
+        # (num_spins, num_bands, num_k) energies
+        bands = records[:, 4:].reshape(-1, num_bands, band_width)
+        self.points = bands[:, :, 1:1 + num_spins].transpose(2, 1, 0).copy()
+
+    # Set the list forms of the arrays and the energy range.
+    def set_lists(self):
+        self.kpoints = zip(*self.kArray.T.tolist())
+        self.weights = self.weightArray.tolist()
+        self.minEnergy = float(self.points.min())
+        self.maxEnergy = float(self.points.max())
 
     def getNumSpins(self):
         return len(self.points)
@@ -205,42 +239,79 @@ def permute_cset(cset, i, j):
     # Return the new cset set.
     return cset[:j] + [ad, cb] + cset[j+2:]
 
-def relax_cset(cset):
+def swap_cost_changes(a, b):
     # {Assumption: delta-x is constant.}
-
-    cost = cset_cost(cset)
-
-    M = len(cset)
-    N = len(cset[0])
+    # Given two curves a and b (numpy arrays of length N), return for each
+    # i in range(N - 1) the change in cset_cost of [a, b] caused by
+    # permute_cset at i (crossing the curves at point i). Only the second
+    # differences centred on points i - 1 and i change.
+    N = len(a)
+    i = numpy.arange(N - 1)
+    change = numpy.zeros(N - 1)
+    if N < 3:
+        return change
+    # centred on i - 1: points (i - 2, i - 1, i), for i >= 2
+    t = i[2:]
+    change[2:] += ((a[t-2] - 2*a[t-1] + b[t])**2
+                   + (b[t-2] - 2*b[t-1] + a[t])**2
+                   - (a[t-2] - 2*a[t-1] + a[t])**2
+                   - (b[t-2] - 2*b[t-1] + b[t])**2)
+    # centred on i: points (i - 1, i, i + 1), for 1 <= i <= N - 2
+    t = i[1:]
+    change[1:] += ((a[t-1] - 2*b[t] + b[t+1])**2
+                   + (b[t-1] - 2*a[t] + a[t+1])**2
+                   - (a[t-1] - 2*a[t] + a[t+1])**2
+                   - (b[t-1] - 2*b[t] + b[t+1])**2)
+    return change
+
+def relax_cset(cset, max_rounds = None, tol = 1e-10):
+    # {Assumption: delta-x is constant.}
+    # Cross neighbouring curves wherever that lowers cset_cost by more
+    # than tol, in the same order as trying each permute_cset(cset, i, j)
+    # in turn, until a round makes no change (or after max_rounds rounds).
+    # Smaller changes are rounding noise: comparing whole costs, these
+    # could even exchange two entire curves (i = 0).
+    #
+    # Crossing curves j and j + 1 at i only changes the cost near i, so
+    # the cost changes for all i are found at once by swap_cost_changes.
+    # After crossing at i the curves are exchanged from i on, which leaves
+    # the cost change of crossing at i + 2 or later the same (it is
+    # symmetric in the two curves); only the change at i + 1 needs to be
+    # found again.
+
+    C = numpy.array(cset, dtype = float)
+
+    M = len(C)
+    N = len(C[0])
 
     c = 0
     updated = 1
-    while updated:
+    while updated and (max_rounds is None or c < max_rounds):
         updated = 0
         c = c + 1
 
         status("=round %d: " % c)
+        swaps = 0
 
         for j in range(M - 1):
-            for i in range(N - 1):
-
-                new_cset = permute_cset(cset, i, j)
-                new_cost = cset_cost(new_cset)
-
-                if new_cost < cost:
-                    cset = new_cset
-                    cost = new_cost
+            change = swap_cost_changes(C[j], C[j + 1])
+            i = 0
+            while i < N - 1:
+                if change[i] < -tol:
+                    C[[j, j + 1], i:] = C[[j + 1, j], i:]
                     updated = 1
+                    swaps = swaps + 1
+                    if i + 1 < N - 1:
+                        lo = max(i - 2, 0)
+                        local = swap_cost_changes(C[j, lo:i + 3], C[j + 1, lo:i + 3])
+                        change[i + 1] = local[i + 1 - lo]
+                i = i + 1
 
-                    status("+")
-                else:
-                    status(".")
-
-        status("\n")
+        status("%d swaps\n" % swaps)
 
     status("=done.\n")
 
-    return cset
+    return C.tolist()
 
 # ====================================================================== #
 
@@ -250,10 +321,14 @@ Performs various conversions on EIGENVAL files.
 
 Available options:
     -r  Relax the curves.
+    -R "[maxRounds]" (ex.: -R "20"): Relax the curves, stopping after at
+            most maxRounds rounds.
     -1  Select only the first spin (default).
     -2  Select only the second spin.
     -0  Select all spins.
     (-0 is the same as -1 if there is only one spin in the input file).
+    -c  Cache the parsed INFILE in INFILE.cache.npz, and read the cache
+            instead of INFILE while INFILE is unchanged.
 
     -S "[symPoints]" (ex.: -S "Gamma Z F Gamma L"): Display the provided
             symmetry points on x axis.
@@ -287,14 +362,17 @@ def getArgs():
 
     # Defaults.
     relax = 0
+    max_rounds = None
     spin = 1
     symPoints = []
     yBounds = []
     outcar_path = ""
+    cache = False
     # arg parser state
     just_saw_S = False
     just_saw_Y = False
     just_saw_C = False
+    just_saw_R = False
 
     for i in range(1, len(sys.argv)):
         arg = sys.argv[i]
@@ -307,6 +385,10 @@ def getArgs():
         elif just_saw_C:
             outcar_path = arg
             just_saw_C = False
+        elif just_saw_R:
+            relax = 1
+            max_rounds = int(arg)
+            just_saw_R = False
         elif arg[0] == '-':
             for c in arg[1:]:
                 if c == "r":
@@ -317,12 +399,16 @@ def getArgs():
                     spin = 2
                 elif c == "0":
                     spin = 0
+                elif c == "c":
+                    cache = True
                 elif c == "S":
                     just_saw_S = True
                 elif c == "Y":
                     just_saw_Y = True
                 elif c == "C":
                     just_saw_C = True
+                elif c == "R":
+                    just_saw_R = True
         else:
             break
 
@@ -331,7 +417,7 @@ def getArgs():
     except:
         return [], False
 
-    return [relax, spin, symPoints, yBounds, outcar_path, in_path, format, out_name], True
+    return [relax, max_rounds, spin, symPoints, yBounds, outcar_path, cache, in_path, format, out_name], True
 
 # Get relevant data from OUTCAR file:
 # E-fermi to draw a line through Fermi energy, reciprocal lattice vectors
@@ -400,11 +486,11 @@ def main():
     if not ok:
         print usage
         sys.exit(2)
-    relax, spin, symPoints, yBounds, outcar_path, in_path, format, out_name = args
+    relax, max_rounds, spin, symPoints, yBounds, outcar_path, cache, in_path, format, out_name = args
 
     # obtain band data from EIGENVAL file
     status('Reading "%s"\n' % in_path)
-    e = EIGENVAL(in_path)
+    e = EIGENVAL(in_path, cache)
 
     # get Fermi energy and reciprocal lattice vectors from OUTCAR
     E_fermi = None
@@ -430,27 +516,27 @@ def main():
     if relax:
         if spin == 1:
             status('Relaxing Spin 1\n')
-            A = relax_cset(e.points[0])
+            A = relax_cset(e.points[0], max_rounds)
 
         elif spin == 2:
             status('Relaxing Spin 2\n')
-            A = relax_cset(e.points[1])
+            A = relax_cset(e.points[1], max_rounds)
 
         else:
             status('Relaxing Spin 1\n')
-            A = relax_cset(e.points[0])
+            A = relax_cset(e.points[0], max_rounds)
             
             status('Relaxing Spin 2\n')
-            A = A + relax_cset(e.points[1])
+            A = A + relax_cset(e.points[1], max_rounds)
     else:
         if spin == 1:
-            A = e.points[0]
+            A = e.points[0].tolist()
 
         elif spin == 2:
-            A = e.points[1]
+            A = e.points[1].tolist()
 
         else:
-            A = e.points[0] + e.points[1]
+            A = e.points[0].tolist() + e.points[1].tolist()
 
     M = len(A)
     N = len(A[0])
@@ -19,7 +19,9 @@
 #     OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #     THE SOFTWARE.
 #
-import math, json
+import sys, os, math, json
+import multiprocessing
+import numpy as np
 from numpy import array
 from numpy.linalg import norm
 from scipy.optimize import leastsq
@@ -27,24 +29,124 @@ from scipy.linalg import eigh
 from eigenval2foo import EIGENVAL
 import ti3d_eigen
 
-# Get the error corresponding to the params `p` at the specified k-point
-# with the given 4-elem list of energy eigenvalues.
-def H_err(p, kList, energyList):
-    print("intermediate: " + str(p))
-    vals = []
-    for i in range(len(kList)):
-        if norm(kList[i]) > 0.1:
-            # ignore large k values
-            continue
-        vals.append(norm(H_eigen(p, kList[i]) - energyList[i]))
-    return vals
+usage = """Usage: python fit4bands.py [options]
+Fits the 4-band model to the bands in EIGENVAL (with E_F from OUTCAR),
+starting from the parameters in 4band.json.
+Options:
+    --starts N          number of starting points: the 4band.json estimate
+                        and N-1 Latin hypercube samples around it (default 1)
+    --spread S          relative spread of the samples around the estimate
+                        (default 0.5)
+    --seed S            random seed of the samples (default 0)
+    --jobs J            number of worker processes (default 1)
+    --checkpoint FILE   file to which each completed fit is appended when
+                        N > 1; an interrupted run with the same options is
+                        resumed from it (default fit4bands.checkpoint)"""
+
+# Parse the options given in usage.
+def parseArgs():
+    positional, options = ti3d_eigen.splitOptions(sys.argv[1:],
+        ["starts", "spread", "seed", "jobs", "checkpoint"])
+    if options is None or len(positional) != 0:
+        print(usage)
+        sys.exit(2)
+    return options
+
+# Get the k-points and target energies used in the fit from the k-points
+# kList (in 2pi/a_rhomb units) and the 4-elem lists of energy eigenvalues
+# energyList at each of them. Return (kC, energies): the k-points with
+# |k| <= 0.1, converted to Cartesian (shape (N, 3)), and their energies
+# (shape (N, 4)).
+def fitData(kList, energyList):
+    k = array(kList, dtype=np.float64).reshape(-1, 3)
+    energies = array(energyList, dtype=np.float64).reshape(-1, 4)
+    # ignore large k values
+    use = norm(k, axis=1) <= 0.1
+    return rhombRecipToCartesian(k[use]), energies[use]
+
+# Get the error corresponding to the params `p` at each of the k-points kC
+# (as returned by fitData), with the 4 energy eigenvalues at each given by
+# the rows of `energies`.
+def H_err(p, kC, energies):
+    eigenvals, eigenkets = H_eigensystems(p, kC)
+    return norm(eigenvals - energies, axis=1)
+
+# Get the Jacobian of H_err: one row for each error value, giving its
+# derivatives with respect to the params `p`. The eigenvalue derivatives
+# come from the eigenvectors H_err already found (Hellmann-Feynman), so
+# this costs no further diagonalization.
+def H_jac(p, kC, energies):
+    eigenvals, eigenkets = H_eigensystems(p, kC)
+    dE = eigenvalDerivatives(eigenvals, eigenkets, ti3d_eigen.GammaTerms,
+                             paramDerivatives(len(p), kC))
+    diff = eigenvals - energies
+    err = norm(diff, axis=1)
+    # d|diff|/dp = (diff . dE/dp) / |diff|, taken as 0 where |diff| = 0
+    scale = np.divide(1.0, err, out=np.zeros_like(err), where=err > 0.0)
+    return np.einsum("kpm,km,k->kp", dE, diff, scale)
+
+# The last result of H_eigensystems, as [key, kC, eigensystems].
+lastEigensystems = [None, None, None]
+
+# Get (eigenvals, eigenkets) of the 4-band model with params `p` at the
+# k-points kC (shape (N, 3)), with shapes (N, 4) and (N, 4, 4): the
+# Hamiltonians for all k are built as one stack and diagonalized in one
+# call. The result for the last `p` and kC is kept: leastsq evaluates H_err
+# and H_jac at the same params, so the Jacobian reuses the residual's
+# diagonalizations.
+def H_eigensystems(p, kC):
+    key = tuple(p)
+    if lastEigensystems[0] == key and lastEigensystems[1] is kC:
+        return lastEigensystems[2]
+    H_p = ti3d_eigen.cachedModel(ti3d_eigen.Hamiltonian_4band, get_pmap(p))
+    eigensystems = np.linalg.eigh(H_p(kC))
+    lastEigensystems[:] = [key, kC, eigensystems]
+    return eigensystems
+
+# Get the derivatives of the coefficients of the 4-band model (a
+# ti3d_eigen.GammaModel) at the k-points kC with respect to each of the
+# `numParams` params, with shape (numParams, 6, N). Every coefficient is
+# linear in the params, so the derivatives with respect to p_j are the
+# coefficients with p_j = 1 and all other params 0.
+def paramDerivatives(numParams, kC):
+    derivatives = []
+    for j in range(numParams):
+        unit = [0.0]*numParams
+        unit[j] = 1.0
+        model = ti3d_eigen.cachedModel(ti3d_eigen.Hamiltonian_4band,
+                                       get_pmap(unit))
+        derivatives.append(model.coefficientsAt(kC)[0])
+    return array(derivatives)
+
+# Get the derivatives of the eigenvalues `eigenvals` (shape (N, n), each
+# row ascending) of a stack of N Hamiltonians, with eigenvectors the
+# columns of `eigenkets` (shape (N, n, n)), where the Hamiltonians are
+# sums of constant matrices `terms` (shape (T, n, n)) times coefficients
+# whose derivatives with respect to each param are dCoeffs (shape
+# (numParams, T, N)). Return an array with shape (N, numParams, n).
+# By Hellmann-Feynman dE_m/dp = <m|dH/dp|m> = sum_t dc_t/dp <m|term_t|m>.
+# The eigenvectors of degenerate eigenvalues are an arbitrary basis of
+# their subspace, so for those the mean over the subspace (its trace) is
+# used; the 4-band bands are Kramers pairs, which stay degenerate for all
+# params, so this is their exact derivative.
+def eigenvalDerivatives(eigenvals, eigenkets, terms, dCoeffs, tol=1e-8):
+    # <m|term_t|m>, shape (N, T, n)
+    kets = eigenkets[:, np.newaxis]
+    expect = (kets.conj() * np.matmul(terms, kets)).sum(axis=-2).real
+    gap = abs(eigenvals[:, :, np.newaxis] - eigenvals[:, np.newaxis, :])
+    scale = tol*np.maximum(1.0, abs(eigenvals))[:, :, np.newaxis]
+    same = (gap <= scale).astype(np.float64)
+    same /= same.sum(axis=2)[:, :, np.newaxis]
+    expect = np.matmul(expect, same.transpose(0, 2, 1))
+    return np.matmul(dCoeffs.transpose(2, 0, 1), expect)
 
 # Get the expected 4-band eigenvalues at k-point `k` with params `p`.
 def H_eigen(p, k):
     # convert list p to parameter map
     pmap = get_pmap(p)
-    # get eigenvals for H_p(k)
-    H_p = ti3d_eigen.Hamiltonian_4band(pmap)
+    # get eigenvals for H_p(k); the model is only built once for each
+    # parameter set, not once for each k-point
+    H_p = ti3d_eigen.cachedModel(ti3d_eigen.Hamiltonian_4band, pmap)
     eigenvals, eigenkets = eigh(H_p(rhombRecipToCartesian(k)))
     # convert eigenvals to numpy array
     return array(eigenvals)
@@ -52,22 +154,22 @@ def H_eigen(p, k):
 # Convert rhombohedral reciprocal lattice units to Cartesian.
 # Input k is given in 2pi/a_rhomb units.
 # Return (kx, ky, kz) with kx and ky in 2pi/a_hex units and
-# kz in 2pi/c_hex units.
+# kz in 2pi/c_hex units. k may also be an (N, 3) array of k-points, giving
+# an (N, 3) array.
 def rhombRecipToCartesian(k):
     # convert input to 1/(Angstrom) units
     pi2 = 2.0*math.pi
     a_hex = 4.138
     c_hex = 28.64
     a_rhomb = math.sqrt(a_hex*a_hex/3.0 + c_hex*c_hex/9.0)
-    kA = [k[0]*pi2/a_rhomb, k[1]*pi2/a_rhomb, k[2]*pi2/a_rhomb]
+    kA = np.asarray(k, dtype=np.float64)*pi2/a_rhomb
     # switch to Cartesian basis
     b1 = array([pi2/a_hex, -pi2/(math.sqrt(3)*a_hex), pi2/c_hex])
     b2 = array([0.0, 2.0*pi2/(math.sqrt(3)*a_hex), pi2/c_hex])
     b3 = array([-pi2/a_hex, -pi2/(math.sqrt(3)*a_hex), pi2/c_hex])
-    kC = b1*kA[0] + b2*kA[1] + b3*kA[2]
+    kC = np.dot(kA, array([b1, b2, b3]))
     # convert output to (2pi/a_hex, 2pi/a_hex, 2pi/c_hex) units
-    kC_out = [kC[0]*a_hex/pi2, kC[1]*a_hex/pi2, kC[2]*c_hex/pi2]
-    return kC_out
+    return kC*array([a_hex, a_hex, c_hex])/pi2
 
 # Convert `p`, a list of parameters, to a map representing these params.
 def get_pmap(p):
@@ -91,27 +193,20 @@ def get_p_est():
 # eigenvalue data. Assume these bands are the 2 above and 2 below the
 # Fermi energy (verified that this assumption works with band data).
 # `points` has eigenval2foo format points[s][b][k]; assume here s=0.
+# Return an array with shape (numK, 4).
 def getEnergyList(points):
     E_F = getFermiEnergy()
+    points = np.asarray(points[0])
     # Find 2 bands above and 2 bands below E_F.
     # Look for when E - E_F changes sign; E_F should be in the gap
     # so we can assume that E - E_F != 0.
     stop_b = 0
-    for b in range(len(points[0])):
-        E = points[0][b][0]
-        if E - E_F > 0.0:
-            # when we get here, we have had sign change
-            stop_b = b
-            break
+    above = np.flatnonzero(points[:, 0] - E_F > 0.0)
+    if len(above) > 0:
+        stop_b = above[0]
     bands = [stop_b - 2, stop_b - 1, stop_b, stop_b + 1]
-    # assemble list of eigenvalues for 4-band model
-    energyList = []
-    for k in range(len(points[0][0])):
-        energy = []
-        for b in bands:
-            energy.append(points[0][b][k])
-        energyList.append(energy)
-    return energyList
+    # array of eigenvalues for 4-band model, shape (numK, 4)
+    return points[bands].T
 
 # Get Fermi energy from OUTCAR - look for line with "E-fermi".
 def getFermiEnergy():
@@ -126,7 +221,118 @@ def getFermiEnergy():
     print("error: E_F not found")
     return 0.0
 
+# Return n samples of the unit cube in dim dimensions, shape (n, dim),
+# forming a Latin hypercube: along each dimension every one of the n
+# equal slices of [0, 1) holds exactly one sample.
+def latinHypercube(n, dim, rng):
+    u = np.empty((n, dim))
+    for d in range(dim):
+        u[:, d] = (rng.permutation(n) + rng.uniform(size=n)) / n
+    return u
+
+# Get numStarts starting points for the fit, shape (numStarts, len(p_est)):
+# p_est itself followed by Latin hypercube samples of the box
+# p_est*(1 +- spread), which keeps the sign of each param for spread < 1.
+def startingPoints(p_est, numStarts, spread, seed):
+    p_est = array(p_est, dtype=np.float64)
+    rng = np.random.RandomState(seed)
+    u = latinHypercube(numStarts - 1, len(p_est), rng)
+    samples = p_est*(1.0 + spread*(2.0*u - 1.0))
+    return np.vstack([p_est, samples])
+
+# Fit the params starting from p0. Return (p, cost, ier), where cost is
+# the sum of the squared errors at p and ier is the leastsq status.
+def fitFrom(p0, kC, energies):
+    p, ier = leastsq(H_err, p0, args=(kC, energies), Dfun=H_jac)
+    cost = float(np.sum(H_err(p, kC, energies)**2))
+    return p, cost, int(ier)
+
+# Fit data used by a worker process of multiStartFit.
+workerKC = None
+workerEnergies = None
+
+def initFitWorker(kC, energies):
+    global workerKC, workerEnergies
+    workerKC, workerEnergies = kC, energies
+
+def fitWorker(task):
+    start, p0 = task
+    p, cost, ier = fitFrom(p0, workerKC, workerEnergies)
+    return {"start": start, "p0": list(p0), "p": list(p), "cost": cost,
+            "ier": ier}
+
+# Read the fits recorded in the checkpoint file checkpointFileName (one
+# JSON object per line, as written by multiStartFit) and return them as a
+# map from start index to fit. The file is cut after the last complete
+# line, dropping a partly written fit left by an interruption. Exit if a
+# recorded starting point is not the one with that index in `starts`,
+# since the run was started with other options.
+def readCheckpoint(checkpointFileName, starts):
+    done = {}
+    if not os.path.exists(checkpointFileName):
+        return done
+    with open(checkpointFileName, "r+") as f:
+        end = 0
+        while True:
+            line = f.readline()
+            if not line.endswith("\n"):
+                break
+            try:
+                fit = json.loads(line)
+            except ValueError:
+                break
+            start = fit["start"]
+            if start >= len(starts) or not np.allclose(fit["p0"], starts[start]):
+                print("error: " + checkpointFileName + " is from a run with "
+                      + "other options; remove it to start over")
+                sys.exit(2)
+            done[start] = fit
+            end = f.tell()
+        f.truncate(end)
+    return done
+
+# Fit the params from each of the starting points `starts` (shape
+# (numStarts, numParams)), using `jobs` worker processes. If
+# checkpointFileName is not None, each completed fit is appended to that
+# file as it arrives, and the fits already recorded there are not redone.
+# Return the fits ordered by increasing cost; each is a map with keys
+# "start" (index in starts), "p0", "p", "cost" and "ier".
+def multiStartFit(starts, kC, energies, jobs=1, checkpointFileName=None):
+    done = {}
+    if checkpointFileName is not None:
+        done = readCheckpoint(checkpointFileName, starts)
+    tasks = [(start, starts[start]) for start in range(len(starts))
+             if start not in done]
+    checkpoint = None
+    if checkpointFileName is not None:
+        checkpoint = open(checkpointFileName, "a")
+    pool = None
+    try:
+        if jobs > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(jobs, initializer=initFitWorker,
+                                        initargs=(kC, energies))
+            fits = pool.imap_unordered(fitWorker, tasks)
+        else:
+            initFitWorker(kC, energies)
+            fits = (fitWorker(task) for task in tasks)
+        for fit in fits:
+            done[fit["start"]] = fit
+            if checkpoint is not None:
+                checkpoint.write(json.dumps(fit) + "\n")
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if checkpoint is not None:
+            checkpoint.close()
+    return sorted(done.values(), key=lambda fit: fit["cost"])
+
 def main():
+    options = parseArgs()
     # get eigenvalue data
     e = EIGENVAL("EIGENVAL")
     kList = e.kpoints
@@ -134,14 +340,30 @@ def main():
     # get estimated parameters
     p_est = get_p_est()
 
-    # perform least-squares fit for parameters
-    p, ier = leastsq(H_err, p_est, args=(kList, energyList))
-    if ier not in [1, 2, 3, 4]:
+    # convert and filter the k-points once, not on every evaluation
+    kC, energies = fitData(kList, energyList)
+
+    # perform least-squares fits for parameters from each starting point
+    numStarts = int(options.get("starts", 1))
+    starts = startingPoints(p_est, numStarts,
+                            float(options.get("spread", 0.5)),
+                            int(options.get("seed", 0)))
+    checkpointFileName = None
+    if numStarts > 1:
+        checkpointFileName = options.get("checkpoint", "fit4bands.checkpoint")
+    fits = multiStartFit(starts, kC, energies, int(options.get("jobs", 1)),
+                         checkpointFileName)
+    if numStarts > 1:
+        print("rank  start  cost          ier")
+        for rank, fit in enumerate(fits[:10]):
+            print("%4d  %5d  %.6e  %3d" % (rank + 1, fit["start"], fit["cost"],
+                                           fit["ier"]))
+    if fits[0]["ier"] not in [1, 2, 3, 4]:
         # TODO handle error
         print("error in least-squares fit")
 
     # write output
-    print(p)
+    print(array(fits[0]["p"]))
 
 if __name__ == "__main__":
     main()
@@ -21,22 +21,63 @@
 #     OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #     THE SOFTWARE.
 #
+import os
 import re
+import sys
+import mmap
+import itertools
+import multiprocessing
+import numpy as np
+
+# Names of the lm-decomposed columns of an ion table, in file order. The
+# total column is always the last one.
+ORBITALS = ['s', 'py', 'pz', 'px', 'dxy', 'dyz', 'dz2', 'dxz', 'dx2']
 
 # Represents the data stored in a PROCAR file.
 # Contains properties nonCol, Nk, Nb, Ni, and kPoints.
 # kPoints is a list of KPoint objects.
+#
+# The data itself is stored in columns:
+#   kCoords       (Nk, 3) k-point coordinates
+#   kWeights      (Nk,) k-point weights
+#   energies      (Nk, Nb) band energies
+#   occupations   (Nk, Nb) band occupations
+#   projections   (Nk, Nb, numTables, Ni+1, numOrbitals) ion tables; ion
+#                 index i-1 holds ion i and index Ni holds the 'tot' row.
+#                 The last orbital is the total column; if lmDecomposed is
+#                 false it is the only one.
+# KPoint, Band, IonTable and Ion objects are views into these arrays.
 class PROCAR(object):
     # Create PROCAR object by reading from the file-like object procarFile.
     # nonCol = true if this is a non-collinear calculation (2 spins: 4 spinor
     # components); otherwise nonCol = false.
     # If lmDecomposed=False, all ion table columns are discared except the
     # total column. If storeIds=False, entry ids are not stored.
-    def __init__(self, procarFile, nonCol, lmDecomposed=True, storeIds=True):
+    # dtype is the type of the projections array; np.float32 halves its size.
+    def __init__(self, procarFile, nonCol, lmDecomposed=True, storeIds=True,
+                 dtype=np.float64, jobs=1):
         self.nonCol = nonCol
         self.lmDecomposed = lmDecomposed
         self.storeIds = storeIds
+        self.numTables = 4 if nonCol else 1
+        self.dtype = dtype
+        if jobs > 1:
+            self.parseParallel(procarFile.name, jobs)
+        else:
+            self.parse(procarFile)
+        self.kPoints = [KPoint(self, kId) for kId in range(1, self.Nk+1)]
+
+    # Read the data from procarFile, one k-point entry at a time.
+    def parse(self, procarFile):
+        self.readHeader(procarFile)
+        for k, entry in enumerate(self.readEntries(procarFile)):
+            if k == 0:
+                self.allocate()
+            (self.kCoords[k], self.kWeights[k], self.energies[k],
+             self.occupations[k], self.projections[k]) = entry
 
+    # Read the global data at the start of procarFile.
+    def readHeader(self, procarFile):
         # Start at the beginning of the file
         try:
             procarFile.seek(0)
@@ -50,78 +91,383 @@ class PROCAR(object):
         # (number of k-points, bands, and ions)
         self.Nk, self.Nb, self.Ni = map(int, re.findall(r'\d+', globalLine))
         procarFile.readline()       # discard line 3 (empty)
-        # Iterate over k-points.
-        # The next line read should be the first line of the first k-point entry.
-        self.kPoints = []
-        for kId in range(1, self.Nk+1):
-            # Extract k-point data.
-            self.kPoints.append(KPoint(procarFile, self, kId))
-            # Advance to the next k-point.
-            procarFile.readline() # empty line
+        # Each k-point entry is a header line, an empty line, the band
+        # entries and an empty line; each band entry is a header line, an
+        # empty line, the column names, the ion tables and an empty line.
+        self.bandLines = 4 + self.numTables*(self.Ni + 1)
+        self.kLines = 3 + self.Nb*self.bandLines
+
+    # Iterate over the k-point entries of procarFile, which must follow the
+    # header, yielding the result of ParseKPoint for each one.
+    def readEntries(self, procarFile):
+        for k in range(self.Nk):
+            lines = list(itertools.islice(procarFile, self.kLines))
+            if k == 0:
+                # line 5 of the entry names the ion table columns
+                self.setColumns(lines[4])
+            yield ParseKPoint(lines, self)
+
+    # Read the data from the file at path in jobs worker processes. The
+    # k-point entries are split into chunks at the offsets found by
+    # LazyPROCAR, and the workers parse them straight into projections,
+    # which is allocated in shared memory.
+    def parseParallel(self, path, jobs):
+        # like the serial parse, leave no index file next to the PROCAR
+        with LazyPROCAR(path, self.nonCol, self.lmDecomposed, self.storeIds,
+                        cacheIndex=False) as lazy:
+            self.Nk, self.Nb, self.Ni = lazy.Nk, lazy.Nb, lazy.Ni
+            self.bandLines = lazy.bandLines
+            self.kLines = 3 + self.Nb*self.bandLines
+            self.numColumns, self.numOrbitals = lazy.numColumns, lazy.numOrbitals
+            offsets = lazy.kOffsets.tolist() + [len(lazy.map)]
+
+        # several chunks per worker so that the load stays balanced
+        numChunks = min(self.Nk, 4*jobs)
+        bounds = [self.Nk*i // numChunks for i in range(numChunks + 1)]
+        chunks = [(bounds[i], bounds[i+1], offsets[bounds[i]], offsets[bounds[i+1]])
+                  for i in range(numChunks)]
+        shared = multiprocessing.RawArray('b', int(np.prod(self.projectionsShape()))
+                                          * np.dtype(self.dtype).itemsize)
+        # start the workers before allocating, so that they get the layout
+        # of the file but not the arrays
+        pool = multiprocessing.Pool(jobs, initializer=InitParseWorker,
+                                    initargs=(path, self, shared))
+        try:
+            self.allocate(shared)
+            for start, kCoords, kWeights, energies, occupations in \
+                    pool.imap_unordered(ParseWorker, chunks):
+                stop = start + len(kCoords)
+                self.kCoords[start:stop] = kCoords
+                self.kWeights[start:stop] = kWeights
+                self.energies[start:stop] = energies
+                self.occupations[start:stop] = occupations
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    # Set the number of ion table columns from the line naming them
+    # ("ion s py pz ... tot").
+    def setColumns(self, namesLine):
+        self.numColumns = len(namesLine.split()) - 1
+        self.numOrbitals = self.numColumns if self.lmDecomposed else 1
+
+    def projectionsShape(self):
+        return (self.Nk, self.Nb, self.numTables, self.Ni + 1, self.numOrbitals)
+
+    # Allocate the data arrays. If shared is given, projections uses its
+    # memory.
+    def allocate(self, shared=None):
+        self.kCoords = np.empty((self.Nk, 3))
+        self.kWeights = np.empty(self.Nk)
+        self.energies = np.empty((self.Nk, self.Nb))
+        self.occupations = np.empty((self.Nk, self.Nb))
+        if shared is None:
+            self.projections = np.empty(self.projectionsShape(), dtype=self.dtype)
+        else:
+            self.projections = np.frombuffer(shared, dtype=self.dtype).reshape(
+                self.projectionsShape())
+
+    # Return ([kx, ky, kz], weight) for the k-point with index k (from 0).
+    def kHead(self, k):
+        return self.kCoords[k].tolist(), float(self.kWeights[k])
+
+    # Return (energy, occ, tables) for the band with index b (from 0) at
+    # the k-point with index k; tables has shape (numTables, Ni+1,
+    # numOrbitals).
+    def bandData(self, k, b):
+        return (float(self.energies[k, b]), float(self.occupations[k, b]),
+                self.projections[k, b])
 
     # Return data for the k-point with id given by kId in the PROCAR file
     # format (the first id is 1, not 0).
     def KPoint(self, kId):
         return self.kPoints[kId-1]
-   
+
+# Return ((kx, ky, kz), weight) from a k-point header line.
+def ParseKHead(kHead):
+    # fixed positions since numbers overlap when there is a minus sign
+    k = [float(kHead[18:29]), float(kHead[29:40]), float(kHead[40:51])]
+    # weight is the last thing in the line, isolated by spaces
+    return k, float(kHead.rstrip().split(' ')[-1])
+
+# Parse the lines of consecutive band entries of one k-point (each one
+# procar.bandLines long, the last empty line optional). Return the
+# energies, occupations and ion tables of the bands as arrays with shapes
+# (n,), (n,) and (n, numTables, Ni+1, numOrbitals).
+def ParseBands(lines, procar):
+    n = (len(lines) + 1) // procar.bandLines
+    rowsPerBand = procar.numTables*(procar.Ni + 1)
+    energies, occupations, rows = [], [], []
+    for b in range(n):
+        start = b*procar.bandLines
+        bandHead = lines[start].split()
+        # energy is the fifth group in the line, isolated by spaces;
+        # occ is the last one
+        energies.append(float(bandHead[4]))
+        occupations.append(float(bandHead[-1]))
+        # skip the empty line and the column names
+        rows.extend(lines[start+3:start+3+rowsPerBand])
+    # the first column is the ion number, or 'tot' for the total row
+    values = np.fromstring(' '.join(rows).replace('tot', '0'), sep=' ')
+    if len(values) != n*rowsPerBand*(procar.numColumns + 1):
+        print("error: malformed PROCAR band entry: " + lines[0].strip())
+        sys.exit(2)
+    values = values.reshape(n, procar.numTables, procar.Ni + 1,
+                            procar.numColumns + 1)
+    return (np.array(energies), np.array(occupations),
+            values[..., 1:] if procar.lmDecomposed else values[..., -1:])
+
+# Parse the lines of one k-point entry. Return its coordinates, weight,
+# and the energies, occupations and ion tables of its bands (see
+# ParseBands).
+def ParseKPoint(lines, procar):
+    k, weight = ParseKHead(lines[0])
+    energies, occupations, tables = ParseBands(lines[2:procar.kLines-1], procar)
+    return k, weight, energies, occupations, tables
+
+# File path, PROCAR layout and projections array used by a worker process
+# of PROCAR.parseParallel.
+workerPath = None
+workerProcar = None
+workerProjections = None
+
+def InitParseWorker(path, procar, shared):
+    global workerPath, workerProcar, workerProjections
+    workerPath = path
+    workerProcar = procar
+    workerProjections = np.frombuffer(shared, dtype=procar.dtype).reshape(
+        procar.projectionsShape())
+
+# Parse the k-point entries start to stop-1, which lie between the byte
+# offsets begin and end, into workerProjections. Return (start, kCoords,
+# kWeights, energies, occupations) for these k-points.
+def ParseWorker(chunk):
+    start, stop, begin, end = chunk
+    with open(workerPath, 'rb') as f:
+        f.seek(begin)
+        text = f.read(end - begin)
+    if not isinstance(text, str):
+        text = text.decode('ascii')
+    lines = text.split('\n')
+    procar = workerProcar
+    kCoords = np.empty((stop - start, 3))
+    kWeights = np.empty(stop - start)
+    energies = np.empty((stop - start, procar.Nb))
+    occupations = np.empty((stop - start, procar.Nb))
+    for k in range(start, stop):
+        i = k - start
+        (kCoords[i], kWeights[i], energies[i], occupations[i],
+         workerProjections[k]) = ParseKPoint(
+             lines[i*procar.kLines:(i+1)*procar.kLines], procar)
+    return start, kCoords, kWeights, energies, occupations
+
+# A PROCAR that is read one k-point entry at a time, without keeping the
+# data, so that the memory used does not grow with the size of the file.
+# Iterating over it yields (k, kCoords, weight, energies, occupations,
+# tables) for each k-point in order, where k is the index of the k-point
+# (from 0) and tables has shape (Nb, numTables, Ni+1, numOrbitals).
+# Contains properties nonCol, Nk, Nb, Ni; numOrbitals is set once the
+# first entry has been read. The other arguments are as for PROCAR.
+class StreamPROCAR(PROCAR):
+    def __init__(self, procarFile, nonCol, lmDecomposed=True, dtype=np.float64):
+        self.nonCol = nonCol
+        self.lmDecomposed = lmDecomposed
+        self.numTables = 4 if nonCol else 1
+        self.dtype = dtype
+        self.file = procarFile
+        self.readHeader(procarFile)
+        self.started = False
+
+    def __iter__(self):
+        # iterating again starts over from the top of the file
+        if self.started:
+            self.readHeader(self.file)
+        self.started = True
+        for k, (kCoords, weight, energies, occupations, tables) in \
+                enumerate(self.readEntries(self.file)):
+            yield (k, np.array(kCoords), weight, energies, occupations,
+                   tables.astype(self.dtype, copy=False))
+
+# Suffix of the byte-offset index LazyPROCAR keeps next to a PROCAR file.
+INDEX_SUFFIX = '.index.npz'
+
+# Start of a k-point or band entry. The k-point header starts with a space.
+ENTRY_PATTERN = re.compile(b'\n( k-point|band )')
+
+# A PROCAR that is read lazily from the file at path: opening it only finds
+# the byte offset of every k-point and band entry, and an entry is parsed
+# when KPoint(kId) or KPoint(kId).Band(bandId) first touches it. If
+# cacheIndex is True, the index of offsets is cached in path + INDEX_SUFFIX
+# and reused as long as the size and modification time of the file are
+# unchanged; otherwise the file is scanned every time and nothing is written.
+# The file stays open until close(), or the end of a with block:
+#     with LazyPROCAR(path, nonCol) as procar:
+#         ...
+# Contains properties nonCol, Nk, Nb, Ni, kPoints, kOffsets (Nk,) and
+# bandOffsets (Nk, Nb); the other arguments are as for PROCAR.
+class LazyPROCAR(PROCAR):
+    def __init__(self, path, nonCol, lmDecomposed=True, storeIds=True,
+                 dtype=np.float64, cacheIndex=True):
+        self.nonCol = nonCol
+        self.lmDecomposed = lmDecomposed
+        self.storeIds = storeIds
+        self.numTables = 4 if nonCol else 1
+        self.dtype = dtype
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # (number of k-points, bands, and ions) are on line 2
+        globalLine = self.line(self.map.find(b'\n') + 1)
+        self.Nk, self.Nb, self.Ni = map(int, re.findall(r'\d+', globalLine))
+        self.bandLines = 4 + self.numTables*(self.Ni + 1)
+        if cacheIndex:
+            self.kOffsets, self.bandOffsets = self.loadIndex(path)
+        else:
+            self.kOffsets, self.bandOffsets = self.scan()
+        # line 3 of a band entry names the ion table columns
+        self.setColumns(self.bandText(0, 0).split('\n')[2])
+        self._kPoints = [None]*self.Nk
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+    # Return the text of the file between byte offsets start and end.
+    def text(self, start, end):
+        text = self.map[start:end]
+        if not isinstance(text, str):
+            text = text.decode('ascii')
+        return text
+
+    # Return the line starting at byte offset start.
+    def line(self, start):
+        end = self.map.find(b'\n', start)
+        return self.text(start, end if end >= 0 else len(self.map))
+
+    # Return the text of the band entry with index b at k-point index k.
+    def bandText(self, k, b):
+        if b + 1 < self.Nb:
+            end = self.bandOffsets[k, b+1]
+        elif k + 1 < self.Nk:
+            end = self.kOffsets[k+1]
+        else:
+            end = len(self.map)
+        return self.text(int(self.bandOffsets[k, b]), int(end))
+
+    # Return (kOffsets, bandOffsets) from the cached index if it is up to
+    # date, otherwise scan the file and try to cache the result.
+    def loadIndex(self, path):
+        indexPath = path + INDEX_SUFFIX
+        info = os.stat(path)
+        stamp = [float(info.st_size), info.st_mtime]
+        try:
+            with np.load(indexPath) as index:
+                if index['stamp'].tolist() == stamp:
+                    return index['kOffsets'], index['bandOffsets']
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+        kOffsets, bandOffsets = self.scan()
+        try:
+            np.savez(indexPath, stamp=np.array(stamp), kOffsets=kOffsets,
+                     bandOffsets=bandOffsets)
+        except (IOError, OSError):
+            print("warning: couldn't write PROCAR index " + indexPath)
+        return kOffsets, bandOffsets
+
+    # Scan the file for the byte offsets of the k-point entries, shape
+    # (Nk,), and of the band entries, shape (Nk, Nb).
+    def scan(self):
+        kOffsets, bandOffsets = [], []
+        for match in ENTRY_PATTERN.finditer(self.map):
+            if match.group(1) == b'band ':
+                bandOffsets.append(match.start() + 1)
+            else:
+                kOffsets.append(match.start() + 1)
+        kOffsets = np.array(kOffsets, dtype=np.int64)
+        bandOffsets = np.array(bandOffsets, dtype=np.int64)
+        bandsPerK = np.bincount(np.searchsorted(kOffsets, bandOffsets) - 1,
+                                minlength=self.Nk)
+        if len(kOffsets) != self.Nk or (bandsPerK != self.Nb).any():
+            print("error: PROCAR entries don't match the header: " +
+                  self.file.name)
+            sys.exit(2)
+        return kOffsets, bandOffsets.reshape(self.Nk, self.Nb)
+
+    def kHead(self, k):
+        return ParseKHead(self.line(int(self.kOffsets[k])))
+
+    def bandData(self, k, b):
+        lines = self.bandText(k, b).split('\n')
+        energies, occupations, tables = ParseBands(lines, self)
+        return (float(energies[0]), float(occupations[0]),
+                tables[0].astype(self.dtype))
+
+    @property
+    def kPoints(self):
+        return [self.KPoint(kId) for kId in range(1, self.Nk+1)]
+
+    def KPoint(self, kId):
+        if self._kPoints[kId-1] is None:
+            self._kPoints[kId-1] = KPoint(self, kId)
+        return self._kPoints[kId-1]
+
 # Represents the data for one k-point.
 # Contains properties kId, kx, ky, kz, weight, and bands.
 # bands is a list of Band objects.
 class KPoint(object):
-    # Extract k-point data from procarFile.
-    # The next line read should be the first line of the k-point entry.
-    def __init__(self, procarFile, procar, kId):
+    def __init__(self, procar, kId):
+        self.procar = procar
+        self.k = kId - 1
         if procar.storeIds:
             self.kId = kId
-        kHead = procarFile.readline()
-        # fixed positions since numbers overlap when there is a minus sign
-        self.kx, self.ky, self.kz = map(float, [kHead[18:29], kHead[29:40],
-                                                kHead[40:51]])
-        # weight is the last thing in the line, isolated by spaces
-        self.weight = float(kHead.rstrip().split(' ')[-1])
-        procarFile.readline() # empty line
-        # iterate over bands
-        self.bands = []
-        for bandId in range(1, procar.Nb+1):
-            # Extract band data.
-            self.bands.append(Band(procarFile, procar, bandId))
-            # Advance to the next band.
-            procarFile.readline() # empty line
+        (self.kx, self.ky, self.kz), self.weight = procar.kHead(self.k)
+        self._bands = [None]*procar.Nb
+
+    # Band objects are made on first use and kept, so that properties
+    # added to them (such as surface weights) persist.
+    @property
+    def bands(self):
+        return [self.Band(bandId) for bandId in range(1, self.procar.Nb+1)]
 
     # Return data for the band with id given by bandId in the PROCAR file
     # format (the first id is 1, not 0).
     def Band(self, bandId):
-        return self.bands[bandId-1]
+        if self._bands[bandId-1] is None:
+            self._bands[bandId-1] = Band(self, bandId)
+        return self._bands[bandId-1]
 
 
 # Represents the data for one band belonging to a specific k-point.
 # Contains properties bandId, energy, occ, tables.
 # tables is a list of IonTable objects.
 class Band(object):
-    # Extract band data from procarFile.
-    # The next line read should be the first line of the band entry.
-    def __init__(self, procarFile, procar, bandId):
+    def __init__(self, kPoint, bandId):
+        procar = kPoint.procar
         if procar.storeIds:
             self.bandId = bandId
-        bandHead = procarFile.readline().strip().split()
-        # energy is the fifth group in the line, isolated by spaces
-        self.energy = float(bandHead[4])
-        # occ is the last group in the line, isolated by spaces
-        self.occ = float(bandHead[-1])
-        # get ion tables
-        procarFile.readline() # empty line
-        procarFile.readline()  # skip line containing "ion   s   py  pz"...etc
-        self.tables = []
-        numTables = 1
-        if procar.nonCol:
-            numTables = 4
-        for tableId in range(1, numTables+1):
-            # Extract table data.
-            self.tables.append(IonTable(procarFile, procar, tableId))
+        self.energy, self.occ, self.values = procar.bandData(kPoint.k,
+                                                             bandId-1)
+        self.procar = procar
+        self._tables = None
         # top/bottom surface weights
         self.top = []
         self.bottom = []
 
+    @property
+    def tables(self):
+        if self._tables is None:
+            self._tables = [IonTable(self, tableId)
+                            for tableId in range(1, self.procar.numTables+1)]
+        return self._tables
+
     # Return data for the table with id given by tableId in the PROCAR file
     # format (the first id is 1, not 0).
     def Table(self, tableId):
@@ -133,23 +479,20 @@ class Band(object):
 # ions is a list of Ion objects and tot is an Ion object containing the
 # total values summed over all ions.
 class IonTable(object):
-    # Extract ion table data from procarFile.
-    # The next line read should be the first line of the table, containing ion 1
-    def __init__(self, procarFile, procar, tableId):
-        if procar.storeIds:
+    def __init__(self, band, tableId):
+        self.procar = band.procar
+        if self.procar.storeIds:
             self.tableId = tableId
-        # read data for each ion
-        self.ions = []
-        for ionId in range(1, procar.Ni+1):
-            if procar.lmDecomposed:
-                self.ions.append(Ion(procarFile, procar, ionId))
-            else:
-                self.ions.append(IonTotalOnly(procarFile, procar, ionId))
-        # read row containing totals
-        if procar.lmDecomposed:
-            self.tot = Ion(procarFile, procar, 0)
-        else:
-            self.tot = IonTotalOnly(procarFile, procar, 0)
+        self.values = band.values[tableId-1]
+        self._ions = None
+        self.tot = Ion(self.procar, self.values[-1], 0)
+
+    @property
+    def ions(self):
+        if self._ions is None:
+            self._ions = [Ion(self.procar, self.values[ionId-1], ionId)
+                          for ionId in range(1, self.procar.Ni+1)]
+        return self._ions
 
     # Return data for the ion with id given by ionId in the PROCAR file
     # format (the first id is 1, not 0).
@@ -157,34 +500,25 @@ class IonTable(object):
         return self.ions[ionId-1]
 
 # Represents data for one ion, belonging to a (k-point, band, ionTable).
-# Contains properties ionId, s, py, pz, px, dxy, dyz, dz2, dxz, dx2, tot.
+# Contains properties ionId, s, py, pz, px, dxy, dyz, dz2, dxz, dx2, tot;
+# if the PROCAR was read with lmDecomposed=False, only ionId and tot.
 class Ion(object):
-    def __init__(self, procarFile, procar, ionId):
+    def __init__(self, procar, values, ionId):
         if procar.storeIds:
             self.ionId = ionId
-        # each entry in the line is always separated by spaces
-        l = procarFile.readline().strip().split()
-        self.s, self.py, self.pz, self.px = map(float, [l[1], l[2], l[3], l[4]])
-        self.dxy, self.dyz, self.dz2, self.dxz = map(float, [l[5], l[6], l[7], l[8]])
-        self.dx2, self.tot = map(float, [l[9], l[10]])
-
-    def SquareSum(self):
-        return sum(map(lambda x: x*x, [self.s, self.py, self.pz, self.px,
-                                   self.dxy, self.dyz, self.dz2, self.dxz,
-                                   self.dx2]))
+        self.values = values
 
-# Represents data for one ion, belonging to a (k-point, band, ionTable).
-# Discards lm-decomposed data. Contains properties ionId, tot.
-class IonTotalOnly(object):
-    def __init__(self, procarFile, procar, ionId):
-        if procar.storeIds:
-            self.ionId = ionId
-        # each entry in the line is always separated by spaces
-        l = procarFile.readline().strip().split()
-        self.tot = float(l[10])
+    def __getattr__(self, name):
+        if name == 'tot':
+            return float(self.values[-1])
+        if name in ORBITALS and len(self.values) > 1:
+            return float(self.values[ORBITALS.index(name)])
+        raise AttributeError(name)
 
     def SquareSum(self):
-        return self.tot*self.tot
+        if len(self.values) == 1:
+            return self.tot*self.tot
+        return float(np.dot(self.values[:-1], self.values[:-1]))
 
 if __name__ == "__main__":
     # test - TODO arguments?
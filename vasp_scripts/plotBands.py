@@ -20,53 +20,130 @@
 #     THE SOFTWARE.
 #
 import sys
+import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import parseProcar, surface
 
+# Read the PROCAR file procarFileName one k-point at a time and classify
+# its bands with surface.ClassifySurface, keeping only the results. Return
+# (kx, energy, top, bottom, surf): kx has shape (Nk,) and the others
+# (Nk, Nb); surf is true for the surface states and top and bottom are the
+# largest top/bottom surface fractions over the tables of each band.
+def SurfaceBands(procarFileName, depth, threshold, strategy='SumSquare',
+                 nonCol=True):
+    with open(procarFileName, 'r') as f:
+        stream = parseProcar.StreamPROCAR(f, nonCol)
+        kx = np.empty(stream.Nk)
+        energy = np.empty((stream.Nk, stream.Nb))
+        top = np.empty((stream.Nk, stream.Nb))
+        bottom = np.empty((stream.Nk, stream.Nb))
+        surf = np.empty((stream.Nk, stream.Nb), dtype=bool)
+        for k, kCoords, energies, s, t, b in surface.StreamSurface(
+                stream, depth, threshold, strategy):
+            kx[k] = kCoords[0]
+            energy[k], surf[k], top[k], bottom[k] = energies, s, t, b
+    return kx, energy, top, bottom, surf
+
+# Plot the bands of procar, which has been marked by
+# surface.MarkSurfaceStates.
 def PlotBands(procar, sizeWeight=True):
-    # Iterate over bands to collect data.
-    for i in range(1, procar.Nb+1):
-        # Iterate over k-points to build (kx, energy) pairs for this band.
-        # Entries in surface are 0 (bulk states) or 1 (surface states).
-        # surface controls the color of the markers.
-        kx, energy, surface, topSize, bottomSize = [], [], [], [], []
-        for k in procar.kPoints:
-            kx.append(k.kx)
-            b = k.Band(i)
-            energy.append(b.energy)
-            topSize.append(100.0*max(b.top))
-            bottomSize.append(100.0*max(b.bottom))
-            white = cm.gray(0.99)
-            black = cm.gray(0.0)
-            if hasattr(b, 'surface') and b.surface:
-                print(str(k.kx) + " " + str(i))
-                surface.append(cm.gray(0.0))
-            else:
-                surface.append(cm.gray(0.99))
-        # plot band as thin green line (to clarify connection btwn markers)
-        plt.plot(kx, energy, 'g-', linewidth=1)
-        if sizeWeight:
-            # plot band as markers sized by their surface weight:
-            # top surface -> white, bottom surface -> black
-            plt.scatter(kx, energy, facecolors=white, edgecolor='b',
-                        marker='o', cmap=cm.gray, linewidth=1, s=topSize)
-            plt.scatter(kx, energy, facecolors=black, edgecolor='b',
-                        marker='o', cmap=cm.gray, linewidth=1, s=bottomSize)
-        else:
-            # plot band as markers: bulk -> white, surface -> black
-            plt.scatter(kx, energy, facecolors=surface, edgecolor='b',
-                        marker='o', cmap=cm.gray, linewidth=1, s=50)
+    kx = [k.kx for k in procar.kPoints]
+    bands = [k.bands for k in procar.kPoints]
+    energy = np.array([[b.energy for b in bs] for bs in bands])
+    top = np.array([[max(b.top) for b in bs] for bs in bands])
+    bottom = np.array([[max(b.bottom) for b in bs] for bs in bands])
+    surf = np.array([[getattr(b, 'surface', False) for b in bs] for bs in bands])
+    PlotSurfaceBands(kx, energy, top, bottom, surf, sizeWeight)
+
+# Markers smaller than this (in points^2) are not drawn.
+MIN_MARKER_SIZE = 0.5
+
+# Draw the bands given as arrays, as returned by SurfaceBands, on the
+# matplotlib Axes ax: the bands as one LineCollection and the markers as
+# one scatter per colour. If sizeWeight is true the markers are sized by
+# their top (white) and bottom (black) surface weight, otherwise surface
+# states are black and bulk states white.
+#
+# Markers are rasterized in vector output. Dense markers are downsampled:
+# of the markers of one colour whose centres fall in the same square of
+# markerCell x markerCell pixels, only the largest one is drawn (it covers
+# the others). markerCell=0 draws every marker.
+def DrawBands(ax, kx, energy, top, bottom, surf, sizeWeight=True,
+              markerCell=3):
+    kx = np.asarray(kx, dtype=np.float64)
+    Nk, Nb = energy.shape
+    # plot bands as thin green lines (to clarify connection btwn markers)
+    segments = np.empty((Nb, Nk, 2))
+    segments[:, :, 0] = kx
+    segments[:, :, 1] = energy.T
+    ax.add_collection(LineCollection(segments, colors='g', linewidths=1))
+    ax.autoscale_view()
 
+    x = np.repeat(kx, Nb)
+    y = energy.ravel()
+    cells = MarkerCells(ax, x, y, markerCell) if markerCell else None
+    white = cm.gray(0.99)
+    black = cm.gray(0.0)
+    if sizeWeight:
+        # top surface -> white, bottom surface -> black
+        markers = [(100.0*top.ravel(), white), (100.0*bottom.ravel(), black)]
+    else:
+        # bulk -> white, surface -> black
+        surf = surf.ravel()
+        markers = [(np.where(surf, 0.0, 50.0), white),
+                   (np.where(surf, 50.0, 0.0), black)]
+    for size, color in markers:
+        shown = np.flatnonzero(size >= MIN_MARKER_SIZE)
+        if cells is not None:
+            # largest first, then the first marker in each cell
+            shown = shown[np.argsort(-size[shown], kind='mergesort')]
+            shown = shown[np.unique(cells[shown], return_index=True)[1]]
+        ax.scatter(x[shown], y[shown], s=size[shown], facecolors=[color],
+                   edgecolor='b', marker='o', linewidth=1, rasterized=True)
+
+# Return the index of the square of cell x cell pixels of ax that each of
+# the points (x, y) falls in.
+def MarkerCells(ax, x, y, cell):
+    box = ax.get_window_extent()
+    (x0, x1), (y0, y1) = ax.get_xlim(), ax.get_ylim()
+    nx = max(1, int(box.width / cell))
+    ny = max(1, int(box.height / cell))
+    ix = np.clip(((x - x0) / (x1 - x0) * nx).astype(int), 0, nx - 1)
+    iy = np.clip(((y - y0) / (y1 - y0) * ny).astype(int), 0, ny - 1)
+    return ix*ny + iy
+
+# Plot the bands given as arrays, as returned by SurfaceBands, and show
+# the plot.
+def PlotSurfaceBands(kx, energy, top, bottom, surf, sizeWeight=True,
+                     markerCell=3):
+    DrawBands(plt.gca(), kx, energy, top, bottom, surf, sizeWeight, markerCell)
     # Display the plot
     plt.show()
 
+# Same as PlotSurfaceBands, but write the plot to the file outFileName
+# (whose extension, e.g. .png or .pdf, gives the format) without a
+# display, for batch jobs.
+def RenderBands(outFileName, kx, energy, top, bottom, surf, sizeWeight=True,
+                markerCell=3, dpi=150):
+    fig = Figure(figsize=(8, 6), dpi=dpi)
+    FigureCanvasAgg(fig)
+    DrawBands(fig.add_subplot(111), kx, energy, top, bottom, surf,
+              sizeWeight, markerCell)
+    fig.savefig(outFileName, dpi=dpi)
+
 if __name__ == "__main__":
+    # usage: python plotBands.py [PROCAR [outFileName]]
+    # With outFileName, the plot is written to that file instead of shown.
     procarFileName = 'PROCAR'
     if len(sys.argv) > 1:
         procarFileName = sys.argv[1]
-    procar = None
-    with open(procarFileName, 'r') as f:
-        procar = parseProcar.PROCAR(f, nonCol=True, lmDecomposed=True, storeIds=True)
-    surface.MarkSurfaceStates(procar, 1, 0.99, strategy="SumSquare")
-    PlotBands(procar, sizeWeight=True)
+    kx, energy, top, bottom, surf = SurfaceBands(procarFileName, 1, 0.99,
+                                                 strategy="SumSquare")
+    if len(sys.argv) > 2:
+        RenderBands(sys.argv[2], kx, energy, top, bottom, surf, sizeWeight=True)
+    else:
+        PlotSurfaceBands(kx, energy, top, bottom, surf, sizeWeight=True)
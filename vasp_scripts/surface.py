@@ -21,85 +21,204 @@
 #     OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #     THE SOFTWARE.
 #
+import sys
+import math
+import numpy as np
 import parseProcar
 
-# For each ion table in procar, if the quantities in the 'total' column are
-# concentrated close enough to the surface then mark the table as a surface
-# state by adding the property table.surface=True; otherwise set
-# table.surface=False. For a given (kpoint, band) pair, if any tables have
-# the surface property set to true, set band.surface=True; otherwise set
-# band.surface=False.
-#
 # Whether or not an ion table represents a surface state is controlled by
 # the depth and threshold parameters. Starting with ion #1 and moving inward
-# to ion #(depth), add the values in the total column together and call this
-# 'sumTop'. On the other end, add the total column values for ion #(Ni)
-# to ion #(Ni-depth+1) and call this 'sumBottom'.
-# (TODO: better to make depth fractional?)
-# The value table.tot.tot contains the sum over all ions of the total column;
-# call this value 'sum'.
-# If |sumBottom|/|sum| > threshold or |sumTop|/|sum| > threshold, then the
-# table represents a surface state.
+# to ion #(depth), add the weights of the ions together and call this
+# 'sumTop'. On the other end, add the weights of ion #(Ni) to ion
+# #(Ni-depth+1) and call this 'sumBottom'. Call the weight of the whole
+# table 'sum'. If |sumBottom|/|sum| > threshold or |sumTop|/|sum| >
+# threshold, then the table represents a surface state.
+#
+# depth is either a number of ions (an int, or a float >= 1) or a fraction
+# of the slab (a float between 0 and 1), in which case the ions are assumed
+# to be ordered from the top of the slab to the bottom.
+#
+# strategy = 'SumSquare' or 'Sum' - are PROCAR values squared before
+# summation, or not? With 'SumSquare' the weight of an ion is the sum of
+# the squares of its lm-decomposed entries (or the square of its total if
+# the PROCAR was read with lmDecomposed=False) and 'sum' is the sum of the
+# ion weights. With 'Sum' the weight of an ion is its total and 'sum' is
+# the total of the table.
 #
-# TODO it would be nice to have an automatic procedure for choosing good
-# values for depth and threshold.
+# SweepSurface helps to choose depth and threshold by evaluating many
+# values at once.
+
+# Tables whose weight is below this are not surface states.
+MIN_WEIGHT = 1e-9
+
+# Return the number of ions from each surface counted for the given depth
+# in a slab of Ni ions.
+def IonCount(depth, Ni):
+    if isinstance(depth, float) and 0.0 < depth < 1.0:
+        return max(1, int(math.ceil(depth*Ni)))
+    return min(int(depth), Ni)
+
+# Return the weight of each ion, shape (..., Ni), and the weight 'sum' of
+# each table, shape (...), for the ion tables given as an array with shape
+# (..., Ni+1, numOrbitals).
+def IonWeights(tables, strategy='SumSquare'):
+    Ni = tables.shape[-2] - 1
+    if strategy == 'SumSquare':
+        if tables.shape[-1] > 1:
+            ions = tables[..., :Ni, :-1]
+            weights = np.einsum('...ij,...ij->...i', ions, ions)
+        else:
+            weights = tables[..., :Ni, 0]**2
+        return weights, weights.sum(axis=-1)
+    elif strategy == 'Sum':
+        return tables[..., :Ni, -1], abs(tables[..., Ni, -1])
+    print("error: invalid strategy " + str(strategy))
+    sys.exit(2)
+
+# Return 1/sum where sum >= MIN_WEIGHT and 0 elsewhere.
+def InverseWeight(sumAll):
+    weighted = sumAll >= MIN_WEIGHT
+    return np.where(weighted, 1.0/np.where(weighted, sumAll, 1.0), 0.0)
+
+# Return the weights (sumTop, sumBottom, sum) of the ion tables given as
+# an array with shape (..., Ni+1, numOrbitals), such as procar.projections,
+# as arrays with the leading shape of tables, e.g. (Nk, Nb, numTables).
+def SurfaceWeights(tables, depth, strategy='SumSquare'):
+    weights, sumAll = IonWeights(tables, strategy)
+    Ni = weights.shape[-1]
+    n = IonCount(depth, Ni)
+    return weights[..., :n].sum(axis=-1), weights[..., Ni-n:].sum(axis=-1), sumAll
+
+# Classify the ion tables given as an array with shape (..., Ni+1,
+# numOrbitals). Return (surface, top, bottom), each with the leading shape
+# of tables: surface is true for the tables that are surface states and
+# top and bottom are the fractions |sumTop/sum| and |sumBottom/sum| (0 if
+# the table has no weight). If log is true, print the surface states.
+def ClassifySurface(tables, depth, threshold, strategy='SumSquare', log=False):
+    sumTop, sumBottom, sumAll = SurfaceWeights(tables, depth, strategy)
+    # note that sum(Top, Bottom, All) >= 0
+    scale = InverseWeight(sumAll)
+    top, bottom = abs(sumTop*scale), abs(sumBottom*scale)
+    surface = (top > threshold) | (bottom > threshold)
+    if log:
+        for index in np.argwhere(surface):
+            print('surface state ' + str(tuple(index + 1)) + ' top: ' +
+                  str(sumTop[tuple(index)]) + ' bottom: ' +
+                  str(sumBottom[tuple(index)]) + ' total: ' +
+                  str(sumAll[tuple(index)]))
+    return surface, top, bottom
+
+# Classify the k-point entries yielded by entries, such as a
+# parseProcar.StreamPROCAR, as they are read. For each entry yield (k,
+# kCoords, energies, surface, top, bottom), where surface, top and bottom
+# have shape (Nb,): a band is a surface state if any of its tables is, and
+# top and bottom are the largest fractions over its tables.
+def StreamSurface(entries, depth, threshold, strategy='SumSquare'):
+    for k, kCoords, weight, energies, occupations, tables in entries:
+        surface, top, bottom = ClassifySurface(tables, depth, threshold,
+                                               strategy)
+        yield (k, kCoords, energies, surface.any(axis=-1), top.max(axis=-1),
+               bottom.max(axis=-1))
+
+# Evaluate the classification of ClassifySurface for every pair of the
+# given depths and thresholds at once. The weights are summed inward from
+# both surfaces a single time, so the cost hardly depends on the number of
+# pairs. Return (counts, stability), both with shape (len(depths),
+# len(thresholds)): counts is the number of tables that are surface
+# states, and stability is the smallest Jaccard index |A & B|/|A | B|
+# between the set A of those tables and the set B found with a
+# neighbouring depth or threshold in the lists (1 if both are empty), so
+# a stability close to 1 means the choice is not sensitive to small
+# changes of the parameters.
 #
-# strategy = 'SquareSum' or 'Sum' - are PROCAR values squared before
-# summation, or not?
-def MarkSurfaceStates(procar, depth, threshold, strategy='SumSquare'):
-    for kPoint in procar.kPoints:
-        for band in kPoint.bands:
-            marked = False
-            for table in band.tables:
-                isSurf, top, bottom = IsSurface(table, depth, threshold, strategy)
-                band.top.append(top)
-                band.bottom.append(bottom)
-                if isSurf:
-                    table.surface = True
-                    marked = True
-                else:
-                    table.surface = False
-            if marked:
-                print("marked: kPoint " + str(kPoint.kId) + " band " + str(band.bandId))
+# For one count per (k-point, band) of a non-collinear PROCAR, pass the
+# total tables only: procar.projections[:, :, :1].
+def SweepSurface(tables, depths, thresholds, strategy='SumSquare'):
+    weights, sumAll = IonWeights(tables, strategy)
+    Ni = weights.shape[-1]
+    weights = weights.reshape(-1, Ni)
+    scale = InverseWeight(sumAll.reshape(-1))[:, np.newaxis]
+    # column n is the weight of the n ions nearest each surface, from 0
+    zero = np.zeros((len(weights), 1))
+    fromTop = np.hstack([zero, np.cumsum(weights, axis=-1)])
+    fromBottom = np.hstack([zero, np.cumsum(weights[:, ::-1], axis=-1)])
+    counted = [IonCount(depth, Ni) for depth in depths]
+    # larger of the top and bottom fractions, shape (len(depths), numTables)
+    fraction = np.maximum(abs(fromTop[:, counted]*scale),
+                          abs(fromBottom[:, counted]*scale)).T
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    counts = CountAbove(fraction, thresholds)
+    stability = np.ones(counts.shape)
+    # neighbouring thresholds: the set for the higher one is a subset of
+    # the set for the lower one
+    if len(thresholds) > 1:
+        higher = thresholds[1:] > thresholds[:-1]
+        small = np.where(higher, counts[:, 1:], counts[:, :-1])
+        large = np.where(higher, counts[:, :-1], counts[:, 1:])
+        jaccard = Jaccard(small, large)
+        stability[:, 1:] = np.minimum(stability[:, 1:], jaccard)
+        stability[:, :-1] = np.minimum(stability[:, :-1], jaccard)
+    # neighbouring depths: a table is in both sets if its smaller
+    # fraction is above the threshold
+    if len(counted) > 1:
+        both = CountAbove(np.minimum(fraction[1:], fraction[:-1]), thresholds)
+        jaccard = Jaccard(both, counts[1:] + counts[:-1] - both)
+        stability[1:] = np.minimum(stability[1:], jaccard)
+        stability[:-1] = np.minimum(stability[:-1], jaccard)
+    return counts, stability
+
+# Return the number of entries of each row of values (shape (m, n)) that
+# are above each threshold, with shape (m, len(thresholds)).
+def CountAbove(values, thresholds):
+    values = np.sort(values, axis=-1)
+    n = values.shape[-1]
+    return np.array([n - np.searchsorted(row, thresholds, side='right')
+                     for row in values])
+
+def Jaccard(intersection, union):
+    return np.where(union > 0, intersection/np.maximum(union, 1.0), 1.0)
+
+# Print the result of SweepSurface as a table with one row per depth and
+# one column per threshold, each entry giving count/stability.
+def PrintSweep(depths, thresholds, counts, stability):
+    print("depth \\ threshold " + " ".join("%12g" % t for t in thresholds))
+    for depth, row, stable in zip(depths, counts, stability):
+        print("%17s " % depth + " ".join("%6d/%5.3f" % (c, s)
+                                         for c, s in zip(row, stable)))
+
+# For each ion table in procar, if the quantities in the 'total' column are
+# concentrated close enough to the surface then mark the table as a surface
+# state by adding the property table.surface=True; otherwise set
+# table.surface=False. For a given (kpoint, band) pair, if any tables have
+# the surface property set to true, set band.surface=True. The fractions
+# top and bottom of each table are appended to band.top and band.bottom.
+# Return (surface, top, bottom) as ClassifySurface does for
+# procar.projections, with shape (Nk, Nb, numTables).
+def MarkSurfaceStates(procar, depth, threshold, strategy='SumSquare', log=False):
+    surface, top, bottom = ClassifySurface(procar.projections, depth,
+                                           threshold, strategy)
+    for k, kPoint in enumerate(procar.kPoints):
+        for b, band in enumerate(kPoint.bands):
+            band.top.extend(top[k, b].tolist())
+            band.bottom.extend(bottom[k, b].tolist())
+            for table, isSurf in zip(band.tables, surface[k, b].tolist()):
+                table.surface = isSurf
+            if surface[k, b].any():
+                if log:
+                    print("marked: kPoint " + str(k+1) + " band " + str(b+1))
                 band.surface = True
+    return surface, top, bottom
 
-# Return true if the given table meets the requirements for a surface state
-# as described in the documentation for MarkSurfaceStates. Return false
-# otherwise.
+# Return (isSurface, top, bottom) for one ion table, as MarkSurfaceStates
+# does for each table.
 def IsSurface(table, depth, threshold, strategy):
-    if strategy not in ['SumSquare', 'Sum']:
-        print("error: invalid strategy")
-        return False, 0.0, 0.0
-    Ni = len(table.ions)
-    sumTop, sumBottom, sumAll = 0.0, 0.0, 0.0
-    # iterate over ions close to the top/bottom
-    for i in range(1, Ni+1): 
-        if strategy == 'SumSquare':
-            sumAll += table.Ion(i).SquareSum()
-        if i <= depth:
-            # only here if i = 1, 2, ..., depth
-            if strategy == 'SumSquare':
-                sumTop += table.Ion(i).SquareSum()
-                sumBottom += table.Ion(Ni - i + 1).SquareSum()
-            elif strategy == 'Sum':
-                sumTop += table.Ion(i).tot
-                sumBottom += table.Ion(Ni - i + 1).tot
-    if strategy == 'Sum':
-        sumAll = abs(table.tot.tot)
-    # surface weight above threshold?
-    # note that sum(Top, Bottom, All) >= 0
-    if sumAll < 1e-9:
-        # total weight too small; assume not surface state
-        return False, 0.0, 0.0
-    if abs(sumTop/sumAll) > threshold or abs(sumBottom/sumAll) > threshold:
-        # seems to be a surface state
-        print('top: ' + str(sumTop) + ' bottom: ' + str(sumBottom) + ' total: ' + str(sumAll))
-        return True, abs(sumTop/sumAll), abs(sumBottom/sumAll)
-    # not above threshold
-    return False, abs(sumTop/sumAll), abs(sumBottom/sumAll)
+    surface, top, bottom = ClassifySurface(table.values, depth, threshold,
+                                           strategy)
+    return bool(surface), float(top), float(bottom)
 
 if __name__ == "__main__":
     # test - TODO arguments?
     with open('PROCAR', 'r') as f:
         procar = parseProcar.PROCAR(f, nonCol=True, lmDecomposed=True, storeIds=True)
-        MarkSurfaceStates(procar, 3, 0.99)
+        MarkSurfaceStates(procar, 3, 0.99, log=True)
@@ -1,4 +1,8 @@
+import os
+import shutil
+import tempfile
 import unittest
+import numpy
 import eigenval2foo
 
 class FindSymmetryPoints(unittest.TestCase):
@@ -15,5 +19,74 @@ class FindSymmetryPoints(unittest.TestCase):
             kVal = self.e.kpoints[expectedIndices[i]]
             self.assertEqual(kExpected, kVal)
 
+class RelaxCurves(unittest.TestCase):
+    def setUp(self):
+        e = eigenval2foo.EIGENVAL("TEST_EIGENVAL")
+        self.cset = e.points[0][40:52, :30].tolist()
+
+    def direct_relax(self, cset, tol):
+        # try each permute_cset in turn, comparing the whole cset_cost
+        cost = eigenval2foo.cset_cost(cset)
+        updated = True
+        while updated:
+            updated = False
+            for j in range(len(cset) - 1):
+                for i in range(len(cset[0]) - 1):
+                    new_cset = eigenval2foo.permute_cset(cset, i, j)
+                    new_cost = eigenval2foo.cset_cost(new_cset)
+                    if new_cost < cost - tol:
+                        cset, cost = new_cset, new_cost
+                        updated = True
+        return cset
+
+    def test_matches_direct_relax(self):
+        relaxed = eigenval2foo.relax_cset(self.cset)
+        expected = self.direct_relax(self.cset, 1e-10)
+        for curve, expectedCurve in zip(relaxed, expected):
+            for p, q in zip(curve, expectedCurve):
+                self.assertAlmostEqual(p, q)
+
+    def test_max_rounds(self):
+        once = eigenval2foo.relax_cset(self.cset, max_rounds = 1)
+        relaxed = eigenval2foo.relax_cset(self.cset)
+        self.assertTrue(eigenval2foo.cset_cost(relaxed)
+                        <= eigenval2foo.cset_cost(once)
+                        < eigenval2foo.cset_cost(self.cset))
+
+class Cache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "EIGENVAL")
+        shutil.copy("TEST_EIGENVAL", self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assertSameData(self, a, b):
+        self.assertEqual(a.kpoints, b.kpoints)
+        self.assertEqual(a.weights, b.weights)
+        self.assertEqual(a.symIndices, b.symIndices)
+        self.assertTrue(numpy.array_equal(a.points, b.points))
+        self.assertEqual((a.minEnergy, a.maxEnergy), (b.minEnergy, b.maxEnergy))
+
+    def test_cache(self):
+        # no cache is written by default
+        parsed = eigenval2foo.EIGENVAL(self.path)
+        self.assertFalse(os.path.exists(self.path + eigenval2foo.CACHE_SUFFIX))
+        first = eigenval2foo.EIGENVAL(self.path, cache=True)
+        self.assertTrue(os.path.exists(self.path + eigenval2foo.CACHE_SUFFIX))
+        self.assertSameData(first, parsed)
+        self.assertSameData(eigenval2foo.EIGENVAL(self.path, cache=True), parsed)
+        # a stale cache is rebuilt
+        with open(self.path) as f:
+            lines = f.readlines()
+        lines[8] = lines[8].replace("-", "+", 1)
+        with open(self.path, "w") as f:
+            f.writelines(lines)
+        os.utime(self.path, (0, 0))
+        changed = eigenval2foo.EIGENVAL(self.path, cache=True)
+        self.assertSameData(changed, eigenval2foo.EIGENVAL(self.path))
+        self.assertNotEqual(changed.points[0][0][0], parsed.points[0][0][0])
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import fit4bands
+
+class Jacobian(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.p = np.array(fit4bands.get_p_est())
+        self.kList = [tuple(k) for k in rng.uniform(-0.05, 0.05, (20, 3))]
+        self.kList.append((0.3, 0.0, 0.0))     # ignored: |k| > 0.1
+        p_true = self.p * (1 + 0.1*rng.uniform(-1, 1, len(self.p)))
+        self.energyList = [list(fit4bands.H_eigen(p_true, k)) for k in self.kList]
+        self.kC, self.energies = fit4bands.fitData(self.kList, self.energyList)
+
+    def test_fit_data(self):
+        self.assertEqual(self.kC.shape, (20, 3))
+        self.assertEqual(self.energies.shape, (20, 4))
+        for i in [0, 7, 19]:
+            self.assertTrue(np.allclose(
+                self.kC[i], fit4bands.rhombRecipToCartesian(self.kList[i])))
+        err = fit4bands.H_err(self.p, self.kC, self.energies)
+        for i in range(20):
+            expected = np.linalg.norm(fit4bands.H_eigen(self.p, self.kList[i]) -
+                                      self.energyList[i])
+            self.assertAlmostEqual(err[i], expected, places=10)
+
+    def test_matches_finite_differences(self):
+        J = np.array(fit4bands.H_jac(self.p, self.kC, self.energies))
+        self.assertEqual(J.shape, (20, 12))
+        for j in range(len(self.p)):
+            h = 1e-6*max(1.0, abs(self.p[j]))
+            dp = np.zeros(len(self.p))
+            dp[j] = h
+            up = fit4bands.H_err(self.p + dp, self.kC, self.energies)
+            down = fit4bands.H_err(self.p - dp, self.kC, self.energies)
+            fd = (up - down) / (2*h)
+            self.assertTrue(np.allclose(J[:, j], fd, rtol=1e-4,
+                                        atol=1e-6*abs(J).max()))
+
+    def test_degenerate_eigenvalues(self):
+        # any basis of a degenerate pair gives the same derivatives
+        vals = np.array([[-1.0, -1.0, 2.0, 2.0]])
+        rng = np.random.RandomState(1)
+        dH = rng.randn(1, 1, 4, 4) + 1j*rng.randn(1, 1, 4, 4)
+        dH = dH + np.conj(np.swapaxes(dH, -1, -2))
+        c, s = np.cos(0.7), np.sin(0.7)
+        mix = np.eye(4, dtype=np.complex128)
+        mix[:2, :2] = [[c, -s], [s, c]]
+        dCoeffs = np.ones((1, 1, 1))
+        dE = fit4bands.eigenvalDerivatives(vals, np.eye(4)[np.newaxis],
+                                           dH[0], dCoeffs)
+        dE_mixed = fit4bands.eigenvalDerivatives(vals, mix[np.newaxis],
+                                                 dH[0], dCoeffs)
+        self.assertTrue(np.allclose(dE, dE_mixed))
+        diagonal = np.diagonal(dH[0, 0]).real
+        self.assertTrue(np.allclose(dE[0, 0], [diagonal[:2].mean()]*2 +
+                                    [diagonal[2:].mean()]*2))
+
+class MultiStart(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.dir, "fit4bands.checkpoint")
+        rng = np.random.RandomState(2)
+        self.p = np.array(fit4bands.get_p_est())
+        kList = rng.uniform(-0.05, 0.05, (30, 3))
+        p_true = self.p * (1 + 0.05*rng.uniform(-1, 1, len(self.p)))
+        energyList = [fit4bands.H_eigen(p_true, k) for k in kList]
+        self.kC, self.energies = fit4bands.fitData(kList, energyList)
+        self.starts = fit4bands.startingPoints(self.p, 4, 0.1, seed=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_latin_hypercube(self):
+        u = fit4bands.latinHypercube(5, 3, np.random.RandomState(0))
+        for d in range(3):
+            self.assertEqual(sorted((5*u[:, d]).astype(int)), list(range(5)))
+        self.assertTrue(np.array_equal(self.starts[0], self.p))
+        self.assertTrue(np.all(abs(self.starts/self.p - 1.0) <= 0.1))
+
+    def test_checkpoint_resume(self):
+        fits = fit4bands.multiStartFit(self.starts, self.kC, self.energies,
+                                       jobs=2, checkpointFileName=self.checkpoint)
+        self.assertEqual(sorted(fit["start"] for fit in fits), [0, 1, 2, 3])
+        costs = [fit["cost"] for fit in fits]
+        self.assertEqual(costs, sorted(costs))
+        self.assertTrue(costs[0] < 1e-8)
+        # interrupted after one fit and part of another
+        with open(self.checkpoint) as f:
+            lines = f.readlines()
+        with open(self.checkpoint, "w") as f:
+            f.write(lines[0] + lines[1][:20])
+        resumed = fit4bands.multiStartFit(self.starts, self.kC, self.energies,
+                                          checkpointFileName=self.checkpoint)
+        self.assertEqual([fit["start"] for fit in resumed],
+                         [fit["start"] for fit in fits])
+        self.assertTrue(np.allclose([fit["cost"] for fit in resumed], costs))
+        with open(self.checkpoint) as f:
+            self.assertEqual(f.readline(), lines[0])
+            self.assertEqual(len(f.readlines()), 3)
+        # a checkpoint from other starting points is refused
+        other = fit4bands.startingPoints(self.p, 4, 0.2, seed=0)
+        self.assertRaises(SystemExit, fit4bands.multiStartFit, other, self.kC,
+                          self.energies, checkpointFileName=self.checkpoint)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import parseProcar
+
+# Write a PROCAR with random entries, in the format VASP uses, to path.
+# Return (k, weights, energies, occupations, tables) with the values written;
+# tables has shape (Nk, Nb, numTables, Ni+1, 10).
+def WriteProcar(path, Nk, Nb, Ni, nonCol, seed=0):
+    rng = np.random.RandomState(seed)
+    numTables = 4 if nonCol else 1
+    k = np.round(rng.uniform(-0.5, 0.5, (Nk, 3)), 8)
+    weights = np.round(np.full(Nk, 1.0/Nk), 8)
+    energies = np.round(np.sort(rng.uniform(-5.0, 5.0, (Nk, Nb))), 8)
+    occupations = np.round(rng.uniform(0.0, 1.0, (Nk, Nb)), 8)
+    tables = np.round(rng.uniform(-1.0, 1.0, (Nk, Nb, numTables, Ni+1, 10)), 3)
+    with open(path, 'w') as f:
+        f.write("PROCAR lm decomposed\n")
+        f.write("# of k-points:  %d         # of bands:  %d         # of ions:  %d\n\n"
+                % (Nk, Nb, Ni))
+        for kId in range(Nk):
+            f.write(" k-point %4d :   %11.8f%11.8f%11.8f     weight = %10.8f\n\n"
+                    % ((kId + 1,) + tuple(k[kId]) + (weights[kId],)))
+            for b in range(Nb):
+                f.write("band %5d # energy %14.8f # occ. %12.8f\n\n"
+                        % (b + 1, energies[kId, b], occupations[kId, b]))
+                f.write("ion      s     py     pz     px    dxy    dyz    dz2    dxz    dx2    tot\n")
+                for t in range(numTables):
+                    for i in range(Ni + 1):
+                        label = "tot" if i == Ni else "%3d" % (i + 1)
+                        f.write(label + "".join(" %6.3f" % x
+                                                for x in tables[kId, b, t, i]) + "\n")
+                f.write("\n")
+            f.write("\n")
+    return k, weights, energies, occupations, tables
+
+class ProcarTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "PROCAR")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+class ColumnarProcar(ProcarTestCase):
+    def test_arrays(self):
+        k, weights, energies, occupations, tables = \
+            WriteProcar(self.path, 3, 4, 5, nonCol=True)
+        with open(self.path) as f:
+            procar = parseProcar.PROCAR(f, nonCol=True)
+        self.assertEqual((procar.Nk, procar.Nb, procar.Ni), (3, 4, 5))
+        self.assertEqual(procar.projections.shape, (3, 4, 4, 6, 10))
+        self.assertTrue(np.array_equal(procar.kCoords, k))
+        self.assertTrue(np.array_equal(procar.kWeights, weights))
+        self.assertTrue(np.array_equal(procar.energies, energies))
+        self.assertTrue(np.array_equal(procar.occupations, occupations))
+        self.assertTrue(np.array_equal(procar.projections, tables))
+
+    def test_views(self):
+        k, weights, energies, occupations, tables = \
+            WriteProcar(self.path, 2, 3, 4, nonCol=True)
+        with open(self.path) as f:
+            procar = parseProcar.PROCAR(f, nonCol=True)
+        kPoint = procar.KPoint(2)
+        self.assertEqual((kPoint.kId, kPoint.kx, kPoint.weight),
+                         (2, k[1, 0], weights[1]))
+        band = kPoint.Band(3)
+        self.assertEqual((band.bandId, band.energy, band.occ),
+                         (3, energies[1, 2], occupations[1, 2]))
+        self.assertIs(band, procar.kPoints[1].bands[2])
+        table = band.Table(4)
+        self.assertEqual(len(table.ions), 4)
+        ion = table.Ion(2)
+        self.assertEqual((ion.ionId, ion.s, ion.px, ion.dx2, ion.tot),
+                         (2, tables[1, 2, 3, 1, 0], tables[1, 2, 3, 1, 3],
+                          tables[1, 2, 3, 1, 8], tables[1, 2, 3, 1, 9]))
+        self.assertEqual(table.tot.tot, tables[1, 2, 3, 4, 9])
+        self.assertAlmostEqual(ion.SquareSum(),
+                               (tables[1, 2, 3, 1, :9]**2).sum(), places=12)
+
+    def test_total_only(self):
+        tables = WriteProcar(self.path, 2, 2, 3, nonCol=False)[4]
+        with open(self.path) as f:
+            procar = parseProcar.PROCAR(f, nonCol=False, lmDecomposed=False,
+                                        storeIds=False, dtype=np.float32)
+        self.assertEqual(procar.projections.shape, (2, 2, 1, 4, 1))
+        self.assertEqual(procar.projections.dtype, np.float32)
+        ion = procar.KPoint(1).Band(2).Table(1).Ion(3)
+        self.assertAlmostEqual(ion.tot, tables[0, 1, 0, 2, 9], places=6)
+        self.assertFalse(hasattr(ion, 'ionId'))
+        self.assertRaises(AttributeError, getattr, ion, 's')
+
+    def test_parallel(self):
+        WriteProcar(self.path, 7, 3, 4, nonCol=True)
+        with open(self.path) as f:
+            serial = parseProcar.PROCAR(f, nonCol=True)
+            parallel = parseProcar.PROCAR(f, nonCol=True, jobs=3)
+        for name in ['kCoords', 'kWeights', 'energies', 'occupations',
+                     'projections']:
+            self.assertTrue(np.array_equal(getattr(parallel, name),
+                                           getattr(serial, name)))
+        self.assertEqual(parallel.KPoint(5).Band(2).Table(3).Ion(1).py,
+                         serial.KPoint(5).Band(2).Table(3).Ion(1).py)
+        self.assertFalse(os.path.exists(self.path + parseProcar.INDEX_SUFFIX))
+
+class StreamProcar(ProcarTestCase):
+    def test_matches_full_parse(self):
+        WriteProcar(self.path, 3, 2, 4, nonCol=True)
+        with open(self.path) as f:
+            procar = parseProcar.PROCAR(f, nonCol=True)
+            stream = parseProcar.StreamPROCAR(f, nonCol=True, dtype=np.float32)
+            self.assertEqual((stream.Nk, stream.Nb, stream.Ni), (3, 2, 4))
+            for i in range(2):
+                entries = list(stream)
+                self.assertEqual([entry[0] for entry in entries], [0, 1, 2])
+                for k, kCoords, weight, energies, occupations, tables in entries:
+                    self.assertTrue(np.array_equal(kCoords, procar.kCoords[k]))
+                    self.assertEqual(weight, procar.kWeights[k])
+                    self.assertTrue(np.array_equal(energies, procar.energies[k]))
+                    self.assertEqual(tables.dtype, np.float32)
+                    self.assertTrue(np.array_equal(
+                        tables, procar.projections[k].astype(np.float32)))
+
+class LazyProcar(ProcarTestCase):
+    def test_matches_full_parse(self):
+        WriteProcar(self.path, 3, 4, 5, nonCol=True)
+        with open(self.path) as f:
+            procar = parseProcar.PROCAR(f, nonCol=True)
+        with parseProcar.LazyPROCAR(self.path, nonCol=True) as lazy:
+            self.assertEqual((lazy.Nk, lazy.Nb, lazy.Ni), (3, 4, 5))
+            for kId in [3, 1]:
+                self.assertEqual(lazy.KPoint(kId).ky, procar.KPoint(kId).ky)
+                for bandId in [4, 1]:
+                    band = lazy.KPoint(kId).Band(bandId)
+                    self.assertEqual(band.energy, procar.KPoint(kId).Band(bandId).energy)
+                    self.assertTrue(np.array_equal(band.values,
+                                                   procar.projections[kId-1, bandId-1]))
+            self.assertEqual(len(lazy.kPoints[1].bands), 4)
+        self.assertTrue(lazy.file.closed)
+
+    def test_index_cache(self):
+        WriteProcar(self.path, 2, 3, 2, nonCol=False)
+        indexPath = self.path + parseProcar.INDEX_SUFFIX
+        with parseProcar.LazyPROCAR(self.path, nonCol=False, cacheIndex=False):
+            pass
+        self.assertFalse(os.path.exists(indexPath))
+        with parseProcar.LazyPROCAR(self.path, nonCol=False):
+            pass
+        self.assertTrue(os.path.exists(indexPath))
+        # a stale index is rebuilt
+        k = WriteProcar(self.path, 4, 3, 2, nonCol=False, seed=1)[0]
+        os.utime(self.path, (0, 0))
+        with parseProcar.LazyPROCAR(self.path, nonCol=False) as lazy:
+            self.assertEqual(lazy.bandOffsets.shape, (4, 3))
+            self.assertEqual(lazy.KPoint(4).kz, k[3, 2])
+
+if __name__ == "__main__":
+    unittest.main()
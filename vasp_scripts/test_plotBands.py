@@ -0,0 +1,58 @@
+import os
+import unittest
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import plotBands
+from test_parseProcar import ProcarTestCase, WriteProcar
+
+# Return a new Axes on a headless Figure.
+def NewAxes():
+    fig = Figure(figsize=(4, 3), dpi=100)
+    FigureCanvasAgg(fig)
+    return fig.add_subplot(111)
+
+class DrawBands(unittest.TestCase):
+    def setUp(self):
+        # two bands, one k-point far away from the 50 close ones
+        self.kx = np.append(np.linspace(0.0, 1e-4, 50), 1.0)
+        self.energy = np.zeros((51, 2))
+        self.energy[:, 1] = 1.0
+        self.top = np.full((51, 2), 0.2)
+        self.top[10, 0] = 0.9
+        self.bottom = np.zeros((51, 2))
+        self.surf = np.zeros((51, 2), dtype=bool)
+
+    def test_keeps_largest_marker(self):
+        ax = NewAxes()
+        plotBands.DrawBands(ax, self.kx, self.energy, self.top, self.bottom,
+                            self.surf)
+        # the bottom weights are all below MIN_MARKER_SIZE
+        white, black = ax.collections[1:]
+        self.assertEqual(len(black.get_offsets()), 0)
+        # one marker for each band in the dense cell, one for each band at
+        # kx = 1
+        offsets = np.asarray(white.get_offsets())
+        self.assertEqual(len(offsets), 4)
+        self.assertEqual(sorted(white.get_sizes().tolist()),
+                         [20.0, 20.0, 20.0, 90.0])
+
+    def test_no_downsampling(self):
+        ax = NewAxes()
+        plotBands.DrawBands(ax, self.kx, self.energy, self.top, self.bottom,
+                            self.surf, markerCell=0)
+        self.assertEqual(len(ax.collections[1].get_offsets()), 102)
+
+class RenderBands(ProcarTestCase):
+    def test_render(self):
+        WriteProcar(self.path, 4, 3, 5, nonCol=True)
+        arrays = plotBands.SurfaceBands(self.path, 2, 0.25)
+        for name in ["bands.png", "bands.pdf"]:
+            outFileName = os.path.join(self.dir, name)
+            plotBands.RenderBands(outFileName, *arrays)
+            self.assertTrue(os.path.getsize(outFileName) > 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+import numpy as np
+import parseProcar
+import surface
+from test_parseProcar import ProcarTestCase, WriteProcar
+
+# Return (sumTop, sumBottom, sum) for one ion table (shape (Ni+1, 10)) by
+# looping over the ions, as the per-object implementation did.
+def DirectWeights(table, depth, strategy):
+    Ni = len(table) - 1
+    sumTop, sumBottom, sumAll = 0.0, 0.0, 0.0
+    for i in range(1, Ni+1):
+        if strategy == 'SumSquare':
+            sumAll += (table[i-1, :-1]**2).sum()
+        if i <= depth:
+            if strategy == 'SumSquare':
+                sumTop += (table[i-1, :-1]**2).sum()
+                sumBottom += (table[Ni-i, :-1]**2).sum()
+            else:
+                sumTop += table[i-1, -1]
+                sumBottom += table[Ni-i, -1]
+    if strategy == 'Sum':
+        sumAll = abs(table[Ni, -1])
+    return sumTop, sumBottom, sumAll
+
+class SurfaceWeights(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.tables = rng.uniform(-1.0, 1.0, (3, 4, 2, 7, 10))
+
+    def test_matches_direct_sums(self):
+        for strategy in ['SumSquare', 'Sum']:
+            top, bottom, total = surface.SurfaceWeights(self.tables, 2, strategy)
+            self.assertEqual(top.shape, (3, 4, 2))
+            for index in np.ndindex(top.shape):
+                expected = DirectWeights(self.tables[index], 2, strategy)
+                self.assertTrue(np.allclose((top[index], bottom[index],
+                                             total[index]), expected))
+
+    def test_fractional_depth(self):
+        self.assertEqual(surface.IonCount(0.3, 6), 2)
+        self.assertEqual(surface.IonCount(4, 6), 4)
+        self.assertEqual(surface.IonCount(10, 6), 6)
+        fraction = surface.SurfaceWeights(self.tables, 0.3)
+        count = surface.SurfaceWeights(self.tables, 2)
+        for a, b in zip(fraction, count):
+            self.assertTrue(np.array_equal(a, b))
+
+    def test_classify(self):
+        tables = np.zeros((3, 5, 10))
+        tables[0, 0, 0] = 1.0       # all weight on the top ion
+        tables[1, 2, 0] = 1.0       # all weight in the middle
+        # table 2 has no weight
+        surf, top, bottom = surface.ClassifySurface(tables, 1, 0.5)
+        self.assertEqual(surf.tolist(), [True, False, False])
+        self.assertEqual(top.tolist(), [1.0, 0.0, 0.0])
+        self.assertEqual(bottom.tolist(), [0.0, 0.0, 0.0])
+
+class Sweep(unittest.TestCase):
+    def test_matches_classify(self):
+        rng = np.random.RandomState(1)
+        tables = rng.uniform(-1.0, 1.0, (6, 5, 2, 8, 10))**4
+        depths = [0, 1, 2, 0.4, 4]
+        thresholds = [0.2, 0.3, 0.35, 0.5]
+        counts, stability = surface.SweepSurface(tables, depths, thresholds)
+        sets = [[set(map(tuple, np.argwhere(surface.ClassifySurface(
+                     tables, depth, threshold)[0])))
+                 for threshold in thresholds] for depth in depths]
+        for d in range(len(depths)):
+            for t in range(len(thresholds)):
+                self.assertEqual(counts[d, t], len(sets[d][t]))
+                jaccard = [1.0]
+                for dd, tt in [(d-1, t), (d+1, t), (d, t-1), (d, t+1)]:
+                    if 0 <= dd < len(depths) and 0 <= tt < len(thresholds):
+                        a, b = sets[d][t], sets[dd][tt]
+                        jaccard.append(float(len(a & b))/len(a | b)
+                                       if a | b else 1.0)
+                self.assertAlmostEqual(stability[d, t], min(jaccard))
+        # no ions within depth 0, so no surface states
+        self.assertTrue((counts[0] == 0).all())
+        self.assertTrue(counts[1:, 0].min() > 0)
+
+class StreamSurface(ProcarTestCase):
+    def test_matches_mark(self):
+        WriteProcar(self.path, 4, 3, 5, nonCol=True)
+        with open(self.path) as f:
+            procar = parseProcar.PROCAR(f, nonCol=True)
+            surface.MarkSurfaceStates(procar, 2, 0.25)
+            results = list(surface.StreamSurface(
+                parseProcar.StreamPROCAR(f, nonCol=True), 2, 0.25))
+        self.assertEqual(len(results), 4)
+        for k, kCoords, energies, surf, top, bottom in results:
+            bands = procar.kPoints[k].bands
+            self.assertEqual(energies.tolist(), [b.energy for b in bands])
+            self.assertEqual(surf.tolist(),
+                             [getattr(b, 'surface', False) for b in bands])
+            self.assertEqual(top.tolist(), [max(b.top) for b in bands])
+            self.assertEqual(bottom.tolist(), [max(b.bottom) for b in bands])
+
+if __name__ == "__main__":
+    unittest.main()
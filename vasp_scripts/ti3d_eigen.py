@@ -19,9 +19,11 @@
 #     OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #     THE SOFTWARE.
 #
-import sys, json, math
+import sys, os, json, math, multiprocessing
+from collections import OrderedDict
 import numpy as np
 from scipy import linalg
+from scipy.optimize import linear_sum_assignment
 import matplotlib.pyplot as plt
 
 # 3D model notation for Gamma matrices
@@ -52,20 +54,97 @@ Gamma5 = np.array([[1, 0, 0, 0],
 
 # Construct a Hermitian matrix contaning the upper triangular part given
 # by M. The diagonal elements of M must be real and the elements below
-# the diagonal must contain all zeros.
+# the diagonal must contain all zeros. M may also be a stack of such
+# matrices with shape (N, d, d).
 def makeHermitian(M):
-    return M + M.T.conj() - np.diag(M.diagonal())
+    idx = np.arange(M.shape[-1])
+    diag = np.zeros_like(M)
+    diag[..., idx, idx] = M[..., idx, idx]
+    return M + np.swapaxes(M, -1, -2).conj() - diag
 
-# Parse command-line arguments calcType, kpointsFileName, outFileName
+# Convert in_k, which is either a single k-point or an (N, 3) array of
+# k-points, to an array k with shape (3, N) so that k[0], k[1] and k[2] are
+# arrays over all the points. Also return True if in_k was a single k-point
+# (in which case the Hamiltonian should return a single matrix).
+def kColumns(in_k):
+    k = np.asarray(in_k, dtype=np.float64)
+    single = (k.ndim == 1)
+    return np.atleast_2d(k).T, single
+
+# Multiply the constant matrix G by each of the coefficients in c (shape
+# (N,)) to give a stack of matrices with shape (N, d, d).
+def scaleMatrix(c, G):
+    return np.multiply.outer(c, G)
+
+# Combine the entries of one matrix row into an array with shape (N, d).
+# Each entry is either an array with shape (N,) or a scalar.
+def matrixRow(*entries):
+    return np.stack(np.broadcast_arrays(*entries), axis=-1)
+
+usage = """Usage: ti3D_eigen [options] calcType kpointsFileName outFileName
+calcType should be 8band, 4band, or mnk12
+Options:
+    --jobs N        diagonalize k-points in N worker processes (default 1)
+    --format F      output format: text (default) or npy; for npy,
+                    outFileName is a directory of .npy files
+    --kets LO:HI    with --format npy, store only the eigenkets of bands
+                    LO to HI-1 (LO:LO stores none; default all); counted
+                    from 0 like --bands and within its range
+    --eigen E       full (default): eigenvalues and eigenkets;
+                    vals: eigenvalues only
+    --bands LO:HI   only find bands LO to HI-1 (counting from 0)
+    --window A:B    only find eigenvalues with A < E <= B
+    --connect C     how bands are connected between k-points in the plot:
+                    sorted (default) by eigenvalue index, or overlap by the
+                    overlap of the eigenkets, so that crossings are kept
+                    (not with --eigen vals or --window); with --format npy
+                    the order is written to bandOrder.npy"""
+
+# Options accepted on the command line.
+knownOptions = ["jobs", "format", "kets", "eigen", "bands", "window", "connect"]
+
+# Split the command-line arguments args into positional arguments and
+# options of the form "--name value". Return (positional, options) where
+# options maps each name to its value (as a string). Return None for the
+# options if an option is not in knownOptions or is missing its value.
+def splitOptions(args, knownOptions):
+    positional, options = [], {}
+    i = 0
+    while i < len(args):
+        if args[i].startswith("--"):
+            name = args[i][2:]
+            if name not in knownOptions or i + 1 >= len(args):
+                return positional, None
+            options[name] = args[i+1]
+            i += 2
+        else:
+            positional.append(args[i])
+            i += 1
+    return positional, options
+
+# Parse command-line arguments calcType, kpointsFileName, outFileName and
+# the options given in usage.
 def parseArgs():
-    if len(sys.argv) != 4:
-        print("Usage: ti3D_eigen calcType kpointsFileName outFileName")
-        print("calcType should be 8band, 4band, or mnk12")
+    positional, options = splitOptions(sys.argv[1:], knownOptions)
+    if (options is None or len(positional) != 3
+            or options.get("format", "text") not in ["text", "npy"]
+            or not validEigenOptions(options)):
+        print(usage)
         sys.exit(2)
-    return sys.argv[1], sys.argv[2], sys.argv[3]
+    return positional[0], positional[1], positional[2], options
 
-# Parse kpoints file
-def getKpoints(kpointsFileName):
+# Parse a range of band indices given as "LO:HI" (LO to HI-1) into a
+# (LO, HI) pair. Return None if s is None.
+def parseRange(s):
+    if s is None:
+        return None
+    lo, hi = s.split(":")
+    return int(lo), int(hi)
+
+# Parse the ranges of a kpoints file in line mode. Return (kNum, kBounds),
+# where kNum is the number of points in each range and kBounds is the list
+# of [start, stop] pairs of the ranges (each a list of 3 floats).
+def getKpointRanges(kpointsFileName):
     # KPOINTS format: ignore lines 0, 2, 3; line 1 = # of points in each range;
     # line 4-5: range 1; line 7-8: range 2; ...
     # k values returned are in 2pi/(lattice constant) units.
@@ -78,11 +157,15 @@ def getKpoints(kpointsFileName):
     kBounds = []
     while lineNum < len(lines):
         # take lineNum and lineNum+1 and convert each to a list of floats
-        start = map(float, lines[lineNum].split(" "))
-        stop = map(float, lines[lineNum+1].split(" "))
+        start = list(map(float, lines[lineNum].split(" ")))
+        stop = list(map(float, lines[lineNum+1].split(" ")))
         kBounds.append([start, stop])
         lineNum += 3
+    return kNum, kBounds
 
+# Parse kpoints file
+def getKpoints(kpointsFileName):
+    kNum, kBounds = getKpointRanges(kpointsFileName)
     kpoints = []
     # iterate over (kStart, kStop) pairs and generate points
     for pair in kBounds:
@@ -94,35 +177,255 @@ def getKpoints(kpointsFileName):
             kpoints.append(point)
     return kpoints
 
-# Return a Hamiltonian function (k -> H_k) of the type specified
-def HamiltonianFn(calcType):
+# Reciprocal lattice vectors (rows) in the units of the k-points given to
+# the Hamiltonians. For the hexagonal Bi2Se3 cell these are (2pi/a_hex,
+# 2pi/a_hex, 2pi/c_hex), with k_x along Gamma-K; mnk12 is tight-binding
+# on a cubic lattice, in 2pi/a units.
+reciprocalLattices = {
+    "hexagonal": np.array([[1.0, 1.0/math.sqrt(3.0), 0.0],
+                           [0.0, 2.0/math.sqrt(3.0), 0.0],
+                           [0.0, 0.0, 1.0]]),
+    "cubic": np.identity(3)}
+
+# Generators of the point groups (Cartesian rotation matrices acting on k).
+# The mirror is x -> -x in both cases.
+pointGroupGenerators = {
+    "C3v": [np.array([[-0.5, -math.sqrt(3.0)/2.0, 0.0],
+                      [math.sqrt(3.0)/2.0, -0.5, 0.0],
+                      [0.0, 0.0, 1.0]]),
+            np.diag([-1.0, 1.0, 1.0])],
+    "C4v": [np.array([[0.0, -1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]]),
+            np.diag([-1.0, 1.0, 1.0])]}
+
+# Lattice and point group of each model, and whether the model is periodic
+# in k (tight-binding) rather than a continuum model. The point group
+# together with time reversal (k -> -k) leaves the spectrum of the model
+# unchanged.
+modelSymmetry = {"8band": ("hexagonal", "C3v", False),
+                 "4band": ("hexagonal", "C3v", False),
+                 "mnk12": ("cubic", "C4v", True)}
+
+# Return the list of operations (Cartesian 3x3 matrices) of the point group
+# with the given name, combined with time reversal k -> -k if timeReversal
+# is True.
+def pointGroup(name, timeReversal=True):
+    generators = list(pointGroupGenerators[name])
+    if timeReversal:
+        generators.append(-np.identity(3))
+    ops = [np.identity(3)]
+    seen = set([tuple(np.round(ops[0], 8).ravel())])
+    # multiply by the generators until no new operations appear
+    i = 0
+    while i < len(ops):
+        for g in generators:
+            R = np.dot(g, ops[i])
+            key = tuple(np.round(R, 8).ravel())
+            if key not in seen:
+                seen.add(key)
+                ops.append(R)
+        i += 1
+    return ops
+
+# Return the Cartesian k-points, shape (n, 3), of the points with
+# fractional coordinates frac in the reciprocal lattice B, each moved by a
+# reciprocal lattice vector into the Wigner-Seitz cell (the first
+# Brillouin zone), which is left unchanged by the point group.
+def wignerSeitzFold(frac, B):
+    k = np.dot(frac - np.round(frac), B)
+    shifts = np.dot(np.indices((3, 3, 3)).reshape(3, -1).T - 1, B)
+    candidates = k[:, np.newaxis, :] + shifts[np.newaxis, :, :]
+    closest = np.argmin(np.sum(candidates**2, axis=2), axis=1)
+    return candidates[np.arange(len(k)), closest]
+
+# A uniform grid of k-points reduced to its irreducible part by a point
+# group. The grid has sizes[i] points along reciprocal lattice vector i,
+# offset by shift[i] grid spacings from Gamma. Grid points related by any
+# of the operations ops (which map the grid onto itself) are equivalent;
+# operations which do not map the grid onto itself are skipped. If periodic
+# is False, points are only equivalent if they are mapped onto each other
+# exactly, not up to a reciprocal lattice vector.
+#
+# sizes: the grid size along each reciprocal lattice vector
+# fullKpoints: all grid points, shape (numFull, 3), in the order of the
+#     grid indices (m1, m2, m3) with m3 varying fastest
+# kpoints: one point of each class of equivalent points, shape (numK, 3)
+# weights: fraction of the grid equivalent to each of kpoints (sums to 1)
+# fullIndex: index in kpoints of the point equivalent to each grid point
+class KGrid(object):
+    def __init__(self, lattice, sizes, shift=(0.0, 0.0, 0.0), ops=None,
+                 periodic=False):
+        B = reciprocalLattices[lattice]
+        sizes = np.array(sizes, dtype=int)
+        shift = np.array(shift, dtype=np.float64)
+        self.sizes = tuple(sizes)
+        m = np.indices(sizes).reshape(3, -1).T
+        frac = (m + shift) / sizes
+        self.fullKpoints = wignerSeitzFold(frac, B)
+        self.numOps = 0
+        # smallest index of the grid points equivalent to each point
+        rep = np.arange(len(m))
+        for R in (ops if ops is not None else [np.identity(3)]):
+            # R in the reciprocal lattice basis (rows are fractional k)
+            Rf = np.dot(np.dot(B, R.T), np.linalg.inv(B))
+            image = np.dot(frac, Rf) * sizes - shift
+            if (not np.allclose(Rf, np.round(Rf))
+                    or not np.allclose(image, np.round(image))):
+                continue
+            image = np.mod(np.round(image).astype(int), sizes)
+            imageIndex = np.ravel_multi_index(image.T, sizes)
+            if not periodic:
+                # on the zone boundary R may map a point onto another only
+                # up to a reciprocal lattice vector
+                exact = np.all(np.isclose(np.dot(self.fullKpoints, R.T),
+                                          self.fullKpoints[imageIndex]), axis=1)
+                imageIndex = np.where(exact, imageIndex, rep)
+            rep = np.minimum(rep, imageIndex)
+            self.numOps += 1
+        irreducible, self.fullIndex = np.unique(rep, return_inverse=True)
+        self.kpoints = self.fullKpoints[irreducible]
+        self.weights = np.bincount(self.fullIndex) / float(len(m))
+
+    # Return the values computed at kpoints (array with first axis of
+    # length numK) at each point of the full grid.
+    def unfold(self, values):
+        return np.asarray(values)[self.fullIndex]
+
+# If kpointsFileName is a VASP KPOINTS file in automatic mode (0 k-points
+# on line 1, then Gamma or Monkhorst-Pack, the grid size and optionally a
+# shift), return the KGrid for model calcType reduced by the symmetry of
+# the model. Return None if it is in line mode (as read by getKpoints).
+def getKpointGrid(kpointsFileName, calcType):
+    with open(kpointsFileName, 'r') as kpointsFile:
+        lines = kpointsFile.readlines()
+    if int(lines[1]) != 0:
+        return None
+    style = lines[2].strip()[:1].upper()
+    sizes = list(map(int, lines[3].split()))
+    shift = [0.0, 0.0, 0.0]
+    if len(lines) > 4 and lines[4].strip() != "":
+        shift = list(map(float, lines[4].split()))
+    if style not in ["G", "M"] or len(sizes) != 3 or len(shift) != 3:
+        print("error: unsupported automatic KPOINTS file " + kpointsFileName)
+        sys.exit(2)
+    if style == "M":
+        # Monkhorst-Pack grids with an even size do not include Gamma
+        shift = [s + 0.5*(1 - n % 2) for n, s in zip(sizes, shift)]
+    lattice, group, periodic = modelSymmetry[calcType]
+    return KGrid(lattice, sizes, shift, pointGroup(group), periodic)
+
+# Parameters which must be given (as numbers) in the JSON file of each
+# model. Optional parameters (A2 and B2 in 4band) are not listed.
+modelParams = {
+    "8band": ["P1", "Q1", "P2", "Q2", "P3", "Q3", "F1", "K1", "F3", "K3",
+              "F5", "K5", "F7", "K7", "U35re", "U35im", "V35re", "V35im",
+              "F37", "K37", "U47", "V47im", "U58re", "U58im", "V58re",
+              "V58im"],
+    "4band": ["C0", "C1", "C2", "M0", "M1", "M2", "A0", "B0", "R1", "R2"],
+    "mnk12": ["C", "A", "B", "M"]}
+
+# Parameter sets already loaded, keyed by file path. Each entry is
+# (modification time, parameters); the file is read again if it changes.
+paramCache = {}
+
+# Return the parameters of the model calcType, read from calcType + ".json"
+# in the working directory and checked against modelParams. The file is
+# only parsed the first time (or again after it is modified).
+def loadParams(calcType):
+    path = os.path.abspath(calcType + ".json")
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        print("error: parameter file " + path + " not found")
+        sys.exit(2)
+    if path not in paramCache or paramCache[path][0] != mtime:
+        with open(path, 'r') as propsFile:
+            props = json.load(propsFile)
+        missing = [name for name in modelParams.get(calcType, [])
+                   if not isinstance(props.get(name), (int, float))]
+        if len(missing) != 0:
+            print("error: " + path + " is missing parameters " + ", ".join(missing))
+            sys.exit(2)
+        paramCache[path] = (mtime, props)
+    # copy so that callers can't modify the cached parameters
+    return dict(paramCache[path][1])
+
+# Maximum number of Hamiltonian functions kept by cachedModel.
+MODEL_CACHE_SIZE = 32
+
+# Hamiltonian functions already built, least recently used first.
+modelCache = OrderedDict()
+
+# Return a key identifying the arguments args of a Hamiltonian generator:
+# parameter dicts are replaced by their sorted items so that equal
+# parameter sets give equal (and equally hashed) keys.
+def modelKey(args):
+    key = []
+    for arg in args:
+        if isinstance(arg, dict):
+            arg = tuple(sorted(arg.items()))
+        key.append(arg)
+    return tuple(key)
+
+# Return fn(*args), where fn is a Hamiltonian generator such as
+# Hamiltonian_4band, reusing the function built by an earlier call with
+# the same fn and equal arguments. The k-independent parts of the
+# Hamiltonian are computed by the generator, so this avoids redoing them
+# when the same model is evaluated many times (in sweeps and fits).
+def cachedModel(fn, *args):
+    key = (fn.__module__, fn.__name__, modelKey(args))
+    if key in modelCache:
+        H = modelCache.pop(key)
+    else:
+        # copy parameter dicts, which the generated function keeps
+        H = fn(*[dict(arg) if isinstance(arg, dict) else arg for arg in args])
+        if len(modelCache) >= MODEL_CACHE_SIZE:
+            modelCache.popitem(last=False)
+    modelCache[key] = H
+    return H
+
+# Return (fn, args) such that fn(*args) is the Hamiltonian function
+# (k -> H_k) of the type specified. Unlike the Hamiltonian function itself,
+# fn and args can be passed to worker processes.
+def HamiltonianSpec(calcType):
     fns = {"8band": Hamiltonian_8band, "4band": Hamiltonian_4band, "mnk12": Hamiltonian_mnk12}
     if calcType not in fns:
-        print("Usage: ti3D_eigen calcType kpointsFileName outFileName")
-        print("calcType should be 8band, 4band, or mnk12")
+        print(usage)
         sys.exit(2)
-    with open(calcType + ".json", 'r') as propsFile:
-        props = json.load(propsFile)
-        return fns[calcType](props)
+    return fns[calcType], (loadParams(calcType),)
+
+# Return a Hamiltonian function (k -> H_k) of the type specified
+def HamiltonianFn(calcType):
+    fn, args = HamiltonianSpec(calcType)
+    return cachedModel(fn, *args)
 
 # Generate 8-band Hamiltonian function with properties given by p.
 # This Hamiltonian is from Liu et al PRB 82, 045122 (2010).
 # Complex numbers in p are encoded as "varName" + ("re" or "im").
+# The returned function accepts either a single k-point, giving an 8x8
+# matrix, or an (N, 3) array of k-points, giving an (N, 8, 8) stack.
 def Hamiltonian_8band(p):
     k_plus = lambda k: k[0] + 1j*k[1]
     k_minus = lambda k: k[0] - 1j*k[1]
     f = lambda k, F, K: F * k[2]**2 + K * (k[0]**2 + k[1]**2)
     g = lambda k, U, V: U * k[2] * k_plus(k) + V * k_minus(k)**2
 
+    U35 = p["U35re"] + 1j*p["U35im"]
+    V35 = p["V35re"] + 1j*p["V35im"]
+    U36, V36 = U35.conjugate(), -V35.conjugate()
+    U58 = p["U58re"] + 1j*p["U58im"]
+    V58 = p["V58re"] + 1j*p["V58im"]
+    U68, V68 = -U58.conjugate(), V58.conjugate()
+
+    # Convert k from 2pi/(lattice vector) units to 1/A.
+    # TODO: ensure that this assignment of a and c is correct.
+    a_hex = 4.138
+    c_hex = 28.64
+    kScale = 2.0 * math.pi / np.array([[a_hex], [a_hex], [c_hex]])
+    idx = np.arange(8)
+
     def H(in_k):
-        # Convert k from 2pi/(lattice vector) units to 1/A.
-        # TODO: ensure that this assignment of a and c is correct.
-        a_hex = 4.138
-        c_hex = 28.64
-        k = [0, 0, 0]
-        k[0] = 2.0 * math.pi * in_k[0] / a_hex
-        k[1] = 2.0 * math.pi * in_k[1] / a_hex
-        k[2] = 2.0 * math.pi * in_k[2] / c_hex
+        k, single = kColumns(in_k)
+        k = kScale * k
 
         # Assume factors of (hbar)^2/(2m) and 2/hbar are absorbed into
         # constants. TODO: check that this is correct.
@@ -131,37 +434,82 @@ def Hamiltonian_8band(p):
                     f(k, p["F5"], p["K5"]), f(k, p["F5"], p["K5"]),
                     f(k, p["F7"], p["K7"]), f(k, p["F7"], p["K7"])]
 
-        top = np.zeros([8, 8], dtype=np.complex128)
-        top[0] = [0, 0, k[2]*p["Q1"], p["P1"]*k_minus(k), p["Q2"]*k_plus(k),
-                  k_plus(k)*p["P2"], k[2]*p["Q3"], k_minus(k)*p["P3"]]
+        top = np.zeros([k.shape[1], 8, 8], dtype=np.complex128)
+        top[:, 0] = matrixRow(0, 0, k[2]*p["Q1"], p["P1"]*k_minus(k),
+                              p["Q2"]*k_plus(k), k_plus(k)*p["P2"],
+                              k[2]*p["Q3"], k_minus(k)*p["P3"])
         # P1,2,3 and Q1,2,3 are real so ignore complex conjugate
-        top[1] = [0, 0, k_plus(k)*p["P1"], -k[2]*p["Q1"], -p["P2"]*k_minus(k),
-                  p["Q2"]*k_minus(k), p["P3"]*k_plus(k), -p["Q3"]*k[2]]
-
-        U35 = p["U35re"] + 1j*p["U35im"]
-        V35 = p["V35re"] + 1j*p["V35im"]
-        U36, V36 = U35.conjugate(), -V35.conjugate()
-        top[2] = [0, 0, 0, 0, g(k, U35, V35), g(k, U36, V36),
-                  f(k, p["F37"], p["K37"]), 
-                  -g(-k, p["U47"], 1j*p["V47im"]).conjugate()]
-        top[3] = [0, 0, 0, 0, g(-k, U36, V36).conjugate(),
-                  -g(-k, U35, V35).conjugate(), g(k, p["U47"], 1j*p["V47im"]),
-                  f(-k, p["F37"], p["K37"]).conjugate()]
-
-        U58 = p["U58re"] + 1j*p["U58im"]
-        V58 = p["V58re"] + 1j*p["V58im"]
-        U68, V68 = -U58.conjugate(), V58.conjugate()
-        top[4] = [0, 0, 0, 0, 0, 0, -g(-k, U68, V68).conjugate(),
-                  g(k, U58, V58)]
-        top[5] = [0, 0, 0, 0, 0, 0, g(-k, U58, V58).conjugate(),
-                  g(k, U68, V68)]
-
-        return makeHermitian(top + np.diag(diagonal))
+        top[:, 1] = matrixRow(0, 0, k_plus(k)*p["P1"], -k[2]*p["Q1"],
+                              -p["P2"]*k_minus(k), p["Q2"]*k_minus(k),
+                              p["P3"]*k_plus(k), -p["Q3"]*k[2])
+
+        top[:, 2] = matrixRow(0, 0, 0, 0, g(k, U35, V35), g(k, U36, V36),
+                              f(k, p["F37"], p["K37"]),
+                              -g(-k, p["U47"], 1j*p["V47im"]).conjugate())
+        top[:, 3] = matrixRow(0, 0, 0, 0, g(-k, U36, V36).conjugate(),
+                              -g(-k, U35, V35).conjugate(),
+                              g(k, p["U47"], 1j*p["V47im"]),
+                              f(-k, p["F37"], p["K37"]).conjugate())
+
+        top[:, 4] = matrixRow(0, 0, 0, 0, 0, 0,
+                              -g(-k, U68, V68).conjugate(), g(k, U58, V58))
+        top[:, 5] = matrixRow(0, 0, 0, 0, 0, 0,
+                              g(-k, U58, V58).conjugate(), g(k, U68, V68))
+
+        top[:, idx, idx] += np.stack(diagonal, axis=-1)
+        Hk = makeHermitian(top)
+        if single:
+            return Hk[0]
+        return Hk
 
     return H
 
+# Constant matrices of the terms of a GammaModel: the identity followed by
+# Gamma1 to Gamma5.
+GammaTerms = np.array([Ident, Gamma1, Gamma2, Gamma3, Gamma4, Gamma5],
+                      dtype=np.complex128)
+
+# A 4x4 Hamiltonian of the form H(k) = eps(k) Ident + sum_i d_i(k) Gamma_i,
+# stored as the table GammaTerms and a function coefficients(k) giving
+# [eps, d_1, ..., d_5] for k with shape (3, N) (each entry an array with
+# shape (N,) or a scalar). Calling the model gives H(k) like the other
+# Hamiltonian functions: a single k-point gives a 4x4 matrix, and an (N, 3)
+# array of k-points gives an (N, 4, 4) stack.
+class GammaModel(object):
+    def __init__(self, coefficients):
+        self.coefficients = coefficients
+
+    # Return the coefficients at in_k as an array with shape (6, N), and
+    # True if in_k was a single k-point.
+    def coefficientsAt(self, in_k):
+        k, single = kColumns(in_k)
+        terms = np.broadcast_arrays(k[0], *self.coefficients(k))[1:]
+        return np.array(terms, dtype=np.float64), single
+
+    def __call__(self, in_k):
+        c, single = self.coefficientsAt(in_k)
+        Hk = np.einsum("tn,tij->nij", c, GammaTerms)
+        if single:
+            return Hk[0]
+        return Hk
+
+    # Return the eigenvalues of H(k) in ascending order without
+    # diagonalizing: shape (4,) for a single k-point or (N, 4). Gamma1 to
+    # Gamma5 anticommute and square to the identity, so
+    # (sum_i d_i Gamma_i)^2 = |d|^2 Ident and the eigenvalues are
+    # eps - |d| and eps + |d|, each twice.
+    def eigenvalues(self, in_k):
+        c, single = self.coefficientsAt(in_k)
+        eps, d = c[0], np.sqrt(np.sum(c[1:]**2, axis=0))
+        vals = np.stack([eps - d, eps - d, eps + d, eps + d], axis=-1)
+        if single:
+            return vals[0]
+        return vals
+
 # Generate 4-band Hamiltonian function with properties given by p.
 # This Hamiltonian is also from Liu 2010.
+# The returned GammaModel accepts either a single k-point, giving a 4x4
+# matrix, or an (N, 3) array of k-points, giving an (N, 4, 4) stack.
 def Hamiltonian_4band(p):
     # (k_parallel)^2
     kp2 = lambda k: k[0]**2 + k[1]**2
@@ -184,47 +532,433 @@ def Hamiltonian_4band(p):
     # parenthetic expression in H3, Eq. 17, Liu 2010
     q = lambda kx, ky: kx**3 - 3.0*kx*(ky**2)
 
-    def H(in_k):
-        # Convert k from 2pi/(lattice vector) units to 1/A.
-        # TODO: ensure that this assignment of a and c is correct.
-        a_hex = 4.138
-        c_hex = 28.64
-        k = [0, 0, 0]
-        k[0] = 2.0 * math.pi * in_k[0] / a_hex
-        k[1] = 2.0 * math.pi * in_k[1] / a_hex
-        k[2] = 2.0 * math.pi * in_k[2] / a_hex
-
-        H0 = epsilon(k)*Ident + M(k)*Gamma5 + B(k)*Gamma4*k[2] + A(k)*(Gamma1*k[1] - Gamma2*k[0])
-        H3 = p["R1"]*Gamma3*q(k[0], k[1]) - p["R2"]*Gamma4*q(k[1], k[0])
-        return H0 + H3
+    # Convert k from 2pi/(lattice vector) units to 1/A.
+    # TODO: ensure that this assignment of a and c is correct.
+    a_hex = 4.138
+    kScale = 2.0 * math.pi / a_hex
 
-    return H
+    # H = H0 + H3: coefficients of Ident and Gamma1 to Gamma5
+    def coefficients(k):
+        k = kScale * k
+        A_k = A(k)
+        return [epsilon(k), A_k*k[1], -A_k*k[0], p["R1"]*q(k[0], k[1]),
+                B(k)*k[2] - p["R2"]*q(k[1], k[0]), M(k)]
+
+    return GammaModel(coefficients)
 
-# Generate mnk12 Hamiltonian function with properties given by p
+# Generate mnk12 Hamiltonian function with properties given by p.
+# The returned GammaModel accepts either a single k-point, giving a 4x4
+# matrix, or an (N, 3) array of k-points, giving an (N, 4, 4) stack.
 def Hamiltonian_mnk12(p):
-    d = lambda k: p["M"] - 2.0*p["B"] + 2.0*p["B"] * (math.cos(k[0])
-            + math.cos(k[1]) - 2.0)
-    def H(k):
+    d = lambda k: p["M"] - 2.0*p["B"] + 2.0*p["B"] * (np.cos(k[0])
+            + np.cos(k[1]) - 2.0)
+
+    # coefficients of Ident and Gamma1 to Gamma5
+    def coefficients(k):
         # Convert k from 2pi/(lattice vector) units to 1/(lattice vector).
         # Lattice vector factor eliminated in sin(kx * a), etc.
         k = 2.0 * math.pi * k
+        return [p["C"], p["A"]*np.sin(k[1]), p["A"]*np.sin(k[0]), 0.0,
+                p["A"]*np.sin(k[2]), 2.0*p["B"]*np.cos(k[2]) + d(k)]
 
-        diagonal = np.diag([p["C"]]*4)
-        sin_part = p["A"]*(Gamma2 * math.sin(k[0]) + Gamma1 * math.sin(k[1])
-                           + Gamma4 * math.sin(k[2]))
-        cos_part = Gamma5 * (2.0*p["B"] * math.cos(k[2]) + d(k))
-        return diagonal + sin_part + cos_part
+    return GammaModel(coefficients)
 
-    return H
+# Number of bytes of Hamiltonian matrices to build at once when
+# diagonalizing over many k-points.
+CHUNK_BYTES = 64 * 1024 * 1024
+
+# Return the number of k-points to diagonalize at once, given the shape of
+# the Hamiltonian for one k-point (dense or banded) and the solveStack
+# arguments mode. The chunk is limited by the size of the Hamiltonians and
+# of the eigenkets computed from them.
+def chunkSizeFor(shape, mode=None):
+    mode = mode or {}
+    dim = shape[-1]
+    size = int(np.prod(shape))
+    if not mode.get("eigvalsOnly", False):
+        numKets = dim
+        if mode.get("bands") is not None:
+            numKets = mode["bands"][1] - mode["bands"][0]
+        size = max(size, dim * numKets)
+    return max(1, CHUNK_BYTES // (16 * size))
+
+# Return True if scipy.linalg.eigh accepts the subset_by_index and
+# subset_by_value keywords (scipy 1.5 and later).
+def eighHasSubsets():
+    try:
+        linalg.eigh(np.eye(1), subset_by_index=[0, 0])
+    except TypeError:
+        return False
+    return True
+
+EIGH_SUBSETS = eighHasSubsets()
+
+# Diagonalize the Hermitian matrix Hk for solveStack with a scipy whose eigh
+# has no subset keywords: bands are selected with the older eigvals=(LO,
+# HI-1) argument, which also uses a subset driver; for a window, whose
+# bounds older scipy can't pass to LAPACK, all eigenpairs are found and
+# those in the window kept.
+def eighSubsetFallback(Hk, eigvalsOnly, bands, window):
+    kwargs = {"eigvals_only": eigvalsOnly, "overwrite_a": True,
+              "check_finite": False}
+    if bands is not None:
+        return linalg.eigh(Hk, eigvals=(bands[0], bands[1] - 1), **kwargs)
+    result = linalg.eigh(Hk, **kwargs)
+    vals = result if eigvalsOnly else result[0]
+    inWindow = (vals > window[0]) & (vals <= window[1])
+    if eigvalsOnly:
+        return vals[inWindow]
+    return vals[inWindow], result[1][:, inWindow]
+
+# Diagonalize each of the Hermitian matrices in the stack Hs (shape
+# (n, d, d)). Return (eigenvals, eigenkets) as for numpy.linalg.eigh.
+# If eigvalsOnly is True, the eigenkets are not computed and None is
+# returned in their place. bands = (LO, HI) restricts the solution to bands
+# LO to HI-1, and window = (EMIN, EMAX) to the eigenvalues in (EMIN, EMAX];
+# these use the LAPACK subset drivers, which compute only the requested
+# eigenpairs (except for a window with scipy older than 1.5, see
+# eighSubsetFallback). The number of eigenvalues in a window depends on k, so the
+# results are padded to the largest number found with NaN eigenvalues and
+# NaN eigenkets.
+# If banded is True, Hs holds matrices in LAPACK upper banded storage
+# (shape (n, u+1, d), see scipy.linalg.eig_banded) and the banded Hermitian
+# solver is used.
+def solveStack(Hs, eigvalsOnly=False, bands=None, window=None, banded=False):
+    if not banded and bands is None and window is None:
+        if eigvalsOnly:
+            return np.linalg.eigvalsh(Hs), None
+        return np.linalg.eigh(Hs)
+    if banded:
+        kwargs = {"eigvals_only": eigvalsOnly, "lower": False,
+                  "overwrite_a_band": True, "check_finite": False}
+        if bands is not None:
+            kwargs["select"] = "i"
+            kwargs["select_range"] = (bands[0], bands[1] - 1)
+        elif window is not None:
+            kwargs["select"] = "v"
+            kwargs["select_range"] = window
+        solve = lambda Hk: linalg.eig_banded(Hk, **kwargs)
+    elif EIGH_SUBSETS:
+        kwargs = {"eigvals_only": eigvalsOnly, "overwrite_a": True,
+                  "check_finite": False, "driver": "evr"}
+        if bands is not None:
+            kwargs["subset_by_index"] = [bands[0], bands[1] - 1]
+        else:
+            kwargs["subset_by_value"] = window
+        solve = lambda Hk: linalg.eigh(Hk, **kwargs)
+    else:
+        solve = lambda Hk: eighSubsetFallback(Hk, eigvalsOnly, bands, window)
+    results = [solve(Hk) for Hk in Hs]
+    if eigvalsOnly:
+        results = [(vals, None) for vals in results]
+    width = max(len(vals) for vals, kets in results)
+    eigenvals = np.full([len(Hs), width], np.nan)
+    eigenkets = None
+    if not eigvalsOnly:
+        eigenkets = np.full([len(Hs), Hs.shape[-1], width], np.nan,
+                            dtype=np.complex128)
+    for i, (vals, kets) in enumerate(results):
+        eigenvals[i, :len(vals)] = vals
+        if kets is not None:
+            eigenkets[i, :, :len(vals)] = kets
+    return eigenvals, eigenkets
+
+# Return the eigenvalues of the Hamiltonian H at the k-points ks (shape
+# (n, 3)) from the closed form H.eigenvalues, selecting bands or a window
+# and padding with NaN as solveStack does.
+def closedFormEigenvals(H, ks, bands=None, window=None):
+    eigenvals = H.eigenvalues(ks)
+    if bands is not None:
+        return eigenvals[:, bands[0]:bands[1]]
+    if window is not None:
+        inWindow = (eigenvals > window[0]) & (eigenvals <= window[1])
+        # move the eigenvalues in the window to the front, keeping their order
+        order = np.argsort(~inWindow, axis=1, kind="stable")
+        eigenvals = np.where(inWindow, eigenvals, np.nan)
+        eigenvals = np.take_along_axis(eigenvals, order, axis=1)
+        return eigenvals[:, :inWindow.sum(axis=1).max()]
+    return eigenvals
+
+# Diagonalize the Hamiltonian H at the k-points ks with solveStack
+# arguments mode (all eigenpairs if mode is None). If only eigenvalues are
+# needed and H has closed-form eigenvalues (a GammaModel), these are used
+# instead of building and diagonalizing the matrices.
+def diagonalizeAt(H, ks, mode=None):
+    mode = mode or {}
+    if (mode.get("eigvalsOnly", False) and not mode.get("banded", False)
+            and hasattr(H, "eigenvalues")):
+        return closedFormEigenvals(H, ks, mode.get("bands"), mode.get("window")), None
+    return solveStack(H(ks), **mode)
+
+# Return the keyword arguments for solveStack selected by the command-line
+# options: --eigen vals, --bands LO:HI, --window EMIN:EMAX.
+def eigenMode(options):
+    mode = {"eigvalsOnly": options.get("eigen", "full") == "vals",
+            "bands": parseRange(options.get("bands"))}
+    if "window" in options:
+        emin, emax = options["window"].split(":")
+        mode["window"] = (float(emin), float(emax))
+    return mode
+
+# Return True if the command-line options for solveStack (and --connect,
+# which needs all the eigenkets of a fixed number of bands, and --kets,
+# which must lie within --bands) are valid.
+def validEigenOptions(options):
+    connect = options.get("connect", "sorted")
+    bands, kets = parseRange(options.get("bands")), parseRange(options.get("kets"))
+    return (options.get("eigen", "full") in ["full", "vals"]
+            and not ("bands" in options and "window" in options)
+            and connect in ["sorted", "overlap"]
+            and not (connect == "overlap"
+                     and (options.get("eigen") == "vals" or "window" in options))
+            and (kets is None or 0 <= kets[0] <= kets[1])
+            and (kets is None or bands is None
+                 or bands[0] <= kets[0] <= kets[1] <= bands[1]))
+
+# Return the eigenkets to store given by --kets, as a (LO, HI) range of the
+# bands found (None for all). --kets counts bands from 0 like --bands, so
+# with --bands the range is shifted to start at the first band found.
+def ketRange(options):
+    kets = parseRange(options.get("kets"))
+    bands = parseRange(options.get("bands"))
+    if kets is None or bands is None:
+        return kets
+    return kets[0] - bands[0], kets[1] - bands[0]
 
-# Write the output for one kpoint
+# Diagonalize the Hamiltonian H over kpoints, building and diagonalizing
+# the Hamiltonians for many k-points at once. Yields (ks, eigenvals,
+# eigenkets) for each chunk of k-points: eigenvals has shape (n, d) and
+# eigenkets has shape (n, d, d), with the eigenket belonging to
+# eigenvals[i, j] in the column eigenkets[i, :, j].
+# If chunkSize is None, it is chosen so that each chunk of Hamiltonians
+# occupies about CHUNK_BYTES. mode gives keyword arguments for solveStack
+# (all eigenpairs are found if it is None).
+def diagonalizeChunks(H, kpoints, chunkSize=None, mode=None):
+    kpoints = np.asarray(kpoints, dtype=np.float64)
+    if len(kpoints) == 0:
+        return
+    if chunkSize is None:
+        chunkSize = chunkSizeFor(H(kpoints[0]).shape, mode)
+    for start in range(0, len(kpoints), chunkSize):
+        ks = kpoints[start:start+chunkSize]
+        eigenvals, eigenkets = diagonalizeAt(H, ks, mode)
+        yield ks, eigenvals, eigenkets
+
+# Environment variables controlling the number of threads used by the
+# BLAS/LAPACK libraries numpy may be linked against.
+BLAS_THREAD_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                    "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS"]
+
+# Hamiltonian function and solveStack arguments used by a worker process
+# of diagonalizeParallel.
+workerH = None
+workerMode = None
+
+def initWorker(fn, args, mode):
+    global workerH, workerMode
+    workerH = fn(*args)
+    workerMode = mode or {}
+
+def diagonalizeWorker(ks):
+    return diagonalizeAt(workerH, ks, workerMode)
+
+# Start a pool of jobs worker processes, each of which builds the
+# Hamiltonian fn(*args) and diagonalizes with solveStack arguments mode.
+# The workers are started with the BLAS thread count set to blasThreads so
+# that they do not oversubscribe the node.
+def startPool(jobs, fn, args, mode, blasThreads):
+    saved = dict((var, os.environ.get(var)) for var in BLAS_THREAD_VARS)
+    for var in BLAS_THREAD_VARS:
+        os.environ[var] = str(blasThreads)
+    try:
+        # spawn (rather than fork) so that the workers load BLAS after the
+        # thread count variables are set. Python 2 has no get_context and
+        # only forks, so there the workers keep the BLAS the parent loaded
+        # and the thread count is only set by the caller's environment.
+        if not hasattr(multiprocessing, "get_context"):
+            return multiprocessing.Pool(jobs, initializer=initWorker,
+                                        initargs=(fn, args, mode))
+        ctx = multiprocessing.get_context("spawn")
+        return ctx.Pool(jobs, initializer=initWorker, initargs=(fn, args, mode))
+    finally:
+        for var, val in saved.items():
+            if val is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = val
+
+# Same as diagonalizeChunks, but split the k-points over jobs worker
+# processes. The Hamiltonian function is given as (fn, args) as returned
+# by HamiltonianSpec. Chunks are yielded in k order as they complete.
+# Each worker uses blasThreads BLAS threads.
+def diagonalizeParallel(fn, args, kpoints, jobs, chunkSize=None, mode=None,
+                        blasThreads=1):
+    kpoints = np.asarray(kpoints, dtype=np.float64)
+    if len(kpoints) == 0:
+        return
+    if chunkSize is None:
+        chunkSize = chunkSizeFor(fn(*args)(kpoints[0]).shape, mode)
+        # keep several chunks per worker so that the load stays balanced
+        chunkSize = max(1, min(chunkSize, len(kpoints) // (4*jobs)))
+    chunks = [kpoints[start:start+chunkSize]
+              for start in range(0, len(kpoints), chunkSize)]
+    pool = startPool(jobs, fn, args, mode, blasThreads)
+    try:
+        for ks, (eigenvals, eigenkets) in zip(chunks, pool.imap(diagonalizeWorker, chunks)):
+            yield ks, eigenvals, eigenkets
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# Write the output for one kpoint. eigenkets may be None if only the
+# eigenvalues were computed. NaN padding added by solveStack is dropped.
 def writeOutput(k, eigenvals, eigenkets, outFile):
     #TODO
+    eigenvals = eigenvals[~np.isnan(eigenvals)]
     outFile.write(str(k) + "\n")
     outFile.write(str(eigenvals) + "\n")
-    outFile.write(str(eigenkets) + "\n")
+    if eigenkets is not None:
+        outFile.write(str(eigenkets[:, :len(eigenvals)]) + "\n")
     return None
 
+# Stores the results for many k-points as .npy files in the directory
+# path. The files are memory-mapped and filled in a chunk of k-points at a
+# time, so the full set of results never has to fit in memory:
+#   k.npy           (numK, 3)                   k-points
+#   eigenvals.npy   (numK, numBands)            eigenvalues
+#   eigenkets.npy   (numK, dim, numKets)        eigenkets of the bands
+#                                               ketBands[0] to ketBands[1]-1
+#   layers.npy      (numK, numBands, numLayers) per-layer weight of each
+#                                               eigenket (slabs only)
+# The results can be read back with, e.g.,
+# numpy.load(path + "/eigenvals.npy", mmap_mode="r").
+class ResultStore(object):
+    # ketBands = (LO, HI) selects the eigenkets to store (all if None).
+    # numBands is the number of eigenvalues stored per k-point; if None it
+    # is taken from the first chunk. Chunks with fewer eigenvalues (e.g.
+    # from an energy window) are padded with NaN.
+    def __init__(self, path, numK, ketBands=None, numBands=None):
+        self.path = path
+        self.numK = numK
+        self.ketBands = ketBands
+        self.numBands = numBands
+        self.count = 0
+        self.arrays = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    # Create the .npy files, given the first chunk of results.
+    def open(self, eigenvals, eigenkets, layers):
+        if self.numBands is None:
+            self.numBands = eigenvals.shape[1]
+        numBands = self.numBands
+        if self.ketBands is None:
+            self.ketBands = (0, numBands)
+        self.ketBands = (min(self.ketBands[0], numBands), min(self.ketBands[1], numBands))
+        numKets = self.ketBands[1] - self.ketBands[0]
+        shapes = {"k": ((self.numK, 3), np.float64),
+                  "eigenvals": ((self.numK, numBands), np.float64)}
+        if eigenkets is not None:
+            dim = eigenkets.shape[1]
+            shapes["eigenkets"] = ((self.numK, dim, numKets), np.complex128)
+        if layers is not None:
+            shapes["layers"] = ((self.numK, numBands, layers.shape[-1]), np.float64)
+        self.arrays = {}
+        for name, (shape, dtype) in shapes.items():
+            fileName = os.path.join(self.path, name + ".npy")
+            self.arrays[name] = np.lib.format.open_memmap(fileName, mode="w+",
+                                                          dtype=dtype, shape=shape)
+
+    # Append the results for the chunk of k-points ks. eigenvals and
+    # eigenkets are as given by diagonalizeChunks (eigenkets may be None);
+    # layers (optional) has shape (n, numBands, numLayers).
+    def write(self, ks, eigenvals, eigenkets, layers=None):
+        if self.arrays is None:
+            self.open(eigenvals, eigenkets, layers)
+        start, stop = self.count, self.count + len(ks)
+        width = min(eigenvals.shape[1], self.numBands)
+        self.arrays["k"][start:stop] = ks
+        self.arrays["eigenvals"][start:stop] = np.nan
+        self.arrays["eigenvals"][start:stop, :width] = eigenvals[:, :width]
+        if eigenkets is not None and "eigenkets" in self.arrays:
+            # a chunk from an energy window may hold fewer eigenkets than
+            # asked for, or none of them; the missing ones are NaN
+            lo, hi = self.ketBands
+            lo, hi = min(lo, width), min(hi, width)
+            kets = self.arrays["eigenkets"]
+            kets[start:stop, :, max(hi-lo, 0):] = np.nan
+            if hi > lo:
+                kets[start:stop, :, :hi-lo] = eigenkets[:, :, lo:hi]
+        if layers is not None and "layers" in self.arrays:
+            self.arrays["layers"][start:stop, :width] = layers[:, :width]
+        self.count = stop
+
+    # Write the band order found by BandTracker (shape (numK, numBands)):
+    # eigenvals[i, order[i, b]] is band b at k-point i.
+    def writeBandOrder(self, order):
+        np.save(os.path.join(self.path, "bandOrder.npy"), np.array(order))
+
+    # Write the weights of the k-points of the KGrid grid, and the full grid
+    # with the index of the stored k-point equivalent to each of its points:
+    # eigenvals[fullIndex] gives the eigenvalues on the full grid.
+    def writeGrid(self, grid):
+        np.save(os.path.join(self.path, "weights.npy"), grid.weights)
+        np.save(os.path.join(self.path, "fullk.npy"), grid.fullKpoints)
+        np.save(os.path.join(self.path, "fullIndex.npy"), grid.fullIndex)
+
+    def close(self):
+        if self.arrays is not None:
+            for arr in self.arrays.values():
+                arr.flush()
+        self.arrays = None
+
+# Connects bands between successive k-points along a path by the overlap of
+# their eigenkets rather than by eigenvalue index, so that band crossings
+# are not drawn as anticrossings. At each k-point, step finds the
+# assignment of eigenstates to the bands of the previous k-point which
+# maximizes the total overlap |<previous|current>|^2 (a linear assignment
+# problem). Within a degenerate subspace the eigenkets are arbitrary, so
+# the subspace is first rotated to match the previous bands overlapping it
+# most. Each step costs O(d nb^2) for nb bands of dimension d, plus the
+# assignment.
+class BandTracker(object):
+    # Eigenvalues closer than degenerateTol are treated as degenerate.
+    def __init__(self, degenerateTol=1e-6):
+        self.degenerateTol = degenerateTol
+        # eigenkets of the bands at the previous k-point, in band order
+        self.previous = None
+
+    # Rotate the eigenkets (columns of kets) of each degenerate subspace to
+    # be as close as possible to the previous bands overlapping it most.
+    def alignDegenerate(self, eigenvals, kets):
+        breaks = np.nonzero(np.diff(eigenvals) > self.degenerateTol)[0] + 1
+        for group in np.split(np.arange(len(eigenvals)), breaks):
+            if len(group) < 2:
+                continue
+            P = kets[:, group]
+            A = np.dot(P.conj().T, self.previous)
+            closest = np.argsort(-np.sum(np.abs(A)**2, axis=0))[:len(group)]
+            # unitary R maximizing Re tr(R^H A) (orthogonal Procrustes)
+            W, sigma, Vh = np.linalg.svd(A[:, closest])
+            kets[:, group] = np.dot(P, np.dot(W, Vh))
+        return kets
+
+    # Return order such that eigenvals[order[b]] is band b at this k-point,
+    # given the eigenvalues (in ascending order) and eigenkets (in columns)
+    # at the k-point following the previous one.
+    def step(self, eigenvals, eigenkets):
+        kets = np.array(eigenkets, dtype=np.complex128)
+        if self.previous is None:
+            order = np.arange(len(eigenvals))
+        else:
+            kets = self.alignDegenerate(eigenvals, kets)
+            overlap = np.abs(np.dot(self.previous.conj().T, kets))**2
+            bands, states = linear_sum_assignment(-overlap)
+            order = states[np.argsort(bands)]
+        self.previous = kets[:, order]
+        return order
+
 # Decompose eigenvalList (with format [[k, eigenvals]]) into bands and make
 # band plot.
 def plotEigenvals(eigenvalList):
@@ -233,10 +967,15 @@ def plotEigenvals(eigenvalList):
         return
     kpoints = []
     bands = []
-    for i in range(len(eigenvalList[0][1])):
+    # with an energy window the number of eigenvalues varies with k: pad
+    # the missing ones with NaN, which are left out of the plot
+    numBands = max(len(eigenvals) for k, eigenvals in eigenvalList)
+    for i in range(numBands):
         bands.append([])
     for k, eigenvals in eigenvalList:
         kpoints.append(k)
+        for i in range(numBands, len(eigenvals), -1):
+            bands[i-1].append(float("nan"))
         for i in range(len(eigenvals)):
             bands[i].append(eigenvals[i])
     for i in range(len(bands)):
@@ -245,31 +984,70 @@ def plotEigenvals(eigenvalList):
 
 def main():
     # command line arguments
-    calcType, kpointsFileName, outFileName = parseArgs()
-    # read input file
-    kpoints = getKpoints(kpointsFileName)
+    calcType, kpointsFileName, outFileName, options = parseArgs()
+    jobs = int(options.get("jobs", 1))
+    mode = eigenMode(options)
+    # read input file: a uniform grid is reduced by the model's symmetry
+    grid = getKpointGrid(kpointsFileName, calcType)
+    if grid is not None:
+        kpoints = grid.kpoints
+    else:
+        kpoints = getKpoints(kpointsFileName)
     # get appropriate Hamiltonian
-    H = HamiltonianFn(calcType)
+    fn, args = HamiltonianSpec(calcType)
+    if jobs > 1:
+        chunks = diagonalizeParallel(fn, args, kpoints, jobs, mode=mode)
+    else:
+        chunks = diagonalizeChunks(fn(*args), kpoints, mode=mode)
+
+    store, outFile = None, None
+    if options.get("format", "text") == "npy":
+        # an energy window may hold any number of bands, up to all of them
+        numBands = None
+        if "window" in mode:
+            numBands = fn(*args)(kpoints[0]).shape[-1]
+        store = ResultStore(outFileName, len(kpoints), ketRange(options),
+                            numBands)
+        if grid is not None:
+            store.writeGrid(grid)
+    else:
+        outFile = open(outFileName, 'w')
+
+    tracker, bandOrder = None, []
+    if options.get("connect", "sorted") == "overlap":
+        tracker = BandTracker()
 
     seenZero = False # TODO - fix this hack - keeping only k_x for plot
     eigenvalList = []
-    with open(outFileName, 'w') as outFile:
-        # iterate over kpoints (parallelize later if necessary)
-        for k in kpoints:
-            # get Hamiltonian for this k-point
-            Hk = H(k)
-            # diagonalize Hamiltonian
-            eigenvals, eigenkets = linalg.eigh(Hk)
-            # handle output
-            writeOutput(k, eigenvals, eigenkets, outFile)
+    # build and diagonalize the Hamiltonians a chunk of kpoints at a time
+    for ks, eigenvalsChunk, eigenketsChunk in chunks:
+        # handle output
+        if store is not None:
+            store.write(ks, eigenvalsChunk, eigenketsChunk)
+        if eigenketsChunk is None:
+            eigenketsChunk = [None]*len(ks)
+        for k, eigenvals, eigenkets in zip(ks, eigenvalsChunk, eigenketsChunk):
+            if outFile is not None:
+                writeOutput(k, eigenvals, eigenkets, outFile)
+            if tracker is not None:
+                order = tracker.step(eigenvals, eigenkets)
+                bandOrder.append(order)
+                eigenvals = eigenvals[order]
             if k[1] == 0.0 and (k[0] != 0.0 or not seenZero): # TODO - fix this hack - keeping only k_x for plot
                 if k[0] == 0.0:
                     seenZero = True
                 a_hex = 4.138
                 k[0] = 2.0 * math.pi * k[0] / a_hex
                 eigenvalList.append([k[0], eigenvals])
+    if store is not None:
+        if tracker is not None:
+            store.writeBandOrder(bandOrder)
+        store.close()
+    else:
+        outFile.close()
     # plotting
-    plotEigenvals(eigenvalList)
+    if grid is None:
+        plotEigenvals(eigenvalList)
 
 if __name__ == "__main__":
     main()